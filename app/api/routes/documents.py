@@ -11,23 +11,12 @@ from typing import Optional
 from pypdf import PdfReader
 # from markdownify import markdownify as md
 # Opzionale, se estraiamo HTML e vogliamo MD
-from google.api_core import exceptions as google_exceptions
-from app.services.embedding.embedding_service import generate_embeddings
-from app.services.chunking.agentic_chunker import chunk_text_agentically
+from app.services.embedding.model_migration import get_active_collection_name
+from app.core.indexing_pipeline import index_items, SOURCE_DOCUMENT
 from app.utils import build_full_config_for_background_process
 
 logger = logging.getLogger(__name__)  
 
-try:
-    from app.services.embedding.gemini_embedding import split_text_into_chunks, get_gemini_embeddings, TASK_TYPE_DOCUMENT
-except ImportError:
-    # Fallback se la struttura è leggermente diversa, aggiusta se necessario
-    logger.error("!!! Impossibile importare funzioni di embedding/chunking !!!")
-    split_text_into_chunks = None
-    get_gemini_embeddings = None
-    TASK_TYPE_DOCUMENT = "retrieval_document" # Definisci comunque la costante
-
-
 documents_bp = Blueprint('documents', __name__)
 
 def allowed_file(filename):
@@ -87,113 +76,12 @@ def extract_text_from_file(file_storage, original_filename):
 
 def _index_document(doc_id: str, conn: sqlite3.Connection, user_id: str, core_config: dict) -> str:
     """
-    Esegue l'indicizzazione di un documento (lettura MD, chunk, embed, Chroma).
+    Esegue l'indicizzazione di un documento (lettura MD, chunk, embed, Chroma) tramite la pipeline comune.
     NON fa commit; si aspetta che il chiamante gestisca la transazione.
     Restituisce lo stato finale ('completed' o 'failed_...').
     """
     logger.info(f"[_index_document][{doc_id}] Avvio indicizzazione per UserID: {user_id}")
-    final_status = 'failed_indexing_init'
-    cursor = conn.cursor()
-
-    embedding_model = core_config.get('GEMINI_EMBEDDING_MODEL')
-    chunk_size = core_config.get('DEFAULT_CHUNK_SIZE_WORDS', 300)
-    chunk_overlap = core_config.get('DEFAULT_CHUNK_OVERLAP_WORDS', 50)
-    base_doc_collection_name = core_config.get('DOCUMENT_COLLECTION_NAME', 'document_content')
-    use_agentic_chunking = str(core_config.get('USE_AGENTIC_CHUNKING', 'False')).lower() == 'true'
-
-    chroma_client = core_config.get('CHROMA_CLIENT')
-    if not chroma_client: 
-        logger.error(f"[_index_document][{doc_id}] Chroma Client non trovato!")
-        return 'failed_config_client_missing'
-    if not user_id:
-        logger.error(f"[_index_document][{doc_id}] User ID mancante!")
-        return 'failed_user_id_missing'
-
-    user_doc_collection_name = f"{base_doc_collection_name}_{user_id}"
-    try:
-        doc_collection = chroma_client.get_or_create_collection(name=user_doc_collection_name)
-    except Exception as e_coll:
-        logger.error(f"[_index_document][{doc_id}] Errore get/create collezione '{user_doc_collection_name}': {e_coll}")
-        return 'failed_chroma_collection'
-
-    logger.info(f"[_index_document][{doc_id}] Collezione Chroma '{user_doc_collection_name}' pronta.")
-
-    try:
-        cursor.execute("SELECT content, original_filename FROM documents WHERE doc_id = ?", (doc_id,))
-        doc_data = cursor.fetchone()
-        if not doc_data: 
-            logger.error(f"[_index_document][{doc_id}] Record non trovato nel DB.")
-            return 'failed_doc_not_found'
-        
-        markdown_content, original_filename = doc_data[0], doc_data[1]
-        
-        if not markdown_content or not markdown_content.strip():
-             final_status = 'completed'
-        else:
-             chunks = []
-             if use_agentic_chunking:
-                try:
-                    chunks = chunk_text_agentically(
-                        markdown_content, 
-                        llm_provider=core_config.get('llm_provider', 'google'), 
-                        settings=core_config
-                    )
-                except google_exceptions.ResourceExhausted as e:
-                    logger.warning(f"[_index_document][{doc_id}] Quota API esaurita. Fallback a chunking classico. Errore: {e}")
-                    chunks = [] 
-
-                if not chunks:
-                    logger.warning(f"[_index_document][{doc_id}] Chunking intelligente fallito. Fallback a classico.")
-                    chunks = split_text_into_chunks(markdown_content, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-             else:
-                chunks = split_text_into_chunks(markdown_content, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-
-             if not chunks:
-                 final_status = 'completed'
-             else:
-                 embeddings = generate_embeddings(chunks, user_settings=core_config, task_type=TASK_TYPE_DOCUMENT)
-                 if not embeddings or len(embeddings) != len(chunks):
-                     final_status = 'failed_embedding'
-                 else:
-                     ids = [f"{doc_id}_chunk_{i}" for i in range(len(chunks))]
-                     metadatas_chroma = [{
-                         "doc_id": doc_id, "original_filename": original_filename,
-                         "chunk_index": i, "source_type": "document",
-                         "user_id": user_id
-                     } for i in range(len(chunks))]
-                     doc_collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas_chroma, documents=chunks)
-                     final_status = 'completed'
-
-    except Exception as e:
-        logger.error(f"[_index_document][{doc_id}] Errore inatteso: {e}", exc_info=True)
-        final_status = 'failed_processing_generic'
-
-    if final_status == 'completed':
-        try:
-            import textstat
-            stats = { 'word_count': 0, 'gunning_fog': 0 }
-            if markdown_content and markdown_content.strip():
-                stats['word_count'] = len(markdown_content.split())
-                stats['gunning_fog'] = textstat.gunning_fog(markdown_content)
-
-            cursor.execute("""
-                INSERT INTO content_stats (content_id, user_id, source_type, word_count, gunning_fog)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(content_id) DO UPDATE SET
-                    word_count = excluded.word_count,
-                    gunning_fog = excluded.gunning_fog,
-                    last_calculated = CURRENT_TIMESTAMP
-            """, (doc_id, user_id, 'document', stats['word_count'], stats['gunning_fog']))
-        except Exception as e_stats:
-            logger.error(f"[_index_document][{doc_id}] Errore calcolo statistiche: {e_stats}")
-
-    try:
-        cursor.execute("UPDATE documents SET processing_status = ? WHERE doc_id = ?", (final_status, doc_id))
-    except sqlite3.Error as db_update_err:
-         logger.error(f"[_index_document][{doc_id}] Errore CRITICO aggiornamento DB: {db_update_err}")
-         final_status = 'failed_db_status_update'
-
-    return final_status
+    return index_items(SOURCE_DOCUMENT, [doc_id], conn, user_id, core_config)[doc_id]
 
 
 @documents_bp.route('/upload', methods=['POST'])
@@ -298,7 +186,7 @@ def delete_document(doc_id):
 
         chroma_client = current_app.config.get('CHROMA_CLIENT')
         if chroma_client:
-            user_doc_collection_name = f"{base_doc_collection_name}_{current_user_id}"
+            user_doc_collection_name = get_active_collection_name(base_doc_collection_name, current_user_id, current_app.config)
             try:
                 doc_collection = chroma_client.get_collection(name=user_doc_collection_name)
                 chunks_to_delete = doc_collection.get(where={"doc_id": doc_id}, include=[])
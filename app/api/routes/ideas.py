@@ -1,5 +1,4 @@
 import logging
-import sqlite3
 import os
 import time 
 import requests
@@ -8,6 +7,9 @@ import google.generativeai as genai
 from google.api_core import exceptions as google_exceptions
 from flask import Blueprint, jsonify, current_app
 from app.api.routes.search import _get_ollama_completion 
+from app.services.rate_limiter.token_bucket import acquire, BUCKET_GEMINI, LANE_INTERACTIVE
+from app.services.embedding.model_migration import get_active_collection_name
+from app.core.effective_settings import get_effective_settings
 from flask_login import login_required, current_user
 
 logger = logging.getLogger(__name__)
@@ -37,7 +39,7 @@ def _get_random_chunks_from_collections(user_id, config, sample_size=20):
     }
 
     for base_name in base_names.values():
-        collection_name = f"{base_name}_{user_id}"
+        collection_name = get_active_collection_name(base_name, user_id, config)
         try:
             collection = chroma_client.get_collection(name=collection_name)
             # Il metodo .get() di ChromaDB recupera i dati. Usiamo include=["documents"]
@@ -74,28 +76,14 @@ def _generate_content_ideas_core(user_id, config):
         ollama_base_url = None
         models_to_try = config.get('RAG_MODELS_LIST')
         
-        db_path_settings = config.get('DATABASE_FILE')
-        conn_settings = None
-        if user_id and db_path_settings:
-            try:
-                conn_settings = sqlite3.connect(db_path_settings)
-                conn_settings.row_factory = sqlite3.Row
-                cursor_settings = conn_settings.cursor()
-                cursor_settings.execute("SELECT * FROM user_settings WHERE user_id = ?", (user_id,))
-                user_settings = cursor_settings.fetchone()
-                
-                if user_settings:
-                    logger.info(f"Trovate impostazioni AI personalizzate per l'utente {user_id}.")
-                    llm_provider = user_settings['llm_provider'] or 'google'
-                    ollama_base_url = user_settings['ollama_base_url']
-                    if user_settings['llm_api_key']: 
-                        llm_api_key = user_settings['llm_api_key']
-                    if user_settings['llm_model_name']:
-                        models_to_try = [m.strip() for m in user_settings['llm_model_name'].split(',') if m.strip()]
-            except sqlite3.Error as e:
-                logger.error(f"Errore DB nel recuperare le impostazioni AI per l'utente {user_id}: {e}")
-            finally:
-                if conn_settings: conn_settings.close()
+        if user_id and config.get('DATABASE_FILE'):
+            effective_settings = get_effective_settings(user_id, config)
+            llm_provider = effective_settings.llm_provider or 'google'
+            ollama_base_url = effective_settings.ollama_base_url
+            if effective_settings.llm_api_key:
+                llm_api_key = effective_settings.llm_api_key
+            if effective_settings.rag_models:
+                models_to_try = list(effective_settings.rag_models)
         
         if not models_to_try:
              models_to_try = config.get('RAG_MODELS_LIST', ["gemini-1.5-pro-latest"])
@@ -176,6 +164,7 @@ def _generate_content_ideas_core(user_id, config):
             for model_name in models_to_try:
                 logger.info(f"Tentativo generazione idee con il modello Google: {model_name}")
                 try:
+                    acquire(BUCKET_GEMINI, lane=LANE_INTERACTIVE)
                     model = genai.GenerativeModel(model_name)
                     response = model.generate_content(prompt)
                     
@@ -13,10 +13,8 @@ from flask import Blueprint, current_app, send_from_directory, flash, redirect,
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 
-# Importiamo le funzioni di re-indicizzazione che abbiamo creato/identificato
-from app.api.routes.videos import _reindex_video_from_db
-from app.api.routes.documents import _index_document
-from app.api.routes.rss import _index_article
+from app.core.indexing_pipeline import index_items, SOURCE_VIDEO, SOURCE_DOCUMENT, SOURCE_ARTICLE, SOURCE_PAGE
+from app.core.setup import init_db
 
 logger = logging.getLogger(__name__)
 protection_bp = Blueprint('protection', __name__)
@@ -40,9 +38,8 @@ def _background_reindex_all_content(app_context, user_id: str):
     logger.info(f"[REINDEX_ALL] Avvio task in background per utente {user_id}")
     
     with app_context:
-        # Importiamo le funzioni di utilità e di indicizzazione qui dentro
+        # Importiamo le funzioni di utilità qui dentro
         from app.utils import build_full_config_for_background_process
-        from app.api.routes.website import _index_page 
 
         db_path = current_app.config.get('DATABASE_FILE')
         conn = None
@@ -77,42 +74,26 @@ def _background_reindex_all_content(app_context, user_id: str):
                 reindex_status['total_items'] = total_items
                 reindex_status['processed_items'] = 0
 
-            # --- Processo Video ---
-            for item_id in videos_to_index:
-                with reindex_status_lock:
-                    processed_count += 1
-                    reindex_status['processed_items'] = processed_count
-                    reindex_status['message'] = f"Re-indicizzazione video ({processed_count}/{total_items})..."
-                _reindex_video_from_db(item_id, conn, user_id)
+            # Ogni tipo di contenuto passa per la pipeline comune: embedding e scritture su Chroma a gruppi
+            for source_type, item_ids, label in (
+                (SOURCE_VIDEO, videos_to_index, 'video'),
+                (SOURCE_DOCUMENT, docs_to_index, 'documenti'),
+                (SOURCE_ARTICLE, articles_to_index, 'articoli'),
+                (SOURCE_PAGE, pages_to_index, 'pagine'),
+            ):
+                if not item_ids:
+                    continue
+                processed_before = processed_count
+
+                def _report_progress(done, _total, label=label, processed_before=processed_before):
+                    with reindex_status_lock:
+                        reindex_status['processed_items'] = processed_before + done
+                        reindex_status['message'] = f"Re-indicizzazione {label} ({processed_before + done}/{total_items})..."
+
+                index_items(source_type, item_ids, conn, user_id, core_config_dict, progress_callback=_report_progress)
                 conn.commit()
+                processed_count += len(item_ids)
 
-            # --- Processo Documenti ---
-            for item_id in docs_to_index:
-                with reindex_status_lock:
-                    processed_count += 1
-                    reindex_status['processed_items'] = processed_count
-                    reindex_status['message'] = f"Re-indicizzazione documenti ({processed_count}/{total_items})..."
-                _index_document(item_id, conn, user_id)
-                conn.commit()
-
-            # --- Processo Articoli ---
-            for item_id in articles_to_index:
-                with reindex_status_lock:
-                    processed_count += 1
-                    reindex_status['processed_items'] = processed_count
-                    reindex_status['message'] = f"Re-indicizzazione articoli ({processed_count}/{total_items})..."
-                _index_article(item_id, conn, user_id, core_config_dict)
-                conn.commit()
-
-            # --- Processo Pagine ---
-            for item_id in pages_to_index:
-                with reindex_status_lock:
-                    processed_count += 1
-                    reindex_status['processed_items'] = processed_count
-                    reindex_status['message'] = f"Re-indicizzazione pagine ({processed_count}/{total_items})..."
-                _index_page(item_id, conn, user_id, core_config_dict)
-                conn.commit()
-            
             with reindex_status_lock:
                 reindex_status['message'] = "Re-indicizzazione completata con successo!"
         
@@ -200,6 +181,8 @@ def restore_database_backup():
         # Sostituisci il database corrente con il backup
         shutil.move(temp_filename, db_path)
         logger.info(f"Database SQLite ripristinato con successo da backup per l'utente {current_user.id}")
+        # Un backup più vecchio può non avere le tabelle/colonne aggiunte dopo: stesse migrazioni dell'avvio
+        init_db(current_app.config)
 
         # Elimina la vecchia cartella ChromaDB
         if chroma_path and os.path.exists(chroma_path):
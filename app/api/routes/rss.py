@@ -11,27 +11,18 @@ import os
 import datetime
 from urllib.parse import urlparse, urljoin
 from flask import Blueprint, request, jsonify, current_app, Response
-from google.api_core import exceptions as google_exceptions
 import threading
-import textstat
+import time
 import copy
+from concurrent.futures import ThreadPoolExecutor
 import logging 
 import io
-from app.services.chunking.agentic_chunker import chunk_text_agentically
-from app.services.embedding.embedding_service import generate_embeddings
-from app.utils import build_full_config_for_background_process, normalize_url
+from app.services.embedding.model_migration import get_active_collection_name
+from app.core.indexing_pipeline import index_items, SOURCE_ARTICLE
+from app.utils import build_full_config_for_background_process, normalize_url, compute_content_hash
 
 logger = logging.getLogger(__name__)
 
-try:
-    from app.services.embedding.gemini_embedding import split_text_into_chunks, get_gemini_embeddings, TASK_TYPE_DOCUMENT
-except ImportError:
-    # ... (gestione errore import) ...
-    logger.error("!!! Impossibile importare funzioni di embedding/chunking (rss.py) !!!")
-    split_text_into_chunks = None
-    get_gemini_embeddings = None
-    TASK_TYPE_DOCUMENT = "retrieval_document"
-
 rss_bp = Blueprint('rss', __name__)
 
 # --- STATO GLOBALE e LOCK per Processo RSS ---
@@ -113,114 +104,120 @@ def parse_feed_date(feed_date_struct):
 
 def _index_article(article_id: str, conn: sqlite3.Connection, user_id: str, core_config: dict) -> str:
     """
-    Esegue l'indicizzazione di un articolo. Richiede sempre un user_id.
+    Indicizza un singolo articolo tramite la pipeline comune. NON fa commit.
+    Restituisce lo stato finale ('completed' o 'failed_...').
     """
-    logger.info(f"[_index_article][{article_id}] Avvio indicizzazione per UserID: {user_id}")
+    return index_items(SOURCE_ARTICLE, [article_id], conn, user_id, core_config)[article_id]
 
-    final_status = 'failed_indexing_init'
-    cursor = conn.cursor()
 
-    llm_api_key = core_config.get('GOOGLE_API_KEY')
-    embedding_model = core_config.get('GEMINI_EMBEDDING_MODEL')
-    chunk_size = core_config.get('DEFAULT_CHUNK_SIZE_WORDS', 300)
-    chunk_overlap = core_config.get('DEFAULT_CHUNK_OVERLAP_WORDS', 50)
-    base_article_collection_name = core_config.get('ARTICLE_COLLECTION_NAME', 'article_content')
-    
-    chroma_client = core_config.get('CHROMA_CLIENT')
-    if not chroma_client: 
-        return 'failed_config_client_missing'
-    if not user_id:
-        return 'failed_user_id_missing'
-        
-    user_article_collection_name = f"{base_article_collection_name}_{user_id}"
-    try:
-        article_collection = chroma_client.get_or_create_collection(name=user_article_collection_name)
-    except Exception as e_coll: 
-        logger.error(f"[_index_article][{article_id}] Errore get/create collezione '{user_article_collection_name}': {e_coll}")
-        return 'failed_chroma_collection'
-    
-    logger.info(f"[_index_article][{article_id}] Collezione Chroma '{user_article_collection_name}' pronta.")
+# Segni di un estratto troncato in fondo al testo del feed
+_TRUNCATION_MARKERS = ('[…]', '[...]', '…', 'continua a leggere', 'leggi tutto', 'read more', 'continue reading')
 
-    try:
-        cursor.execute("SELECT content, title, article_url FROM articles WHERE article_id = ?", (article_id,))
-        article_data = cursor.fetchone()
-        if not article_data: 
-            logger.error(f"[_index_article][{article_id}] Record non trovato nel DB.")
-            return 'failed_article_not_found'
-        
-        article_content, title, article_url = article_data[0], article_data[1], article_data[2]
-        
-        if not article_content or not article_content.strip():
-             final_status = 'completed'
-        else:
-            use_agentic_chunking = str(core_config.get('USE_AGENTIC_CHUNKING', 'False')).lower() == 'true'
-            chunks = []
-            if use_agentic_chunking:
-                try:
-                    chunks = chunk_text_agentically(article_content, llm_provider=core_config.get('llm_provider', 'google'), settings=core_config)
-                except google_exceptions.ResourceExhausted as e:
-                    chunks = []
-                if not chunks:
-                    chunks = split_text_into_chunks(article_content, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-            else:
-                chunks = split_text_into_chunks(article_content, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-            
-            if not chunks:
-                 final_status = 'completed'
-            else:
-                embeddings = generate_embeddings(chunks, user_settings=core_config, task_type=TASK_TYPE_DOCUMENT)
-                if not embeddings or len(embeddings) != len(chunks):
-                    final_status = 'failed_embedding'
-                else:
-                    ids = [f"{article_id}_chunk_{i}" for i in range(len(chunks))]
-                    metadatas_chroma = [{
-                        "article_id": article_id, "article_title": title, "article_url": article_url,
-                        "chunk_index": i, "source_type": "article",
-                        "user_id": user_id
-                    } for i in range(len(chunks))]
-                    article_collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas_chroma, documents=chunks)
-                    final_status = 'completed'
-    except Exception as e:
-        logger.error(f"[_index_article][{article_id}] Errore imprevisto durante indicizzazione: {e}", exc_info=True)
-        # Ripristiniamo la logica per dare un codice di errore più specifico
-        if 'split_text_into_chunks' in str(e): final_status = 'failed_chunking'
-        elif 'upsert' in str(e): final_status = 'failed_chroma_write'
-        else: final_status = 'failed_processing_generic'
-    
-    if final_status == 'completed':
-        try:
-            stats = { 'word_count': 0, 'gunning_fog': 0 }
-            if 'article_content' in locals() and article_content and article_content.strip():
-                stats['word_count'] = len(article_content.split())
-                stats['gunning_fog'] = textstat.gunning_fog(article_content)
-            cursor.execute("""
-                INSERT INTO content_stats (content_id, user_id, source_type, word_count, gunning_fog)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(content_id) DO UPDATE SET
-                    word_count = excluded.word_count,
-                    gunning_fog = excluded.gunning_fog,
-                    last_calculated = CURRENT_TIMESTAMP
-            """, (article_id, user_id, 'articles', stats['word_count'], stats['gunning_fog']))
-        except Exception as e_stats:
-            logger.error(f"[_index_article][{article_id}] Errore durante il calcolo/salvataggio delle statistiche: {e_stats}")
 
-    try:
-        cursor.execute("UPDATE articles SET processing_status = ? WHERE article_id = ?", (final_status, article_id))
-    except sqlite3.Error as db_update_err:
-         final_status = 'failed_db_status_update'
+def _feed_entry_text(entry) -> Optional[str]:
+    """Testo dell'articolo presente nel feed: content:encoded se c'è, altrimenti il riassunto."""
+    html_text = None
+    if 'content' in entry and entry.get('content'):
+        html_text = entry.content[0].value
+    elif 'summary' in entry and entry.get('summary'):
+        html_text = entry.summary
+    if not html_text:
+        return None
+    soup = BeautifulSoup(html_text, 'html.parser')
+    return '\n'.join(line.strip() for line in soup.get_text(separator='\n', strip=True).splitlines() if line.strip())
+
+
+def _feed_content_is_complete(entry, text: Optional[str], min_words: int) -> bool:
+    """
+    Il feed contiene già l'articolo intero? Serve content:encoded (non il solo riassunto),
+    lungo almeno min_words parole e senza i segni di un estratto troncato. min_words = 0: scarica sempre.
+    """
+    if min_words <= 0 or not text or not entry.get('content'):
+        return False
+    if len(text.split()) < min_words:
+        return False
+    tail = text[-80:].lower()
+    return not any(marker in tail for marker in _TRUNCATION_MARKERS)
+
+
+class _HostThrottle:
+    """
+    Cortesia verso i siti durante lo scraping: al massimo `concurrency` richieste insieme per host
+    e almeno `delay` secondi tra l'inizio di una richiesta e la successiva allo stesso host.
+    """
+
+    def __init__(self, concurrency: int, delay: float):
+        self.concurrency = max(1, concurrency)
+        self.delay = max(0.0, delay)
+        self._lock = threading.Lock()
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._next_slot: Dict[str, float] = {}
+
+    def fetch(self, article_url: str) -> Optional[str]:
+        host = urlparse(article_url).netloc.lower()
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.BoundedSemaphore(self.concurrency))
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                slot = max(now, self._next_slot.get(host, 0.0))
+                self._next_slot[host] = slot + self.delay
+            if slot > now:
+                time.sleep(slot - now)
+            return get_full_article_content(article_url)
+
+
+def _find_existing_articles(cursor: sqlite3.Cursor, user_id: str, normalized_urls: set) -> Dict[str, dict]:
+    """Articoli già salvati tra gli URL di una pagina del feed: una ricerca sull'indice (user_id, normalized_url)."""
+    if not normalized_urls:
+        return {}
+    placeholders = ','.join('?' * len(normalized_urls))
+    cursor.execute(
+        f"SELECT article_id, normalized_url, processing_status FROM articles WHERE user_id = ? AND normalized_url IN ({placeholders})",
+        (user_id, *normalized_urls)
+    )
+    return {row['normalized_url']: {'article_id': row['article_id'], 'processing_status': row['processing_status']} for row in cursor.fetchall()}
+
+
+def _load_feed_validators(cursor: sqlite3.Cursor, user_id: str, feed_url: str) -> Dict[str, Optional[str]]:
+    """
+    ETag e Last-Modified salvati dall'ultimo controllo del feed monitorato.
+    Se ci sono articoli del feed da riprovare (pending/failed) la richiesta non è condizionale:
+    un 304 chiuderebbe il run prima di arrivare a quegli articoli.
+    """
+    cursor.execute(
+        "SELECT 1 FROM articles WHERE user_id = ? AND feed_url = ? AND (processing_status = 'pending' OR processing_status LIKE 'failed_%') LIMIT 1",
+        (user_id, feed_url)
+    )
+    if cursor.fetchone():
+        return {}
+    cursor.execute("SELECT etag, last_modified FROM monitored_rss_feeds WHERE user_id = ? AND feed_url = ?", (user_id, feed_url))
+    row = cursor.fetchone()
+    return {'etag': row['etag'], 'last_modified': row['last_modified']} if row else {}
 
-    return final_status
 
 def _process_rss_feed_core(
     initial_feed_url: str, 
     user_id: str, 
     core_config: dict, 
     status_dict: Optional[dict] = None,
-    status_lock: Optional[threading.Lock] = None
+    status_lock: Optional[threading.Lock] = None,
+    use_conditional_get: bool = False,
+    full_backfill: bool = False
 ) -> bool:
+    """
+    Importa gli articoli di un feed, pagina per pagina. Con use_conditional_get (lo scheduler)
+    la prima pagina viene chiesta con ETag/Last-Modified dell'ultimo controllo: se il feed
+    non è cambiato il server risponde 304 e il run finisce lì.
+    La paginazione si ferma dopo RSS_STOP_AFTER_KNOWN_PAGES pagine consecutive fatte solo di
+    articoli già completati (l'archivio più vecchio è già importato); full_backfill la percorre tutta.
+    Le scritture sono confermate pagina per pagina in transazioni brevi (nuovi articoli, poi i loro stati):
+    scaricamento ed embedding avvengono senza tenere il lock di scrittura del DB.
+    """
     logger.info(f"[CORE RSS Process] Avvio per feed={initial_feed_url}, user_id={user_id}")
     overall_success = False
     conn_sqlite = None
+    scrape_pool = None
 
     pages_processed, total_entries, skipped_count, saved_ok_count, failed_count = 0, 0, 0, 0, 0
 
@@ -230,11 +227,16 @@ def _process_rss_feed_core(
         conn_sqlite.row_factory = sqlite3.Row
         cursor_sqlite = conn_sqlite.cursor()
 
-        articles_map = {}
-        cursor_sqlite.execute("SELECT article_id, article_url, processing_status FROM articles WHERE user_id = ?", (user_id,))
-        for r in cursor_sqlite.fetchall():
-            norm_db_url = normalize_url(r['article_url']) if r['article_url'] else r['article_url']
-            articles_map[norm_db_url] = {'article_id': r['article_id'], 'processing_status': r['processing_status']}
+        validators = _load_feed_validators(cursor_sqlite, user_id, initial_feed_url) if use_conditional_get else {}
+        min_feed_words = int(core_config.get('RSS_FEED_CONTENT_MIN_WORDS', 150) or 0)
+        stop_after_known_pages = 0 if full_backfill else int(core_config.get('RSS_STOP_AFTER_KNOWN_PAGES', 1) or 0)
+        known_pages_in_a_row = 0
+        host_throttle = _HostThrottle(
+            int(core_config.get('RSS_SCRAPE_PER_HOST_CONCURRENCY', 2) or 1),
+            int(core_config.get('RSS_SCRAPE_PER_HOST_DELAY_MS', 500) or 0) / 1000
+        )
+        scrape_pool = ThreadPoolExecutor(max_workers=max(1, int(core_config.get('RSS_SCRAPE_WORKERS', 8) or 1)))
+        new_validators = None
 
         parsed_initial_url = urlparse(initial_feed_url)
         base_feed_url = urljoin(initial_feed_url, parsed_initial_url.path)
@@ -247,7 +249,15 @@ def _process_rss_feed_core(
                 with status_lock:
                     status_dict['message'] = f"Analisi pagina #{page_number} del feed..."
 
-            parsed_feed = feedparser.parse(url_to_fetch, request_headers={'User-Agent': 'MagazzinoDelCreatoreBot/1.0'}, agent='MagazzinoDelCreatoreBot/1.0')
+            if page_number == 1:
+                parsed_feed = feedparser.parse(url_to_fetch, request_headers={'User-Agent': 'MagazzinoDelCreatoreBot/1.0'}, agent='MagazzinoDelCreatoreBot/1.0',
+                                               etag=validators.get('etag'), modified=validators.get('last_modified'))
+                if parsed_feed.get('status') == 304:
+                    logger.info(f"[CORE RSS Process] Feed {initial_feed_url} invariato dall'ultimo controllo (304).")
+                    break
+                new_validators = (parsed_feed.get('etag'), parsed_feed.get('modified'))
+            else:
+                parsed_feed = feedparser.parse(url_to_fetch, request_headers={'User-Agent': 'MagazzinoDelCreatoreBot/1.0'}, agent='MagazzinoDelCreatoreBot/1.0')
 
             if parsed_feed.bozo or not parsed_feed.entries:
                 break
@@ -255,6 +265,12 @@ def _process_rss_feed_core(
             pages_processed += 1
             num_entries_page = len(parsed_feed.entries)
             total_entries += num_entries_page
+            page_articles = {} # article_id -> URL normalizzato, indicizzati insieme a fine pagina
+            new_entries, new_urls_on_page = [], set()
+            existing_articles = _find_existing_articles(
+                cursor_sqlite, user_id, {normalize_url(entry.get('link')) for entry in parsed_feed.entries if entry.get('link')}
+            )
+            page_all_completed = True
 
             for entry_index, entry in enumerate(parsed_feed.entries):
                 if status_dict and status_lock:
@@ -271,50 +287,85 @@ def _process_rss_feed_core(
                     continue
 
                 norm_article_url = normalize_url(article_url)
-                existing = articles_map.get(norm_article_url)
+                existing = existing_articles.get(norm_article_url)
 
                 if existing:
                     if existing['processing_status'] == 'pending' or (existing['processing_status'] and str(existing['processing_status']).startswith('failed_')):
                         article_id_to_process = existing['article_id']
                         needs_processing = True
+                        page_all_completed = False
                     else:
                         skipped_count += 1
                         continue
                 else:
-                    content = None
-                    if 'content' in entry and entry.get('content'):
-                        soup_content = BeautifulSoup(entry.content[0].value, 'html.parser')
-                        content = '\n'.join(line.strip() for line in soup_content.get_text(separator='\n', strip=True).splitlines() if line.strip())
-                    elif 'summary' in entry and entry.get('summary'):
-                        soup_summary = BeautifulSoup(entry.summary, 'html.parser')
-                        content = '\n'.join(line.strip() for line in soup_summary.get_text(separator='\n', strip=True).splitlines() if line.strip())
-                    
-                    full_content = get_full_article_content(article_url)
-                    content = full_content if full_content else content
-
-                    if not content:
+                    page_all_completed = False
+                    if norm_article_url in new_urls_on_page:
                         skipped_count += 1
                         continue
+                    new_urls_on_page.add(norm_article_url)
+                    content = _feed_entry_text(entry)
+                    scrape = None
+                    if not _feed_content_is_complete(entry, content, min_feed_words):
+                        scrape = scrape_pool.submit(host_throttle.fetch, article_url)
+                    new_entries.append((entry, article_url, norm_article_url, title, content, scrape))
+                    continue
 
-                    article_id_to_process = str(uuid.uuid4())
-                    needs_processing = True
-                    guid = entry.get('id') or entry.get('guid') or article_url
-                    published_at_iso = parse_feed_date(entry.get('published_parsed') or entry.get('updated_parsed'))
+                if needs_processing and article_id_to_process:
+                    page_articles[article_id_to_process] = norm_article_url
 
-                    cursor_sqlite.execute("INSERT INTO articles (article_id, guid, feed_url, article_url, title, published_at, content, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                            (article_id_to_process, guid, initial_feed_url, article_url, title, published_at_iso, content, user_id, 'pending'))
-                    articles_map[norm_article_url] = {'article_id': article_id_to_process, 'processing_status': 'pending'}
+            # Articoli nuovi, nell'ordine del feed: le pagine scaricate in parallelo arrivano qui.
+            # Si aspettano tutti gli scaricamenti prima di scrivere, così nessuna transazione resta aperta sulla rete.
+            scraping_count = sum(1 for *_, scrape in new_entries if scrape)
+            if scraping_count and status_dict and status_lock:
+                with status_lock:
+                    status_dict['message'] = f"Scaricamento di {scraping_count} articoli (Pag. {page_number})..."
+            new_rows = []
+            for entry, article_url, norm_article_url, title, content, scrape in new_entries:
+                full_content = scrape.result() if scrape else None
+                content = full_content if full_content else content
 
-                if needs_processing and article_id_to_process:
-                    indexing_status = _index_article(article_id_to_process, conn_sqlite, user_id, core_config)
+                if not content:
+                    skipped_count += 1
+                    continue
+
+                article_id_to_process = str(uuid.uuid4())
+                guid = entry.get('id') or entry.get('guid') or article_url
+                published_at_iso = parse_feed_date(entry.get('published_parsed') or entry.get('updated_parsed'))
+
+                new_rows.append((article_id_to_process, guid, initial_feed_url, article_url, norm_article_url, title, published_at_iso, content, compute_content_hash(content), user_id, 'pending'))
+                page_articles[article_id_to_process] = norm_article_url
+
+            if new_rows:
+                # Confermati subito come 'pending': se l'indicizzazione si interrompe, il prossimo run li riprende
+                cursor_sqlite.executemany("INSERT INTO articles (article_id, guid, feed_url, article_url, normalized_url, title, published_at, content, content_hash, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", new_rows)
+                conn_sqlite.commit()
+
+            if page_articles:
+                if status_dict and status_lock:
+                    with status_lock:
+                        status_dict['message'] = f"Indicizzazione di {len(page_articles)} articoli (Pag. {page_number})..."
+                # Embedding e ChromaDB senza transazioni aperte: index_items scrive gli stati solo alla fine
+                page_statuses = index_items(SOURCE_ARTICLE, list(page_articles), conn_sqlite, user_id, core_config)
+                conn_sqlite.commit()
+                for article_id, indexing_status in page_statuses.items():
                     if indexing_status == 'completed':
                         saved_ok_count += 1
                     else:
                         failed_count += 1
-                    articles_map[norm_article_url]['processing_status'] = indexing_status
+
+            known_pages_in_a_row = known_pages_in_a_row + 1 if page_all_completed else 0
+            if stop_after_known_pages and known_pages_in_a_row >= stop_after_known_pages:
+                logger.info(f"[CORE RSS Process] {known_pages_in_a_row} pagine di fila già importate (ultima: #{page_number}): paginazione interrotta.")
+                break
 
             page_number += 1
 
+        if new_validators:
+            # Salvati solo a run concluso: se qualcosa va storto il prossimo controllo rifà tutto
+            cursor_sqlite.execute(
+                "UPDATE monitored_rss_feeds SET etag = ?, last_modified = ? WHERE user_id = ? AND feed_url = ?",
+                (*new_validators, user_id, initial_feed_url)
+            )
         conn_sqlite.commit()
         overall_success = True
 
@@ -322,13 +373,14 @@ def _process_rss_feed_core(
         if conn_sqlite: conn_sqlite.rollback()
         overall_success = False
     finally:
+        if scrape_pool: scrape_pool.shutdown(wait=False, cancel_futures=True)
         if conn_sqlite: conn_sqlite.close()
 
     return overall_success
 
 
 # --- Funzione Background per RSS ---
-def _background_rss_processing(app_context, initial_feed_url: str, user_id: Optional[str], initial_status: dict):
+def _background_rss_processing(app_context, initial_feed_url: str, user_id: Optional[str], initial_status: dict, full_backfill: bool = False):
     global rss_processing_status, rss_status_lock
     thread_final_message = "Elaborazione background RSS terminata con stato sconosciuto."
     job_success = False
@@ -357,7 +409,8 @@ def _background_rss_processing(app_context, initial_feed_url: str, user_id: Opti
                 user_id, 
                 core_config_dict,
                 status_dict=rss_processing_status, # Aggiungiamo questo
-                status_lock=rss_status_lock        # Aggiungiamo questo
+                status_lock=rss_status_lock,       # Aggiungiamo questo
+                full_backfill=full_backfill
             )
 
             if job_success:
@@ -398,6 +451,8 @@ def process_rss_feed():
         })
 
     initial_feed_url = request.json.get('rss_url')
+    # Reimporta tutto l'archivio del feed invece di fermarsi alle pagine già importate
+    full_backfill = bool(request.json.get('full_backfill'))
     if not initial_feed_url or not is_valid_url(initial_feed_url):
         with rss_status_lock: rss_processing_status['is_processing'] = False
         return jsonify({'success': False, 'error_code': 'VALIDATION_ERROR', 'message': "URL non valido."}), 400
@@ -406,7 +461,7 @@ def process_rss_feed():
         app_context = current_app.app_context()
         background_thread = threading.Thread(
             target=_background_rss_processing,
-            args=(app_context, initial_feed_url, current_user_id, copy.deepcopy(rss_processing_status))
+            args=(app_context, initial_feed_url, current_user_id, copy.deepcopy(rss_processing_status), full_backfill)
         )
         background_thread.daemon = True
         background_thread.start()
@@ -478,7 +533,7 @@ def delete_all_user_articles():
     base_article_collection_name = current_app.config.get('ARTICLE_COLLECTION_NAME', 'article_content')
     chroma_client = current_app.config.get('CHROMA_CLIENT')
 
-    user_article_collection_name = f"{base_article_collection_name}_{current_user_id}"
+    user_article_collection_name = get_active_collection_name(base_article_collection_name, current_user_id, current_app.config)
     conn_sqlite = None
     try:
         conn_sqlite = sqlite3.connect(db_path)
@@ -543,7 +598,7 @@ def debug_rss_summary():
     try:
         chroma_client = current_app.config.get('CHROMA_CLIENT')
         base_name = current_app.config.get('ARTICLE_COLLECTION_NAME', 'article_content')
-        collection_name = f"{base_name}_{current_user_id}"
+        collection_name = get_active_collection_name(base_name, current_user_id, current_app.config)
         result['chroma']['collection_name'] = collection_name
 
         if not chroma_client:
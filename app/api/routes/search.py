@@ -12,7 +12,13 @@ import jwt
 import cohere
 import requests
 from groq import Groq
-from app.services.embedding.embedding_service import generate_embeddings
+from app.services.embedding.embedding_service import generate_embeddings, align_query_embedding
+from app.services.embedding.model_migration import apply_embedding_profile, get_active_collection_name
+from app.core.effective_settings import get_effective_settings
+from app.services.rate_limiter.token_bucket import (
+    acquire, RateLimitTimeout, LANE_INTERACTIVE,
+    BUCKET_GEMINI, BUCKET_OLLAMA, BUCKET_GROQ, BUCKET_COHERE
+)
 
   
 
@@ -92,12 +98,13 @@ def require_api_key(f):
         return jsonify({"success": False, "error_code": "UNAUTHORIZED", "message": "Autenticazione richiesta."}), 401
     return decorated_function
 
-def _get_ollama_completion(prompt: str, base_url: str, model_name: str) -> str:
+def _get_ollama_completion(prompt: str, base_url: str, model_name: str, lane: str = LANE_INTERACTIVE) -> str:
     if not base_url.endswith('/'):
         base_url += '/'
     api_url = f"{base_url}api/generate"
     payload = {"model": model_name, "prompt": prompt, "stream": False}
     logger.info(f"Invio richiesta a Ollama: URL={api_url}, Modello={model_name}")
+    acquire(BUCKET_OLLAMA, lane=lane)
     try:
         response = requests.post(api_url, json=payload, timeout=120)
         response.raise_for_status()
@@ -119,6 +126,7 @@ def _get_ollama_embedding(text: str, base_url: str, model_name: str) -> Optional
     api_url = f"{base_url}api/embeddings"
     payload = {"model": model_name, "prompt": text}
     logger.info(f"Invio richiesta di embedding a Ollama: URL={api_url}, Modello={model_name}")
+    acquire(BUCKET_OLLAMA, lane=LANE_INTERACTIVE)
     try:
         response = requests.post(api_url, json=payload, timeout=60)
         response.raise_for_status()
@@ -301,28 +309,13 @@ def handle_search_request(*args, **kwargs):
             models_to_try = current_app.config.get('RAG_MODELS_LIST', [])
             ollama_base_url = None
 
-            if user_id_to_use:
-                db_path = current_app.config.get('DATABASE_FILE')
-                conn_settings = None
-                try:
-                    conn_settings = sqlite3.connect(db_path)
-                    conn_settings.row_factory = sqlite3.Row
-                    cursor_settings = conn_settings.cursor()
-                    cursor_settings.execute("SELECT * FROM user_settings WHERE user_id = ?", (user_id_to_use,))
-                    user_settings = cursor_settings.fetchone()
-                    
-                    if user_settings:
-                        logger.info(f"Trovate impostazioni personalizzate per l'utente {user_id_to_use}.")
-                        llm_provider = user_settings['llm_provider'] or 'google'
-                        ollama_base_url = user_settings['ollama_base_url']
-                        if user_settings['llm_api_key']: llm_api_key = user_settings['llm_api_key']
-                        if user_settings['llm_embedding_model']: embedding_model = user_settings['llm_embedding_model']
-                        if user_settings['llm_model_name']:
-                            models_to_try = [m.strip() for m in user_settings['llm_model_name'].split(',') if m.strip()]
-                except sqlite3.Error as e:
-                    logger.error(f"Errore DB nel recuperare le impostazioni per l'utente {user_id_to_use}: {e}")
-                finally:
-                    if conn_settings: conn_settings.close()
+            effective_settings = get_effective_settings(user_id_to_use) if user_id_to_use else None
+            if effective_settings:
+                llm_provider = effective_settings.llm_provider or 'google'
+                ollama_base_url = effective_settings.ollama_base_url
+                if effective_settings.llm_api_key: llm_api_key = effective_settings.llm_api_key
+                if effective_settings.llm_embedding_model: embedding_model = effective_settings.llm_embedding_model
+                if effective_settings.rag_models: models_to_try = list(effective_settings.rag_models)
             
             # --- FASE 1: EMBEDDING (con misurazione) ---
             start_embedding_time = time.time()
@@ -332,15 +325,36 @@ def handle_search_request(*args, **kwargs):
                 'llm_provider': llm_provider,
                 'llm_embedding_model': embedding_model,
                 'ollama_base_url': ollama_base_url,
-                'llm_api_key': llm_api_key
+                'llm_api_key': llm_api_key,
+                # La query usa sempre la dimensione piena: align_query_embedding la adatta
+                # alla dimensione registrata da ciascuna collezione (anche se indicizzate in tempi diversi).
+                'EMBEDDING_OUTPUT_DIMENSIONALITY': 0
             }
+
+            # Se l'utente sta migrando a un nuovo modello di embedding, la ricerca resta sul modello
+            # e sulle collezioni attive finché le collezioni ombra non sono complete.
+            embedding_state = effective_settings.embedding_state if effective_settings else None
+            if embedding_state:
+                user_settings_for_embedding = apply_embedding_profile(user_settings_for_embedding, embedding_state['active_profile'], embedding_state['active_suffix'])
+                user_settings_for_embedding['EMBEDDING_OUTPUT_DIMENSIONALITY'] = 0
+            else:
+                user_settings_for_embedding['EMBEDDING_COLLECTION_SUFFIX'] = ''
             
             # Chiamiamo il nostro nuovo servizio centralizzato
-            query_embedding_list = generate_embeddings(
-                texts=[query_text_internal], 
-                user_settings=user_settings_for_embedding, 
-                task_type=TASK_TYPE_QUERY
-            )
+            try:
+                query_embedding_list = generate_embeddings(
+                    texts=[query_text_internal], 
+                    user_settings=user_settings_for_embedding, 
+                    task_type=TASK_TYPE_QUERY
+                )
+            except RateLimitTimeout as e_rl:
+                logger.warning(f"Embedding query non eseguito: {e_rl}")
+                final_payload.update({
+                    'success': False,
+                    'error_code': 'API_RATE_LIMIT_EXCEEDED',
+                    'message': 'Troppe richieste in corso verso il provider AI. Riprova tra qualche istante.'
+                })
+                return final_payload, 429
 
             performance_metrics['embedding_duration_ms'] = round((time.time() - start_embedding_time) * 1000)
             
@@ -359,13 +373,16 @@ def handle_search_request(*args, **kwargs):
                     logger.warning(f"Impossibile eseguire la ricerca per {coll_type}: User ID mancante.")
                     continue
 
-                coll_name = f"{base_name}_{user_id_to_use}"
+                coll_name = get_active_collection_name(base_name, user_id_to_use, user_settings_for_embedding)
                 try:
                     collection_instance = chroma_client.get_collection(name=coll_name)
+                    collection_query_embedding = align_query_embedding(query_embedding, collection_instance)
+                    if collection_query_embedding is None:
+                        continue
                     logger.info(f"Querying {coll_type} collection ('{coll_name}') con n_results={n_results}")
                     
                     results = collection_instance.query(
-                        query_embeddings=[query_embedding], 
+                        query_embeddings=[collection_query_embedding], 
                         n_results=n_results,
                         include=['documents', 'metadatas', 'distances']
                     )
@@ -393,6 +410,7 @@ def handle_search_request(*args, **kwargs):
                     start_reranking_time = time.time() 
                     try:
                         logger.info("Avvio re-ranking con l'API di Cohere...")
+                        acquire(BUCKET_COHERE, lane=LANE_INTERACTIVE)
                         co = cohere.Client(cohere_api_key)
                         docs_to_rerank = [chunk['text'] for chunk in all_results_combined]
                         logger.debug(f"COHERE DEBUG: Invio {len(docs_to_rerank)} documenti per il re-ranking. Query: '{query_text_internal[:100]}...'")
@@ -442,6 +460,7 @@ def handle_search_request(*args, **kwargs):
                     raise RuntimeError("API Key o nome modello di Groq non configurati.")
                 
                 try:
+                    acquire(BUCKET_GROQ, lane=LANE_INTERACTIVE)
                     client = Groq(api_key=llm_api_key)
                     model_name = models_to_try[0] # Groq usa un modello alla volta
                     chat_completion = client.chat.completions.create(
@@ -471,6 +490,7 @@ def handle_search_request(*args, **kwargs):
                 for model_name in models_to_try:
                     logger.info(f"Tentativo di generazione risposta con il modello: {model_name}")
                     try:
+                        acquire(BUCKET_GEMINI, lane=LANE_INTERACTIVE)
                         model = genai.GenerativeModel(model_name, safety_settings=current_app.config.get('RAG_SAFETY_SETTINGS', {}))
                         response_llm = model.generate_content(prompt, generation_config=genai.types.GenerationConfig(**current_app.config.get('RAG_GENERATION_CONFIG', {})))
                         try:
@@ -504,8 +524,13 @@ def handle_search_request(*args, **kwargs):
                 error_code_llm = 'LLM_GENERATION_FAILED'
                 message_llm = f'Errore LLM: {last_error}'
                 
+                # Attesa massima superata sul rate limiter locale (qualsiasi provider)
+                if isinstance(last_error, RateLimitTimeout):
+                    error_code_llm = 'API_RATE_LIMIT_EXCEEDED'
+                    message_llm = 'Troppe richieste in corso verso il provider AI. Riprova tra qualche istante.'
+
                 # Gestione Specifica Google
-                if llm_provider == 'google':
+                elif llm_provider == 'google':
                     # Cattura esplicita ResourceExhausted (Quota superata)
                     if isinstance(last_error, google_exceptions.ResourceExhausted):
                         error_code_llm = 'API_RATE_LIMIT_EXCEEDED'
@@ -3,10 +3,40 @@ import sqlite3
 from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app, jsonify
 from flask_login import login_required, current_user
 import requests
+from app.utils import build_full_config_for_background_process
+from app.core.effective_settings import bump_settings_version
+from app.services.embedding.model_migration import (
+    get_embedding_profile, request_embedding_migration, start_embedding_migration, STATUS_PENDING
+)
 
 logger = logging.getLogger(__name__)
 settings_bp = Blueprint('settings', __name__)
 
+
+def _current_embedding_profile(user_id):
+    """Modello di embedding richiesto dalle impostazioni salvate finora (prima della modifica)."""
+    try:
+        return get_embedding_profile(build_full_config_for_background_process(user_id, apply_embedding_state=False))
+    except Exception as e:
+        logger.warning(f"Impossibile determinare il modello di embedding corrente per l'utente {user_id}: {e}")
+        return None
+
+
+def _schedule_embedding_migration(user_id, previous_profile) -> bool:
+    """
+    Se le nuove impostazioni cambiano modello o dimensione degli embedding, avvia in background
+    la conversione dei contenuti esistenti. Restituisce True se è stata pianificata una nuova migrazione.
+    """
+    try:
+        status = request_embedding_migration(user_id, previous_profile)
+        if status is None:
+            return False
+        start_embedding_migration(current_app._get_current_object(), user_id)
+        return status == STATUS_PENDING
+    except Exception as e:
+        logger.error(f"Errore pianificando la migrazione embedding per l'utente {user_id}: {e}", exc_info=True)
+        return False
+
 @settings_bp.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings_page():
@@ -33,7 +63,23 @@ def settings_page():
         else: # Per Google e Groq, che usano lo stesso campo
             embedding_model_to_save = request.form.get('llm_embedding_model')
 
-        # 3. Raccolta di tutti i dati da salvare
+        # 3. Dimensione ridotta degli embedding (vuoto = dimensione piena del modello)
+        embedding_dimension = None
+        embedding_dimension_str = (request.form.get('embedding_dimension') or '').strip()
+        if embedding_dimension_str:
+            try:
+                embedding_dimension = int(embedding_dimension_str)
+                if embedding_dimension < 32:
+                    raise ValueError("Dimensione troppo piccola.")
+            except ValueError:
+                logger.warning(f"Dimensione embedding non valida ('{embedding_dimension_str}') per l'utente {user_id}. Ignorata.")
+                flash('Dimensione dei vettori non valida: uso la dimensione piena del modello.', 'warning')
+                embedding_dimension = None
+
+        # Modello di embedding con cui sono stati indicizzati i contenuti finora
+        previous_embedding_profile = _current_embedding_profile(user_id)
+
+        # 4. Raccolta di tutti i dati da salvare
         settings_to_save = {
             'llm_provider': provider,
             'llm_model_name': combined_models,
@@ -42,17 +88,19 @@ def settings_page():
             'ollama_base_url': request.form.get('ollama_base_url'),
             'wordpress_url': request.form.get('wordpress_url'),
             'wordpress_username': request.form.get('wordpress_username'),
-            'wordpress_api_key': request.form.get('wordpress_api_key')
+            'wordpress_api_key': request.form.get('wordpress_api_key'),
+            'embedding_dimension': embedding_dimension
         }
         
         conn = None
+        settings_saved = False
         try:
             conn = sqlite3.connect(db_path)
             cursor = conn.cursor()
             # La query SQL rimane identica, perché i dati sono già stati preparati correttamente
             cursor.execute("""
-                INSERT INTO user_settings (user_id, llm_provider, llm_model_name, llm_embedding_model, llm_api_key, ollama_base_url, wordpress_url, wordpress_username, wordpress_api_key)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT INTO user_settings (user_id, llm_provider, llm_model_name, llm_embedding_model, llm_api_key, ollama_base_url, wordpress_url, wordpress_username, wordpress_api_key, embedding_dimension)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ON CONFLICT(user_id) DO UPDATE SET
                     llm_provider = excluded.llm_provider,
                     llm_model_name = excluded.llm_model_name,
@@ -61,7 +109,8 @@ def settings_page():
                     ollama_base_url = excluded.ollama_base_url,
                     wordpress_url = excluded.wordpress_url,
                     wordpress_username = excluded.wordpress_username,
-                    wordpress_api_key = excluded.wordpress_api_key;
+                    wordpress_api_key = excluded.wordpress_api_key,
+                    embedding_dimension = excluded.embedding_dimension;
             """, (user_id, 
                   settings_to_save['llm_provider'], 
                   settings_to_save['llm_model_name'], 
@@ -70,15 +119,21 @@ def settings_page():
                   settings_to_save['ollama_base_url'],
                   settings_to_save['wordpress_url'],
                   settings_to_save['wordpress_username'],
-                  settings_to_save['wordpress_api_key']))
+                  settings_to_save['wordpress_api_key'],
+                  settings_to_save['embedding_dimension']))
             conn.commit()
+            bump_settings_version(user_id, db_path)
             flash('Impostazioni salvate con successo!', 'success')
+            settings_saved = True
         except sqlite3.Error as e:
             logger.error(f"Errore DB salvando le impostazioni per l'utente {user_id}: {e}")
             flash('Errore durante il salvataggio delle impostazioni.', 'error')
         finally:
             if conn:
                 conn.close()
+
+        if settings_saved and _schedule_embedding_migration(user_id, previous_embedding_profile):
+            flash('Modello di embedding cambiato: i contenuti esistenti vengono convertiti in background. La ricerca usa il modello precedente finché la conversione non è completa.', 'info')
         
         return redirect(url_for('settings.settings_page'))
 
@@ -178,6 +233,7 @@ def reset_ai_settings():
     user_id = current_user.id
     db_path = current_app.config.get('DATABASE_FILE')
     logger.info(f"Richiesta di ripristino impostazioni AI per l'utente: {user_id}")
+    previous_embedding_profile = _current_embedding_profile(user_id)
     
     conn = None
     try:
@@ -193,13 +249,18 @@ def reset_ai_settings():
                 llm_model_name = NULL,
                 llm_embedding_model = NULL,
                 llm_api_key = NULL,
-                ollama_base_url = NULL
+                ollama_base_url = NULL,
+                embedding_dimension = NULL
             WHERE user_id = ?
         """, (user_id,))
 
         conn.commit()
-        
-        return jsonify({'success': True, 'message': 'Impostazioni AI ripristinate ai valori predefiniti.'})
+        bump_settings_version(user_id, db_path)
+
+        message = 'Impostazioni AI ripristinate ai valori predefiniti.'
+        if _schedule_embedding_migration(user_id, previous_embedding_profile):
+            message += ' I contenuti esistenti vengono convertiti al modello di embedding predefinito in background.'
+        return jsonify({'success': True, 'message': message})
 
     except sqlite3.Error as e:
         if conn: conn.rollback()
@@ -6,13 +6,13 @@ from datetime import datetime
 from flask import Blueprint, jsonify, request, current_app, Response
 from flask_login import login_required, current_user
 from typing import Optional
-from google.api_core import exceptions as google_exceptions
 
 import threading
 import textstat
 import copy
-from app.services.embedding.embedding_service import generate_embeddings
-from app.core.youtube_processor import _background_channel_processing
+from app.services.embedding.embedding_service import generate_embeddings, ensure_collection_dimension
+from app.services.embedding.model_migration import get_active_collection_name
+from app.core.youtube_processor import _background_channel_processing, status_lock
 from app.utils import build_full_config_for_background_process 
 from app.services.chunking.agentic_chunker import chunk_text_agentically 
 from app.main import load_credentials
@@ -22,7 +22,8 @@ from app.main import load_credentials
 from app.services.youtube.client import YouTubeClient
 from app.services.transcripts.youtube_transcript import TranscriptService
 # Assicurati che l'import del modulo embedding sia corretto
-from app.services.embedding.gemini_embedding import split_text_into_chunks, get_gemini_embeddings, TASK_TYPE_DOCUMENT
+from app.services.embedding.gemini_embedding import split_text_into_chunks, add_chunk_offsets, get_gemini_embeddings, TASK_TYPE_DOCUMENT
+from app.core.indexing_pipeline import index_items, SOURCE_VIDEO
 
 # --- Setup Logger e Blueprint ---
 logger = logging.getLogger(__name__)
@@ -44,8 +45,6 @@ def process_channel():
     e restituisce subito una risposta.
     """
     global processing_status
-    # Usa un lock anche qui per sicurezza nell'accesso iniziale allo stato
-    status_lock = threading.Lock()
 
     logger.info("Richiesta ricevuta per processare canale (avvio thread).")
     current_user_id = current_user.id
@@ -75,9 +74,19 @@ def process_channel():
             'is_processing': True,
             'current_video': None,
             'total_videos': 0, # Verrà aggiornato dal thread
-            'message': 'Avvio elaborazione in background...'
+            'message': 'Avvio elaborazione in background...',
+            'error': None, 'error_code': None # Azzera l'esito dell'elaborazione precedente
         }
 
+        # Controllo e impostazione dello stato sono atomici, e avvengono *prima* di avviare il thread:
+        # se lo stato venisse scritto dopo, un thread che termina subito (es. quota esaurita)
+        # verrebbe sovrascritto e la UI resterebbe su "in elaborazione".
+        with status_lock:
+            if processing_status.get('is_processing', False):
+                logger.warning("Tentativo di avviare elaborazione canale mentre un'altra è già in corso.")
+                return jsonify({'success': False, 'error_code': 'ALREADY_PROCESSING', 'message': 'Un processo di elaborazione canale è già attivo. Attendi il completamento.'}), 409 # Conflict
+            processing_status.update(initial_status_for_thread)
+
         # Ottieni il contesto dell'app corrente per passarlo al thread
         # È NECESSARIO per accedere a current_app.config dal thread
         app_context = current_app.app_context()
@@ -91,11 +100,6 @@ def process_channel():
         background_thread.start()
         logger.info(f"Thread in background avviato per processare canale: {channel_url}")
 
-        # Aggiorna lo stato globale *dopo* aver avviato il thread con successo
-        # (il thread lo sovrascriverà comunque, ma impostiamolo anche qui)
-        with status_lock:
-            processing_status.update(initial_status_for_thread)
-
         # --- RESTITUISCI RISPOSTA IMMEDIATA ---
         return jsonify({
             'success': True,
@@ -232,7 +236,7 @@ def reprocess_single_video(video_id):
                         logger.error(f"[{video_id}] Fallimento generazione/corrispondenza embedding.")
                     else:
                         logger.info(f"[{video_id}] Embedding OK. Preparazione per ChromaDB...")
-                        collection_name = f"{base_video_collection_name}_{current_user_id}"
+                        collection_name = get_active_collection_name(base_video_collection_name, current_user_id, core_config)
                         video_collection = chroma_client.get_or_create_collection(name=collection_name)
                         logger.info(f"[{video_id}] Uso collezione Chroma: '{collection_name}'")
                         
@@ -241,6 +245,8 @@ def reprocess_single_video(video_id):
                         
                         ids_upsert = [f"{video_id}_chunk_{i}" for i in range(len(chunks))]
                         metadatas_upsert = [{'video_id': video_id, 'channel_id': video_meta_dict['channel_id'], 'video_title': video_meta_dict['title'], 'published_at': str(video_meta_dict['published_at']), 'chunk_index': i, 'language': transcript_lang, 'caption_type': transcript_type, 'user_id': current_user_id} for i in range(len(chunks))]
+                        add_chunk_offsets(metadatas_upsert, transcript_text, chunks)
+                        ensure_collection_dimension(video_collection, embeddings)
                         video_collection.upsert(ids=ids_upsert, embeddings=embeddings, metadatas=metadatas_upsert, documents=chunks)
                         logger.info(f"[{video_id}] Upsert di {len(chunks)} nuovi chunk in Chroma OK.")
                         final_status = 'completed'
@@ -251,7 +257,7 @@ def reprocess_single_video(video_id):
         # Pulizia Chroma se trascrizione vuota
         if final_status == 'completed' and not chunks:
             try:
-                collection_name = f"{base_video_collection_name}_{current_user_id}"
+                collection_name = get_active_collection_name(base_video_collection_name, current_user_id, core_config)
                 video_collection = chroma_client.get_or_create_collection(name=collection_name)
                 video_collection.delete(where={"video_id": video_id})
                 logger.info(f"[{video_id}] Pulizia ChromaDB eseguita per video senza nuovi chunk.")
@@ -331,7 +337,9 @@ def reprocess_single_video(video_id):
 @videos_bp.route('/progress', methods=['GET'])
 @login_required
 def get_progress():
-    return jsonify(processing_status)
+    with status_lock:
+        snapshot = copy.deepcopy(processing_status)
+    return jsonify(snapshot)
 
 @videos_bp.route('/all', methods=['DELETE'])
 @login_required
@@ -347,7 +355,7 @@ def delete_all_user_videos():
         # ... (return errore config) ...
          return jsonify({'success': False, 'error_code': 'SERVER_CONFIG_ERROR', 'message': 'Errore configurazione server.'}), 500
 
-    user_video_collection_name = f"{base_video_collection_name}_{current_user_id}"
+    user_video_collection_name = get_active_collection_name(base_video_collection_name, current_user_id, current_app.config)
     conn_sqlite = None
     rows_affected = 0
     rows_after_delete = -1 # Valore iniziale per verifica
@@ -550,103 +558,10 @@ def download_all_transcripts():
 
 def _reindex_video_from_db(video_id: str, conn: sqlite3.Connection, user_id: Optional[str], core_config: dict) -> str:
     """
-    Re-indicizza un singolo video. Ora gestisce correttamente gli errori di rate limit
-    e il context delle variabili locali dopo un'eccezione.
+    Re-indicizza un singolo video tramite la pipeline comune, scaricando la trascrizione se manca.
+    NON fa commit. Restituisce lo stato finale.
     """
     logger.info(f"[_reindex_video_from_db][{video_id}] Avvio re-indicizzazione per utente: {user_id}")
-    
-    final_status = 'failed_reindex_init'
-    chunking_version_to_set = None
-    
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    try:
-        sql_get_video = "SELECT title, channel_id, published_at, transcript, transcript_language, captions_type FROM videos WHERE video_id = ? AND user_id = ?"
-        cursor.execute(sql_get_video, (video_id, user_id))
-        video_data = cursor.fetchone()
-
-        if not video_data:
-            logger.warning(f"[_reindex_video_from_db][{video_id}] Video non trovato nel DB.")
-            return 'failed_not_found'
-
-        video_meta_dict = dict(video_data)
-        transcript_text = video_meta_dict.get('transcript')
-        
-        transcript_lang = video_meta_dict.get('transcript_language')
-        transcript_type = video_meta_dict.get('captions_type')
-
-        if not transcript_text or not transcript_text.strip():
-            logger.info(f"[_reindex_video_from_db][{video_id}] Trascrizione non trovata nel DB. Tento il download.")
-            try:
-                token_path = core_config.get('TOKEN_PATH')
-                youtube_client = YouTubeClient(token_file=token_path)
-                transcript_result = TranscriptService.get_transcript(video_id, youtube_client=youtube_client)
-
-                if transcript_result and not transcript_result.get('error'):
-                    transcript_text = transcript_result['text']
-                    transcript_lang = transcript_result['language']
-                    transcript_type = transcript_result['type']
-                    cursor.execute("UPDATE videos SET transcript = ?, transcript_language = ?, captions_type = ? WHERE video_id = ?", (transcript_text, transcript_lang, transcript_type, video_id))
-                else:
-                    final_status = 'failed_transcript'; cursor.execute("UPDATE videos SET processing_status = ? WHERE video_id = ?", (final_status, video_id)); return final_status
-            except Exception as e_yt:
-                final_status = 'failed_transcript_api'; cursor.execute("UPDATE videos SET processing_status = ? WHERE video_id = ?", (final_status, video_id)); return final_status
-        else:
-            logger.info(f"[_reindex_video_from_db][{video_id}] Trascrizione trovata nel DB.")
-
-        use_agentic_chunking = str(core_config.get('USE_AGENTIC_CHUNKING', 'False')).lower() == 'true'
-        chunks = []
-        if transcript_text and transcript_text.strip():
-            if use_agentic_chunking:
-                chunks = chunk_text_agentically(transcript_text, llm_provider=core_config.get('llm_provider', 'google'), settings=core_config)
-            else:
-                chunks = split_text_into_chunks(transcript_text, chunk_size=core_config.get('DEFAULT_CHUNK_SIZE_WORDS', 300), chunk_overlap=core_config.get('DEFAULT_CHUNK_OVERLAP_WORDS', 50))
-        
-        chroma_client = core_config.get('CHROMA_CLIENT')
-        base_video_collection_name = core_config.get('VIDEO_COLLECTION_NAME', 'video_transcripts')
-        user_video_collection_name = f"{base_video_collection_name}_{user_id}"
-        video_collection = chroma_client.get_or_create_collection(name=user_video_collection_name)
-        video_collection.delete(where={"video_id": video_id})
-        
-        if chunks:
-            embeddings = generate_embeddings(chunks, user_settings=core_config, task_type=TASK_TYPE_DOCUMENT)
-            if embeddings and len(embeddings) == len(chunks):
-                ids_upsert = [f"{video_id}_chunk_{i}" for i in range(len(chunks))]
-                # --- INIZIO BLOCCO CORRETTO ---
-                metadatas_upsert = [{
-                    'video_id': video_id, 'video_title': video_meta_dict['title'], 'channel_id': video_meta_dict['channel_id'],
-                    'published_at': str(video_meta_dict['published_at']), 'chunk_index': i, 
-                    'language': transcript_lang,
-                    'caption_type': transcript_type,
-                    'user_id': user_id
-                } for i in range(len(chunks))]
-                # --- FINE BLOCCO CORRETTO ---
-                
-                video_collection.upsert(ids=ids_upsert, embeddings=embeddings, metadatas=metadatas_upsert, documents=chunks)
-                final_status = 'completed'
-            else:
-                final_status = 'failed_embedding'
-        else:
-            final_status = 'completed'
-        
-    except google_exceptions.ResourceExhausted as e:
-        logger.warning(f"[_reindex_video_from_db][{video_id}] Rate limit rilevato. Lo segnalo al processo principale.")
-        raise e
-
-    except Exception as e:
-        logger.error(f"[_reindex_video_from_db][{video_id}] Errore critico durante re-indicizzazione: {e}", exc_info=True)
-        final_status = 'failed_reindex_critical'
-    
-    if final_status == 'completed':
-        if use_agentic_chunking:
-            rag_models = core_config.get('RAG_MODELS_LIST', [])
-            model_name_marker = rag_models[0].strip() if rag_models and rag_models[0].strip() else "unknown_model"
-            chunking_version_to_set = f'agentic_v1_{model_name_marker}'
-        else:
-            chunking_version_to_set = 'classic_v1'
-    
-    cursor.execute("UPDATE videos SET processing_status = ?, chunking_version = ? WHERE video_id = ?", (final_status, chunking_version_to_set, video_id))
-    
+    final_status = index_items(SOURCE_VIDEO, [video_id], conn, user_id, core_config)[video_id]
     logger.info(f"[_reindex_video_from_db][{video_id}] Re-indicizzazione terminata con stato: {final_status}")
-    return final_status
\ No newline at end of file
+    return final_status
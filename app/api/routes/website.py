@@ -5,19 +5,15 @@ import copy
 from flask import Blueprint, jsonify, current_app
 from flask_login import login_required, current_user
 import os
-import textstat
-import hashlib
 import uuid
 import html
 import markdownify as md
 from bs4 import BeautifulSoup
 from typing import Optional 
-from app.services.embedding.gemini_embedding import split_text_into_chunks, get_gemini_embeddings, TASK_TYPE_DOCUMENT
-from app.utils import build_full_config_for_background_process, normalize_url
+from app.services.embedding.model_migration import get_active_collection_name
+from app.core.indexing_pipeline import index_items, SOURCE_ARTICLE, SOURCE_PAGE
+from app.utils import build_full_config_for_background_process, normalize_url, compute_content_hash
 from app.services.wordpress.client import WordPressClient
-from app.services.chunking.agentic_chunker import chunk_text_agentically
-from google.api_core import exceptions as google_exceptions
-from .rss import _index_article
 
 logger = logging.getLogger(__name__)
 connectors_bp = Blueprint('connectors', __name__)
@@ -32,100 +28,8 @@ wp_sync_lock = threading.Lock() # Un "semaforo" per evitare che più processi sc
 
 def _index_page(page_id: str, conn: sqlite3.Connection, user_id: Optional[str] = None, core_config: Optional[dict] = None) -> str:
     logger.info(f"[_index_page][{page_id}] Avvio indicizzazione per UserID: {user_id}")
+    return index_items(SOURCE_PAGE, [page_id], conn, user_id, core_config or current_app.config)[page_id]
 
-    if not user_id:
-        logger.error(f"[_index_page][{page_id}] Tentativo di indicizzare senza User ID. Operazione annullata.")
-        return 'failed_user_id_missing'
-
-    final_status = 'failed_indexing'
-    cursor = conn.cursor()
-
-    try:
-        config = core_config or current_app.config
-        llm_api_key = config.get('GOOGLE_API_KEY')
-        embedding_model = config.get('GEMINI_EMBEDDING_MODEL')
-        chunk_size = config.get('DEFAULT_CHUNK_SIZE_WORDS', 300)
-        chunk_overlap = config.get('DEFAULT_CHUNK_OVERLAP_WORDS', 50)
-        base_page_collection_name = "page_content"
-        chroma_client = config.get('CHROMA_CLIENT')
-        if not chroma_client:
-            raise RuntimeError("Client ChromaDB non trovato.")
-        
-        collection_name = f"{base_page_collection_name}_{user_id}"
-        page_collection = chroma_client.get_or_create_collection(name=collection_name)
-        
-        cursor.execute("SELECT content, title, page_url FROM pages WHERE page_id = ?", (page_id,))
-        page_data = cursor.fetchone()
-        if not page_data:
-            raise FileNotFoundError(f"Pagina con ID {page_id} non trovata nel DB.")
-        
-        page_content, title, page_url = page_data[0], page_data[1], page_data[2]
-
-        if not page_content or not page_content.strip():
-            final_status = 'completed'
-        else:
-            use_agentic_chunking = str(core_config.get('USE_AGENTIC_CHUNKING', 'False')).lower() == 'true'
-
-            chunks = [] # Inizializziamo a lista vuota
-            if use_agentic_chunking:
-                try:
-                    logger.info(f"[_index_page][{page_id}] Tentativo di CHUNKING INTELLIGENTE (Agentic)...")
-                    chunks = chunk_text_agentically(page_content, llm_provider=core_config.get('llm_provider', 'google'), settings=core_config)
-                except google_exceptions.ResourceExhausted as e:
-                    logger.warning(f"[_index_page][{page_id}] Quota API esaurita durante il chunking. Fallback al metodo classico. Errore: {e}")
-                    chunks = [] # Resetta per sicurezza
-
-                if not chunks:
-                    logger.warning(f"[_index_page][{page_id}] CHUNKING INTELLIGENTE non ha prodotto risultati. Ritorno al metodo classico.")
-                    chunks = split_text_into_chunks(page_content, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-            else:
-                logger.info(f"[_index_page][{page_id}] Esecuzione CHUNKING CLASSICO (basato su dimensione).")
-                chunks = split_text_into_chunks(page_content, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-            if not chunks:
-                final_status = 'completed'
-            else:
-                embeddings = get_gemini_embeddings(chunks, api_key=llm_api_key, model_name=embedding_model, task_type=TASK_TYPE_DOCUMENT)
-                if not embeddings or len(embeddings) != len(chunks):
-                    raise ValueError("Fallimento generazione embedding.")
-                
-                ids = [f"{page_id}_chunk_{i}" for i in range(len(chunks))]
-                metadatas = [{
-                    "page_id": page_id, "page_title": title, "page_url": page_url,
-                    "chunk_index": i, "source_type": "page",
-                    "user_id": user_id
-                } for i in range(len(chunks))]
-                
-                page_collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=chunks)
-                final_status = 'completed'
-
-    except Exception as e:
-        logger.error(f"[_index_page][{page_id}] Errore durante indicizzazione: {e}", exc_info=True)
-        final_status = 'failed_indexing'
-
-    if final_status == 'completed':
-        try:
-            stats = { 'word_count': 0, 'gunning_fog': 0 }
-            if 'page_content' in locals() and page_content and page_content.strip():
-                stats['word_count'] = len(page_content.split())
-                stats['gunning_fog'] = textstat.gunning_fog(page_content)
-            cursor.execute("""
-                INSERT INTO content_stats (content_id, user_id, source_type, word_count, gunning_fog)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(content_id) DO UPDATE SET
-                    word_count = excluded.word_count,
-                    gunning_fog = excluded.gunning_fog,
-                    last_calculated = CURRENT_TIMESTAMP
-            """, (page_id, user_id, 'pages', stats['word_count'], stats['gunning_fog']))
-            logger.info(f"[_index_page][{page_id}] Statistiche salvate/aggiornate nella cache.")
-        except Exception as e_stats:
-            logger.error(f"[_index_page][{page_id}] Errore durante il calcolo/salvataggio delle statistiche: {e_stats}")
-
-    try:
-        cursor.execute("UPDATE pages SET processing_status = ? WHERE page_id = ?", (final_status, page_id))
-    except sqlite3.Error as db_err:
-        logger.error(f"[_index_page][{page_id}] Errore DB: {db_err}")
-        return 'failed_db_update'
-    return final_status
 
 def _delete_page_permanently(page_id: str, conn: sqlite3.Connection, user_id: Optional[str] = None):
     """
@@ -143,7 +47,7 @@ def _delete_page_permanently(page_id: str, conn: sqlite3.Connection, user_id: Op
         try:
             chroma_client = current_app.config.get('CHROMA_CLIENT')
             base_page_collection_name = "page_content"
-            collection_name = f"{base_page_collection_name}_{user_id}" # Logica semplificata
+            collection_name = get_active_collection_name(base_page_collection_name, user_id, current_app.config)
             page_collection = chroma_client.get_collection(name=collection_name)
             
             chunks_to_delete = page_collection.get(where={"page_id": page_id})
@@ -185,7 +89,7 @@ def _delete_article_permanently(article_id: str, conn: sqlite3.Connection, user_
         try:
             chroma_client = current_app.config.get('CHROMA_CLIENT')
             base_article_collection_name = current_app.config.get('ARTICLE_COLLECTION_NAME', 'article_content')
-            collection_name = f"{base_article_collection_name}_{user_id}"
+            collection_name = get_active_collection_name(base_article_collection_name, user_id, current_app.config)
             
             article_collection = chroma_client.get_collection(name=collection_name)
             
@@ -213,9 +117,6 @@ def _delete_article_permanently(article_id: str, conn: sqlite3.Connection, user_
         logger.error(f"[_delete_article][{article_id}] Errore imprevisto durante l'eliminazione: {e}", exc_info=True)
         return False
 
-def _calculate_content_hash(content_text: str) -> str:
-    return hashlib.sha256(content_text.encode('utf-8')).hexdigest()
-
 def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_config: dict):
     global wp_sync_status, wp_sync_lock
     
@@ -247,12 +148,8 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
 
             # --- FASE 2: CONFRONTO E PULIZIA ---
             # Pagine (normalizziamo gli URL dal DB e da WP)
-            cursor.execute("SELECT page_id, page_url FROM pages WHERE user_id = ?", (user_id,))
-            pages_in_db = {}
-            for row in cursor.fetchall():
-                raw_url = row['page_url']
-                normalized = normalize_url(raw_url) if raw_url else raw_url
-                pages_in_db[normalized] = {'page_id': row['page_id']}
+            cursor.execute("SELECT page_id, normalized_url FROM pages WHERE user_id = ?", (user_id,))
+            pages_in_db = {row['normalized_url']: {'page_id': row['page_id']} for row in cursor.fetchall()}
             urls_from_wp_pages = { normalize_url(page.get('link')) for page in pages_from_wp if page.get('link') }
             pages_to_delete_urls = set(pages_in_db.keys()) - urls_from_wp_pages
             
@@ -271,12 +168,8 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
                 with wp_sync_lock: wp_sync_status['deleted_items'] = deleted_items_count
                 
             # Articoli (normalizziamo gli URL dal DB e da WP)
-            cursor.execute("SELECT article_id, article_url FROM articles WHERE user_id = ?", (user_id,))
-            articles_in_db = {}
-            for row in cursor.fetchall():
-                raw_url = row['article_url']
-                normalized = normalize_url(raw_url) if raw_url else raw_url
-                articles_in_db[normalized] = row['article_id']
+            cursor.execute("SELECT article_id, normalized_url FROM articles WHERE user_id = ?", (user_id,))
+            articles_in_db = {row['normalized_url']: row['article_id'] for row in cursor.fetchall()}
             urls_from_wp_posts = { normalize_url(post.get('link')) for post in posts_from_wp if post.get('link') }
             articles_to_delete_urls = set(articles_in_db.keys()) - urls_from_wp_posts
 
@@ -298,6 +191,8 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
             with wp_sync_lock: wp_sync_status['total_items'] = total_items_to_process
 
             new_items_count, updated_items_count, skipped_items_count = 0, 0, 0
+            # Contenuti nuovi o modificati, indicizzati tutti insieme a fine confronto (embedding e upsert a gruppi)
+            ids_to_index = {'post': [], 'page': []}
 
             for idx, (item_type, item_data) in enumerate(all_items):
                 processed_count = idx + 1
@@ -312,7 +207,7 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
                     with wp_sync_lock: wp_sync_status['skipped_items'] += 1
                     continue
 
-                current_hash = hashlib.sha256(content_text.encode('utf-8')).hexdigest()
+                current_hash = compute_content_hash(content_text)
                 
                 date_str = None
                 if item_type == 'post':
@@ -328,9 +223,8 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
 
                 table_name = 'articles' if item_type == 'post' else 'pages'
                 id_col = 'article_id' if item_type == 'post' else 'page_id'
-                url_col = 'article_url' if item_type == 'post' else 'page_url'
 
-                cursor.execute(f"SELECT {id_col}, content_hash FROM {table_name} WHERE {url_col} = ? AND user_id = ?", (item_url, user_id))
+                cursor.execute(f"SELECT {id_col}, content_hash FROM {table_name} WHERE normalized_url = ? AND user_id = ?", (item_url, user_id))
                 existing = cursor.fetchone()
 
                 if existing:
@@ -339,10 +233,7 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
                         item_id = existing[id_col]
                         cursor.execute(f"UPDATE {table_name} SET title = ?, published_at = ?, content = ?, content_hash = ?, processing_status = 'pending' WHERE {id_col} = ?",
                                     (title, published_at_iso, content_text, current_hash, item_id))
-                        if item_type == 'post':
-                            _index_article(item_id, conn, user_id, core_config)
-                        else:
-                            _index_page(item_id, conn, user_id, core_config)
+                        ids_to_index[item_type].append(item_id)
                         updated_items_count += 1
                     else:
                         skipped_items_count += 1
@@ -351,11 +242,11 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
                     item_id = str(uuid.uuid4())
                     try:
                         if item_type == 'post':
-                            cursor.execute("INSERT OR IGNORE INTO articles (article_id, guid, feed_url, article_url, title, published_at, content, content_hash, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')",
-                                        (item_id, item_data.get('guid', {}).get('rendered', item_url), settings['wordpress_url'], item_url, title, published_at_iso, content_text, current_hash, user_id))
+                            cursor.execute("INSERT OR IGNORE INTO articles (article_id, guid, feed_url, article_url, normalized_url, title, published_at, content, content_hash, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')",
+                                        (item_id, item_data.get('guid', {}).get('rendered', item_url), settings['wordpress_url'], item_url, item_url, title, published_at_iso, content_text, current_hash, user_id))
                             # Se l'insert è stato ignorato (rowcount == 0), recupera l'id esistente
                             if cursor.rowcount == 0:
-                                cursor.execute("SELECT article_id FROM articles WHERE article_url = ? AND user_id = ?", (item_url, user_id))
+                                cursor.execute("SELECT article_id FROM articles WHERE normalized_url = ? AND user_id = ?", (item_url, user_id))
                                 existing_row = cursor.fetchone()
                                 if existing_row:
                                     logger.info(f"Articolo '{title}' già presente dopo INSERT OR IGNORE.")
@@ -363,13 +254,13 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
                                 else:
                                     new_items_count += 1
                             else:
-                                _index_article(item_id, conn, user_id, core_config)
+                                ids_to_index[item_type].append(item_id)
                                 new_items_count += 1
                         else:
-                            cursor.execute("INSERT OR IGNORE INTO pages (page_id, page_url, title, published_at, content, content_hash, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')",
-                                        (item_id, item_url, title, published_at_iso, content_text, current_hash, user_id))
+                            cursor.execute("INSERT OR IGNORE INTO pages (page_id, page_url, normalized_url, title, published_at, content, content_hash, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending')",
+                                        (item_id, item_url, item_url, title, published_at_iso, content_text, current_hash, user_id))
                             if cursor.rowcount == 0:
-                                cursor.execute("SELECT page_id FROM pages WHERE page_url = ? AND user_id = ?", (item_url, user_id))
+                                cursor.execute("SELECT page_id FROM pages WHERE normalized_url = ? AND user_id = ?", (item_url, user_id))
                                 existing_row = cursor.fetchone()
                                 if existing_row:
                                     logger.info(f"Pagina '{title}' già presente dopo INSERT OR IGNORE.")
@@ -377,7 +268,7 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
                                 else:
                                     new_items_count += 1
                             else:
-                                _index_page(item_id, conn, user_id, core_config)
+                                ids_to_index[item_type].append(item_id)
                                 new_items_count += 1
                     except sqlite3.IntegrityError as ie:
                         logger.warning(f"IntegrityError inserimento {item_type} '{title}': {ie}")
@@ -387,6 +278,14 @@ def _background_wp_sync_core(app_context, user_id: str, settings: dict, core_con
                         skipped_items_count += 1
                 conn.commit()
 
+            for item_type, source_type, label in (('post', SOURCE_ARTICLE, 'articoli'), ('page', SOURCE_PAGE, 'pagine')):
+                item_ids = ids_to_index[item_type]
+                if not item_ids:
+                    continue
+                with wp_sync_lock: wp_sync_status['message'] = f"Indicizzazione di {len(item_ids)} {label}..."
+                index_items(source_type, item_ids, conn, user_id, core_config)
+                conn.commit()
+
             with wp_sync_lock:
                 wp_sync_status['new_items'] = new_items_count
                 wp_sync_status['updated_items'] = updated_items_count
@@ -0,0 +1,172 @@
+# FILE: app/core/effective_settings.py
+
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from flask import current_app
+
+from app.services.embedding.model_migration import get_embedding_model_state, apply_embedding_profile
+
+logger = logging.getLogger(__name__)
+
+# Cache del processo: user_id -> EffectiveSettings. Ogni worker gunicorn ha la sua;
+# restano allineate grazie al contatore di versione salvato nel DB principale.
+_cache: Dict[str, 'EffectiveSettings'] = {}
+_cache_lock = threading.Lock()
+
+
+class EffectiveSettings:
+    """
+    Impostazioni AI effettive di un utente: le sovrascritture salvate in user_settings
+    e il profilo di embedding attivo. Sola lettura; i campi vuoti valgono "usa il default dell'app".
+    """
+    __slots__ = ('user_id', 'version', 'checked_at', 'llm_provider', 'llm_model_name', 'rag_models',
+                 'llm_embedding_model', 'llm_api_key', 'ollama_base_url', 'embedding_dimension', 'embedding_state')
+
+    def __init__(self, user_id: str, version: tuple, settings_row: Optional[dict], embedding_state: Optional[dict]):
+        row = settings_row or {}
+        self.user_id: str = user_id
+        self.version: tuple = version
+        self.checked_at: float = time.monotonic()
+        self.llm_provider: Optional[str] = _clean(row.get('llm_provider'))
+        self.llm_model_name: Optional[str] = _clean(row.get('llm_model_name'))
+        self.rag_models: List[str] = [m.strip() for m in (self.llm_model_name or '').split(',') if m.strip()]
+        self.llm_embedding_model: Optional[str] = _clean(row.get('llm_embedding_model'))
+        self.llm_api_key: Optional[str] = _clean(row.get('llm_api_key'))
+        self.ollama_base_url: Optional[str] = _clean(row.get('ollama_base_url'))
+        self.embedding_dimension: Optional[int] = int(row['embedding_dimension']) if row.get('embedding_dimension') else None
+        self.embedding_state: Optional[dict] = embedding_state
+
+    def build_config(self, base_config, apply_embedding_state: bool = True) -> dict:
+        """
+        Configurazione completa per i processi: quella dell'app con sopra le impostazioni dell'utente.
+        Restituisce sempre un dizionario nuovo, che il chiamante può modificare.
+        """
+        full_config = {**base_config}
+
+        if self.llm_provider:
+            full_config['llm_provider'] = self.llm_provider
+        if self.llm_model_name:
+            full_config['llm_model_name'] = self.llm_model_name
+            # Sovrascriviamo la lista RAG con quella dell'utente
+            full_config['RAG_MODELS_LIST'] = list(self.rag_models)
+        if self.llm_embedding_model:
+            full_config['llm_embedding_model'] = self.llm_embedding_model
+        if self.llm_api_key:
+            full_config['llm_api_key'] = self.llm_api_key
+            # Stessa chiave sotto i nomi che i vari moduli si aspettano
+            full_config['GOOGLE_API_KEY'] = self.llm_api_key
+            if not full_config.get('GEMINI_EMBEDDING_API_KEY'):
+                full_config['GEMINI_EMBEDDING_API_KEY'] = self.llm_api_key
+        if self.ollama_base_url:
+            full_config['ollama_base_url'] = self.ollama_base_url
+        if self.embedding_dimension:
+            full_config['EMBEDDING_OUTPUT_DIMENSIONALITY'] = self.embedding_dimension
+
+        if apply_embedding_state:
+            if self.embedding_state:
+                full_config = apply_embedding_profile(full_config, self.embedding_state['active_profile'], self.embedding_state['active_suffix'])
+            else:
+                full_config['EMBEDDING_COLLECTION_SUFFIX'] = ''
+        return full_config
+
+
+def _clean(value):
+    if isinstance(value, str):
+        value = value.strip()
+    return value or None
+
+
+def _read_version(conn: sqlite3.Connection, user_id: str) -> tuple:
+    """
+    Versione delle impostazioni dell'utente: il contatore incrementato dalle route delle impostazioni
+    più il profilo di embedding attivo, che cambia quando una migrazione si conclude.
+    """
+    row = conn.execute("""
+        SELECT (SELECT version FROM user_settings_versions WHERE user_id = ?),
+               (SELECT active_suffix || '|' || active_profile FROM embedding_model_state WHERE user_id = ?)
+    """, (user_id, user_id)).fetchone()
+    return (row[0] or 0, row[1] or '')
+
+
+def _load(db_path: str, user_id: str) -> Optional['EffectiveSettings']:
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        version = _read_version(conn, user_id)
+        settings_row = conn.execute(
+            "SELECT llm_provider, llm_model_name, llm_embedding_model, llm_api_key, ollama_base_url, embedding_dimension FROM user_settings WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"Impossibile caricare le impostazioni dell'utente {user_id}: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+    if settings_row:
+        logger.info(f"Impostazioni utente caricate (user: {user_id}, versione {version[0]}).")
+    return EffectiveSettings(user_id, version, dict(settings_row) if settings_row else None, get_embedding_model_state(db_path, user_id))
+
+
+def get_effective_settings(user_id: str, config=None) -> 'EffectiveSettings':
+    """
+    Impostazioni effettive dell'utente, dalla cache del processo. La versione nel DB viene
+    ricontrollata al massimo ogni USER_SETTINGS_CACHE_CHECK_SECONDS; se è cambiata si ricaricano.
+    """
+    config = config if config is not None else current_app.config
+    db_path = config.get('DATABASE_FILE')
+    check_seconds = config.get('USER_SETTINGS_CACHE_CHECK_SECONDS', 5)
+
+    with _cache_lock:
+        cached = _cache.get(user_id)
+    if cached and time.monotonic() - cached.checked_at < check_seconds:
+        return cached
+
+    if cached:
+        conn = None
+        try:
+            conn = sqlite3.connect(db_path, timeout=30)
+            if _read_version(conn, user_id) == cached.version:
+                cached.checked_at = time.monotonic()
+                return cached
+        except sqlite3.Error as e:
+            logger.warning(f"Controllo versione impostazioni fallito per l'utente {user_id}: {e}. Le ricarico.")
+        finally:
+            if conn:
+                conn.close()
+
+    settings = _load(db_path, user_id)
+    if settings is None:
+        # DB non leggibile: valgono i default dell'app, senza metterli in cache
+        return EffectiveSettings(user_id, (None, None), None, None)
+    with _cache_lock:
+        _cache[user_id] = settings
+    return settings
+
+
+def bump_settings_version(user_id: str, db_path: Optional[str] = None) -> None:
+    """
+    Da chiamare dopo aver salvato le impostazioni dell'utente: incrementa il contatore nel DB
+    (gli altri processi se ne accorgono al prossimo controllo) e svuota subito la cache locale.
+    """
+    db_path = db_path or current_app.config.get('DATABASE_FILE')
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.execute("""
+            INSERT INTO user_settings_versions (user_id, version) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+        """, (user_id,))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Impossibile aggiornare la versione delle impostazioni per l'utente {user_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
+    with _cache_lock:
+        _cache.pop(user_id, None)
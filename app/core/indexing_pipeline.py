@@ -0,0 +1,356 @@
+# FILE: app/core/indexing_pipeline.py
+
+import queue
+import logging
+import sqlite3
+import threading
+import textstat
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional
+from google.api_core import exceptions as google_exceptions
+
+from flask import current_app
+
+from app.services.youtube.client import YouTubeClient
+from app.services.transcripts.youtube_transcript import TranscriptService
+from app.services.embedding.embedding_service import generate_embeddings, ensure_collection_dimension
+from app.services.embedding.token_budget import get_embedding_limits
+from app.services.embedding.model_migration import get_active_collection_name
+from app.services.embedding.gemini_embedding import split_text_into_chunks, add_chunk_offsets, TASK_TYPE_DOCUMENT
+from app.services.chunking.agentic_chunker import chunk_text_agentically
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DOCUMENT = 'document'
+SOURCE_ARTICLE = 'article'
+SOURCE_PAGE = 'page'
+SOURCE_VIDEO = 'video'
+
+# Se lo stadio di chunking non produce nulla per questo tempo, gli embedding accumulati partono comunque
+_EMBED_FLUSH_SECONDS = 2.0
+_END = object() # Sentinella di fine flusso tra uno stadio e il successivo
+
+
+def _document_metadata(row, user_id):
+    return {"doc_id": row['item_id'], "original_filename": row['original_filename'], "source_type": "document", "user_id": user_id}
+
+def _article_metadata(row, user_id):
+    return {"article_id": row['item_id'], "article_title": row['title'], "article_url": row['article_url'], "source_type": "article", "user_id": user_id}
+
+def _page_metadata(row, user_id):
+    return {"page_id": row['item_id'], "page_title": row['title'], "page_url": row['page_url'], "source_type": "page", "user_id": user_id}
+
+def _video_metadata(row, user_id):
+    return {
+        'video_id': row['item_id'], 'video_title': row['title'], 'channel_id': row['channel_id'],
+        'published_at': str(row['published_at']), 'language': row['transcript_language'],
+        'caption_type': row['captions_type'], 'user_id': user_id
+    }
+
+
+# Cosa cambia da un tipo di contenuto all'altro; il resto della pipeline è comune
+_SOURCES = {
+    SOURCE_DOCUMENT: {
+        'select': "SELECT doc_id AS item_id, content AS text, original_filename FROM documents WHERE doc_id = ?",
+        'id_field': 'doc_id', 'table': 'documents',
+        'collection_key': 'DOCUMENT_COLLECTION_NAME', 'collection_default': 'document_content',
+        'metadata': _document_metadata, 'stats_source_type': 'document',
+        'not_found_status': 'failed_doc_not_found',
+    },
+    SOURCE_ARTICLE: {
+        'select': "SELECT article_id AS item_id, content AS text, title, article_url FROM articles WHERE article_id = ?",
+        'id_field': 'article_id', 'table': 'articles',
+        'collection_key': 'ARTICLE_COLLECTION_NAME', 'collection_default': 'article_content',
+        'metadata': _article_metadata, 'stats_source_type': 'articles',
+        'not_found_status': 'failed_article_not_found',
+    },
+    SOURCE_PAGE: {
+        'select': "SELECT page_id AS item_id, content AS text, title, page_url FROM pages WHERE page_id = ?",
+        'id_field': 'page_id', 'table': 'pages',
+        'collection_key': None, 'collection_default': 'page_content',
+        'metadata': _page_metadata, 'stats_source_type': 'pages',
+        'not_found_status': 'failed_indexing',
+    },
+    SOURCE_VIDEO: {
+        'select': "SELECT video_id AS item_id, transcript AS text, title, channel_id, published_at, transcript_language, captions_type FROM videos WHERE video_id = ? AND user_id = ?",
+        'id_field': 'video_id', 'table': 'videos',
+        'collection_key': 'VIDEO_COLLECTION_NAME', 'collection_default': 'video_transcripts',
+        'metadata': _video_metadata, 'stats_source_type': None,
+        'not_found_status': 'failed_not_found',
+    },
+}
+
+
+def _extract_item(source_type: str, item_id: str, cursor, user_id: str, core_config: dict) -> dict:
+    """Stadio 1 (thread chiamante, l'unico che usa la connessione SQLite): legge il testo e i metadati."""
+    source = _SOURCES[source_type]
+    params = (item_id, user_id) if source_type == SOURCE_VIDEO else (item_id,)
+    cursor.execute(source['select'], params)
+    row = cursor.fetchone()
+    if not row:
+        logger.warning(f"[Indexing][{item_id}] Record '{source_type}' non trovato nel DB.")
+        return {'item_id': item_id, 'status': source['not_found_status']}
+
+    row = dict(row)
+    if source_type == SOURCE_VIDEO and not (row['text'] or '').strip():
+        # Video senza trascrizione salvata: la scarichiamo con l'API ufficiale
+        logger.info(f"[Indexing][{item_id}] Trascrizione non trovata nel DB. Tento il download.")
+        try:
+            youtube_client = YouTubeClient(token_file=core_config.get('TOKEN_PATH'))
+            transcript_result = TranscriptService.get_transcript(item_id, youtube_client=youtube_client)
+        except Exception as e_yt:
+            logger.error(f"[Indexing][{item_id}] Errore API trascrizione: {e_yt}")
+            return {'item_id': item_id, 'status': 'failed_transcript_api'}
+        if not transcript_result or transcript_result.get('error'):
+            return {'item_id': item_id, 'status': 'failed_transcript'}
+        row['text'] = transcript_result['text']
+        row['transcript_language'] = transcript_result['language']
+        row['captions_type'] = transcript_result['type']
+        cursor.execute("UPDATE videos SET transcript = ?, transcript_language = ?, captions_type = ? WHERE video_id = ?",
+                       (row['text'], row['transcript_language'], row['captions_type'], item_id))
+
+    return {'item_id': item_id, 'status': None, 'text': row['text'] or '', 'metadata': source['metadata'](row, user_id)}
+
+
+def _chunk_item(item: dict, core_config: dict) -> None:
+    """Stadio 2: chunking agentico (con ripiego sul classico) o classico."""
+    text = item['text']
+    item['chunks'] = []
+    item['chunking_version'] = 'classic_v1'
+    if not text.strip():
+        return
+
+    chunk_size = core_config.get('DEFAULT_CHUNK_SIZE_WORDS', 300)
+    chunk_overlap = core_config.get('DEFAULT_CHUNK_OVERLAP_WORDS', 50)
+    if str(core_config.get('USE_AGENTIC_CHUNKING', 'False')).lower() == 'true':
+        try:
+            item['chunks'] = chunk_text_agentically(text, llm_provider=core_config.get('llm_provider', 'google'), settings=core_config)
+        except google_exceptions.ResourceExhausted as e:
+            logger.warning(f"[Indexing][{item['item_id']}] Quota API esaurita durante il chunking. Fallback a chunking classico. Errore: {e}")
+            item['chunks'] = []
+        if item['chunks']:
+            rag_models = core_config.get('RAG_MODELS_LIST', [])
+            model_name_marker = rag_models[0].strip() if rag_models and rag_models[0].strip() else "unknown_model"
+            item['chunking_version'] = f'agentic_v1_{model_name_marker}'
+            return
+        logger.warning(f"[Indexing][{item['item_id']}] Chunking intelligente fallito. Fallback a classico.")
+    item['chunks'] = split_text_into_chunks(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def _embed_group(group: List[dict], core_config: dict) -> None:
+    """Stadio 3: una sola chiamata di embedding per i chunk di più contenuti."""
+    to_embed = [item for item in group if item['chunks']]
+    if not to_embed:
+        return
+    texts = [chunk for item in to_embed for chunk in item['chunks']]
+    try:
+        embeddings = generate_embeddings(texts, user_settings=core_config, task_type=TASK_TYPE_DOCUMENT)
+    except Exception as e:
+        logger.error(f"[Indexing] Errore generazione embedding per {len(to_embed)} contenuti: {e}", exc_info=True)
+        embeddings = None
+    if not embeddings or len(embeddings) != len(texts):
+        if len(to_embed) > 1:
+            # Il gruppo fallisce per colpa di un contenuto (o di un errore passeggero): riproviamo
+            # ogni contenuto da solo, così quelli validi non restano bloccati. I batch già riusciti sono in cache.
+            logger.warning(f"[Indexing] Embedding di gruppo fallito: nuovo tentativo per ciascuno dei {len(to_embed)} contenuti.")
+            for item in to_embed:
+                _embed_group([item], core_config)
+            return
+        to_embed[0]['status'] = 'failed_embedding'
+        return
+    offset = 0
+    for item in to_embed:
+        item['embeddings'] = embeddings[offset:offset + len(item['chunks'])]
+        offset += len(item['chunks'])
+
+
+def _write_group(group: List[dict], collection, id_field: str) -> None:
+    """Stadio 4: un solo delete dei vecchi frammenti e un solo upsert per gruppo."""
+    ready = [item for item in group if item['status'] is None]
+    if not ready:
+        return
+    ids, embeddings, metadatas, documents = [], [], [], []
+    for item in ready:
+        item_metadatas = [{**item['metadata'], 'chunk_index': i} for i in range(len(item['chunks']))]
+        add_chunk_offsets(item_metadatas, item['text'], item['chunks'])
+        ids.extend(f"{item['item_id']}_chunk_{i}" for i in range(len(item['chunks'])))
+        embeddings.extend(item.get('embeddings', []))
+        metadatas.extend(item_metadatas)
+        documents.extend(item['chunks'])
+    try:
+        # Un contenuto riscritto può avere meno frammenti di prima: togliamo quelli vecchi
+        collection.delete(where={id_field: {"$in": [item['item_id'] for item in ready]}})
+        if ids:
+            ensure_collection_dimension(collection, embeddings)
+            collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+        for item in ready:
+            item['status'] = 'completed'
+    except Exception as e:
+        logger.error(f"[Indexing] Errore scrittura ChromaDB per {len(ready)} contenuti: {e}", exc_info=True)
+        for item in ready:
+            item['status'] = 'failed_chroma_write'
+
+
+def _save_item_status(source_type: str, item: dict, cursor, user_id: str) -> str:
+    """Aggiorna stato (e statistiche di leggibilità) di un contenuto, nel thread chiamante."""
+    source = _SOURCES[source_type]
+    final_status = item['status'] or 'failed_processing_generic'
+
+    if final_status == 'completed' and source['stats_source_type']:
+        try:
+            text = item.get('text') or ''
+            word_count = len(text.split()) if text.strip() else 0
+            gunning_fog = textstat.gunning_fog(text) if text.strip() else 0
+            cursor.execute("""
+                INSERT INTO content_stats (content_id, user_id, source_type, word_count, gunning_fog)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(content_id) DO UPDATE SET
+                    word_count = excluded.word_count,
+                    gunning_fog = excluded.gunning_fog,
+                    last_calculated = CURRENT_TIMESTAMP
+            """, (item['item_id'], user_id, source['stats_source_type'], word_count, gunning_fog))
+        except Exception as e_stats:
+            logger.error(f"[Indexing][{item['item_id']}] Errore calcolo statistiche: {e_stats}")
+
+    try:
+        if source_type == SOURCE_VIDEO:
+            chunking_version = item.get('chunking_version') if final_status == 'completed' else None
+            cursor.execute("UPDATE videos SET processing_status = ?, chunking_version = ? WHERE video_id = ?", (final_status, chunking_version, item['item_id']))
+        else:
+            cursor.execute(f"UPDATE {source['table']} SET processing_status = ? WHERE {source['id_field']} = ?", (final_status, item['item_id']))
+    except sqlite3.Error as db_update_err:
+        logger.error(f"[Indexing][{item['item_id']}] Errore CRITICO aggiornamento DB: {db_update_err}")
+        final_status = 'failed_db_status_update'
+    return final_status
+
+
+def index_items(
+    source_type: str,
+    item_ids: List[str],
+    conn: sqlite3.Connection,
+    user_id: Optional[str],
+    core_config: dict,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> Dict[str, str]:
+    """
+    Indicizza uno o più contenuti dello stesso tipo con una pipeline a stadi collegati da code limitate:
+    estrazione (thread chiamante) -> chunking -> embedding (a gruppi di più contenuti, fino al
+    limite del provider) -> scrittura su ChromaDB (un upsert per gruppo).
+    Stati e statistiche vengono scritti sulla connessione del chiamante, a cui resta il commit.
+    Restituisce {item_id: stato finale}.
+    """
+    source = _SOURCES[source_type]
+    if not user_id:
+        logger.error(f"[Indexing] User ID mancante: {len(item_ids)} contenuti '{source_type}' non indicizzati.")
+        return {item_id: 'failed_user_id_missing' for item_id in item_ids}
+    chroma_client = core_config.get('CHROMA_CLIENT')
+    if not chroma_client:
+        logger.error("[Indexing] Chroma Client non trovato!")
+        return {item_id: 'failed_config_client_missing' for item_id in item_ids}
+
+    base_collection_name = core_config.get(source['collection_key'], source['collection_default']) if source['collection_key'] else source['collection_default']
+    collection_name = get_active_collection_name(base_collection_name, user_id, core_config)
+    try:
+        collection = chroma_client.get_or_create_collection(name=collection_name)
+    except Exception as e_coll:
+        logger.error(f"[Indexing] Errore get/create collezione '{collection_name}': {e_coll}")
+        return {item_id: 'failed_chroma_collection' for item_id in item_ids}
+
+    queue_size = max(1, int(core_config.get('INDEXING_QUEUE_SIZE', 8) or 1))
+    group_chunks = get_embedding_limits(core_config)['max_items'] # Un gruppo riempie una richiesta al provider
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    embed_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    finished: List[dict] = []
+    finished_lock = threading.Lock()
+    total = len(item_ids)
+
+    try:
+        app = current_app._get_current_object()
+    except RuntimeError:
+        app = None # Fuori da un app context (es. script)
+
+    def _finish(items):
+        with finished_lock:
+            finished.extend(items)
+            done = len(finished)
+        if progress_callback:
+            progress_callback(done, total)
+
+    def _chunk_stage():
+        with app.app_context() if app else nullcontext():
+            try:
+                while (item := chunk_queue.get()) is not _END:
+                    try:
+                        _chunk_item(item, core_config)
+                    except Exception as e:
+                        logger.error(f"[Indexing][{item['item_id']}] Errore chunking: {e}", exc_info=True)
+                        item['status'] = 'failed_chunking'
+                    embed_queue.put(item)
+            finally:
+                embed_queue.put(_END)
+
+    def _embed_stage():
+        with app.app_context() if app else nullcontext():
+            group, group_size, upstream_done = [], 0, False
+            try:
+                while not upstream_done:
+                    try:
+                        item = embed_queue.get(timeout=_EMBED_FLUSH_SECONDS) if group else embed_queue.get()
+                    except queue.Empty:
+                        item = None # Nessun nuovo contenuto per un po': inviamo quanto accumulato
+                    if item is _END:
+                        upstream_done = True
+                    elif item is not None:
+                        if item['status'] is None:
+                            group.append(item)
+                            group_size += len(item['chunks'])
+                        else:
+                            write_queue.put([item])
+                    if group and (item is None or upstream_done or group_size >= group_chunks):
+                        _embed_group(group, core_config)
+                        write_queue.put(group)
+                        group, group_size = [], 0
+            finally:
+                if group: # Uscita per errore imprevisto: i contenuti non devono sparire
+                    write_queue.put(group)
+                write_queue.put(_END)
+
+    def _write_stage():
+        with app.app_context() if app else nullcontext():
+            while (group := write_queue.get()) is not _END:
+                try:
+                    _write_group(group, collection, source['id_field'])
+                finally:
+                    _finish(group)
+
+    stages = [threading.Thread(target=target, daemon=True, name=f"indexing-{name}")
+              for name, target in (('chunk', _chunk_stage), ('embed', _embed_stage), ('write', _write_stage))]
+    for stage in stages:
+        stage.start()
+
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    try:
+        for item_id in item_ids:
+            try:
+                item = _extract_item(source_type, item_id, cursor, user_id, core_config)
+            except Exception as e:
+                logger.error(f"[Indexing][{item_id}] Errore lettura contenuto: {e}", exc_info=True)
+                item = {'item_id': item_id, 'status': 'failed_processing_generic'}
+            if item['status'] is None:
+                chunk_queue.put(item)
+            else:
+                _finish([item])
+    finally:
+        chunk_queue.put(_END)
+        for stage in stages:
+            stage.join()
+
+    statuses = {}
+    cursor.row_factory = None
+    for item in finished:
+        statuses[item['item_id']] = _save_item_status(source_type, item, cursor, user_id)
+    completed = sum(1 for status in statuses.values() if status == 'completed')
+    logger.info(f"[Indexing] {completed}/{total} contenuti '{source_type}' indicizzati per utente {user_id}.")
+    return statuses
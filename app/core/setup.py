@@ -3,8 +3,8 @@ import os
 import sqlite3
 import logging
 from flask import current_app
-from google.oauth2.credentials import Credentials
-import google.auth.transport.requests
+from app.utils import normalize_url, compute_content_hash
+from app.services.youtube.service_factory import get_credentials, store_credentials, invalidate
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +21,7 @@ def save_credentials(credentials):
         logger.error("Percorso TOKEN_PATH non trovato nella configurazione dell'app.")
         return
     try:
-        with open(token_path, 'w') as token:
-            token.write(credentials.to_json())
+        store_credentials(token_path, credentials)
         logger.info(f"Credenziali salvate in: {token_path}")
     except IOError as e:
         logger.error(f"Errore I/O salvando credenziali in {token_path}: {e}")
@@ -47,43 +46,45 @@ def load_credentials():
         logger.info(f"File credenziali '{token_path}' non trovato.")
         return None
 
-    logger.info(f"Tentativo caricamento credenziali da: {token_path}")
     try:
-        creds = Credentials.from_authorized_user_file(token_path, scopes)
+        # Dalla cache del processo: il file viene riletto solo se è cambiato,
+        # il rinnovo del token è coordinato tra i worker (vedi service_factory)
+        creds = get_credentials(token_path, scopes)
         if creds and creds.valid:
-            logger.info("Credenziali valide trovate.")
             return creds
-        elif creds and creds.expired and creds.refresh_token:
-            logger.info("Credenziali scadute, tentativo refresh...")
-            try:
-                creds.refresh(google.auth.transport.requests.Request())
-                # Tentativo di salvataggio (potrebbe fallire se chiamato al di fuori di una richiesta)
-                logger.warning("Tentativo salvataggio credenziali aggiornate da load_credentials.")
-                save_credentials(creds) # Richiede contesto app
-                logger.info("Token aggiornato con successo.")
-                return creds
-            except Exception as e:
-                # ERRORE REFRESH: Qui deve cancellare il file e restituire None
-                logger.error(f"Errore aggiornamento token: {e}. Necessaria ri-autenticazione.")
-                try: os.remove(token_path); logger.info(f"File token rimosso dopo errore refresh: {token_path}") # Log aggiunto
-                except OSError: pass
-                return None # <-- Fondamentale restituire None qui
-        else:
-            # Credenziali non valide o senza refresh: Cancella e restituisci None
-            logger.warning("Credenziali non valide o senza refresh token. Rimuovo file token.")
-            try: os.remove(token_path); logger.info(f"File token rimosso perché invalido/senza refresh: {token_path}") # Log aggiunto
-            except OSError: pass
-            return None # <-- Fondamentale restituire None qui
+        # Credenziali non valide e senza refresh token: Cancella e restituisci None
+        logger.warning("Credenziali non valide o senza refresh token. Rimuovo file token.")
+        try: os.remove(token_path); logger.info(f"File token rimosso perché invalido/senza refresh: {token_path}")
+        except OSError: pass
+        invalidate(token_path)
+        return None
     except Exception as e:
-        # Errore generale caricamento: Cancella e restituisci None
-        logger.error(f"Errore caricamento/parsing credenziali da {token_path}: {e}")
-        try: os.remove(token_path); logger.info(f"File token rimosso dopo errore caricamento: {token_path}") # Log aggiunto
+        # Errore di caricamento o di refresh: Cancella e restituisci None
+        logger.error(f"Errore caricamento/aggiornamento credenziali da {token_path}: {e}. Necessaria ri-autenticazione.")
+        try: os.remove(token_path); logger.info(f"File token rimosso dopo errore: {token_path}")
         except OSError: pass
-        return None # <-- Fondamentale restituire None qui
+        invalidate(token_path)
+        return None
+
 
-    # Aggiunta finale per sicurezza: se si arriva qui inaspettatamente, restituisce None
-    logger.warning("load_credentials ha raggiunto la fine senza restituire un valore esplicito. Restituisco None.")
-    return None
+def _backfill_normalized_urls_and_hashes(cursor: sqlite3.Cursor) -> None:
+    """
+    Migrazione una tantum: URL normalizzato (e hash del contenuto, se manca) per le righe salvate
+    prima che venissero scritti insieme all'articolo/pagina. Le righe da completare si trovano
+    con un indice parziale, vuoto a migrazione conclusa: agli avvii successivi nessuna scansione.
+    """
+    for table_name, id_col, url_col in (('articles', 'article_id', 'article_url'), ('pages', 'page_id', 'page_url')):
+        missing = f"normalized_url IS NULL AND {url_col} IS NOT NULL"
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_missing_normalized_url ON {table_name} ({id_col}) WHERE {missing}")
+        rows = cursor.execute(f"SELECT {id_col}, {url_col}, content, content_hash FROM {table_name} WHERE {missing}").fetchall()
+        if not rows:
+            continue
+        cursor.executemany(
+            f"UPDATE {table_name} SET normalized_url = ?, content_hash = ? WHERE {id_col} = ?",
+            [(normalize_url(url), content_hash or (compute_content_hash(content) if content is not None else None), row_id)
+             for row_id, url, content, content_hash in rows]
+        )
+        logger.info(f"Migrazione: URL normalizzato e hash aggiornati per {len(rows)} righe di '{table_name}'.")
 
 
 # --- Setup Directory (usando config object) ---
@@ -232,6 +233,17 @@ def init_db(config):
             else:
                 raise
 
+        # URL normalizzato (vedi normalize_url) salvato con la riga: i controlli dei duplicati
+        # di RSS e WordPress diventano ricerche sull'indice invece di normalizzare tutto l'archivio
+        for table_name in ('articles', 'pages'):
+            try:
+                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN normalized_url TEXT")
+                logger.info(f"Colonna 'normalized_url' aggiunta alla tabella '{table_name}'.")
+            except sqlite3.OperationalError:
+                logger.debug(f"Colonna 'normalized_url' già presente nella tabella '{table_name}'.")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_user_normalized_url ON {table_name} (user_id, normalized_url)")
+        _backfill_normalized_urls_and_hashes(cursor)
+
         # --- Tabella users ---
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -285,6 +297,35 @@ def init_db(config):
                 UNIQUE (user_id, channel_id)
             )''')
 
+        # Stato dell'ultima scansione di un canale: evita di rileggere la playlist "Uploads"
+        # quando la prima pagina non è cambiata (ETag) e di cercare ogni volta l'ID della playlist
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS youtube_channel_listing_state (
+                user_id TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                uploads_playlist_id TEXT,
+                first_page_etag TEXT,
+                total_results INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, channel_id)
+            )''')
+
+        # Video di un canale in attesa di elaborazione, divisi in lotti giornalieri secondo la quota YouTube
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS youtube_video_backlog (
+                user_id TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                title TEXT,
+                url TEXT,
+                published_at TEXT,
+                description TEXT,
+                planned_day TEXT,                   -- Giorno di quota (ora del Pacifico) previsto per l'elaborazione
+                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, video_id)
+            )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_youtube_video_backlog_channel ON youtube_video_backlog (user_id, channel_id)")
+
         # Tabella per Feed RSS Monitorati
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS monitored_rss_feeds (
@@ -299,6 +340,13 @@ def init_db(config):
                  -- Assicura che un utente monitori un feed solo una volta
                 UNIQUE (user_id, feed_url)
             )''')
+        # Validatori HTTP dell'ultimo controllo, per le richieste condizionali dello scheduler
+        for column in ('etag', 'last_modified'):
+            try:
+                cursor.execute(f"ALTER TABLE monitored_rss_feeds ADD COLUMN {column} TEXT")
+                logger.info(f"Colonna '{column}' aggiunta a 'monitored_rss_feeds'.")
+            except sqlite3.OperationalError:
+                logger.debug(f"Colonna '{column}' già presente in 'monitored_rss_feeds'.")
         
         # --- Tabella per le Impostazioni Utente ---
         cursor.execute('''
@@ -363,6 +411,30 @@ def init_db(config):
             )''')
         logger.info("Tabella 'system_alerts' verificata/creata.")
 
+        # --- Stato del modello di embedding per utente (migrazioni con collezioni ombra) ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_model_state (
+                user_id TEXT PRIMARY KEY,
+                active_suffix TEXT NOT NULL DEFAULT '',   -- '' = collezioni storiche '<base>_<user_id>'
+                active_profile TEXT NOT NULL,             -- JSON: provider, modello e dimensione in uso
+                target_suffix TEXT,                       -- Collezioni ombra in costruzione (NULL se nessuna migrazione)
+                target_profile TEXT,
+                status TEXT NOT NULL DEFAULT 'idle',      -- 'idle', 'pending', 'migrating', 'failed'
+                total_chunks INTEGER DEFAULT 0,
+                migrated_chunks INTEGER DEFAULT 0,
+                last_error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+            )''')
+        logger.info("Tabella 'embedding_model_state' verificata/creata.")
+
+        # --- Versione delle impostazioni utente (invalida le impostazioni effettive in cache in ogni processo) ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_settings_versions (
+                user_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )''')
+
         # --- Aggiunta colonne per Personalizzazione ---
         try:
             cursor.execute("ALTER TABLE user_settings ADD COLUMN brand_color TEXT")
@@ -446,6 +518,15 @@ def init_db(config):
             else:
                 raise  
         
+        try:
+            cursor.execute("ALTER TABLE user_settings ADD COLUMN embedding_dimension INTEGER")
+            logger.info("Colonna 'embedding_dimension' aggiunta alla tabella 'user_settings'.")
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" in str(e).lower():
+                logger.debug("Colonna 'embedding_dimension' già presente in 'user_settings'.")
+            else:
+                raise
+
         # Questo blocco sarebbe servito per Wordpress Oauth, che avrebbe peggiorato UX
         # try:
         #     cursor.execute("ALTER TABLE user_settings ADD COLUMN wordpress_access_token TEXT")
@@ -1,15 +1,16 @@
 import os
 import sqlite3
 import logging
-import json
 from flask import current_app
 from flask_login import current_user
 from datetime import datetime 
 import psutil
 
 from app.core.setup import load_credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from app.services.rate_limiter.token_bucket import get_bucket_states
+from app.services.embedding.model_migration import get_active_collection_name, get_embedding_migration_status
+from app.services.youtube.service_factory import get_youtube_service
+from app.services.youtube.quota_ledger import get_quota_status, record_call
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +28,8 @@ def _get_youtube_auth_status():
             }
 
         # Proviamo a fare una chiamata reale "Chi sono io?"
-        service = build('youtube', 'v3', credentials=credentials)
+        service = get_youtube_service(current_app.config.get('TOKEN_PATH'), current_app.config.get('GOOGLE_SCOPES'))
+        record_call('channels.list')
         response = service.channels().list(part='snippet', mine=True).execute()
         
         if response.get('items'):
@@ -57,73 +59,13 @@ def _get_youtube_auth_status():
 
 def _get_youtube_quota_info():
     """
-    Contatta la Service Usage API di Google per ottenere l'utilizzo della quota
-    della YouTube Data API v3 per il progetto corrente.
-    Restituisce un dizionario con le informazioni o un messaggio di errore.
+    Consumo della quota YouTube Data API di oggi, dal registro locale scritto da YouTubeClient.
+    Non richiede scope aggiuntivi e non ha il ritardo della Service Usage API.
     """
-    try:
-        credentials = load_credentials()
-        if not credentials or not credentials.valid:
-            return {'error': "Credenziali Google non valide o assenti. <a href='/authorize' style='font-weight: bold; text-decoration: underline;'>Clicca qui per autorizzare l'applicazione</a>."}
-
-        project_id = None
-        secrets_path = current_app.config.get('CLIENT_SECRETS_PATH')
-        if os.path.exists(secrets_path):
-            with open(secrets_path, 'r') as f:
-                secrets = json.load(f)
-                project_id = secrets.get('installed', {}).get('project_id') or secrets.get('web', {}).get('project_id')
-        
-        if not project_id:
-            return {'error': "Impossibile determinare il project_id dal file client_secrets.json."}
-
-        service = build('serviceusage', 'v1', credentials=credentials)
-        resource_name = f"projects/{project_id}/services/youtube.googleapis.com"
-        
-        request = service.services().get(name=resource_name)
-        response = request.execute()
-        
-        quota_metrics = response.get('quota', {}).get('metrics', [])
-        usage_value = 0
-        limit_value = 10000
-
-        for metric in quota_metrics:
-            if metric.get('name') == 'youtube.googleapis.com/default':
-                limit_info = metric.get('consumerQuotaLimits', [{}])[0]
-                limit_value = int(limit_info.get('quotaBuckets', [{}])[0].get('effectiveLimit', 10000))
-                usage_value = int(limit_info.get('quotaBuckets', [{}])[0].get('values', {}).get('INT64', 0))
-                break
-        
-        percentage = round((usage_value / limit_value) * 100, 2) if limit_value > 0 else 0
-
-        return {
-            'limit': limit_value,
-            'usage': usage_value,
-            'percentage': percentage,
-            'resets_at': "09:00 (ora italiana, circa)"
-        }
-
-    except HttpError as e:
-        # --- BLOCCO INTELLIGENTE PER LA GESTIONE ERRORI ---
-        try:
-            error_content = json.loads(e.content)
-            error_details = error_content.get('error', {})
-            
-            # Controlliamo specificamente l'errore di PERMESSI INSUFFICIENTI
-            if error_details.get('status') == 'PERMISSION_DENIED' and 'insufficient authentication scopes' in error_details.get('message', ''):
-                logger.warning("Rilevato errore di scope insufficiente per la quota API.")
-                # Restituiamo un messaggio HTML con il link per la soluzione!
-                return {'error': "Permessi insufficienti per leggere la quota. <a href='/authorize' style='font-weight: bold; text-decoration: underline;'>Clicca qui per aggiornare l'autorizzazione</a>."}
-
-            if 'Service Usage API has not been used' in error_details.get('message', ''):
-                return {'error': "L'API 'Service Usage' non è abilitata per questo progetto Google Cloud. Abilitala e riprova."}
-        except Exception:
-            pass # Se non riusciamo a leggere i dettagli, usiamo il messaggio generico sotto
-        
-        logger.error(f"Errore HTTP nel recuperare la quota YouTube: {e}")
-        return {'error': f"Errore API Google ({e.resp.status})."}
-    except Exception as e:
-        logger.error(f"Errore imprevisto nel recuperare la quota YouTube: {e}", exc_info=True)
-        return {'error': f"Errore imprevisto: {e}"}
+    quota = get_quota_status()
+    if not quota['enabled']:
+        return {'error': "Registro della quota YouTube non disponibile."}
+    return quota
 
 
 def get_system_stats():
@@ -243,6 +185,14 @@ def get_system_stats():
         
         final_stats['ram_status'] = ram_stats
 
+        try:
+            final_stats['rate_limits'] = get_bucket_states()
+        except Exception as e:
+            logger.warning(f"Impossibile recuperare lo stato del rate limiter: {e}")
+            final_stats['rate_limits'] = []
+
+        final_stats['embedding_migration'] = get_embedding_migration_status(current_app.config.get('DATABASE_FILE'), user_id)
+
         version_stats = {
             'version': 'sviluppo locale'
         }
@@ -302,7 +252,7 @@ def get_system_stats():
                     "ARTICLE": "article_content", "PAGE": "page_content"
                 }
                 for base_name in base_names.values():
-                    coll_name = f"{base_name}_{user_id}"
+                    coll_name = get_active_collection_name(base_name, user_id, current_app.config)
                     try:
                         collection = chroma_client.get_collection(name=coll_name)
                         total_chunks += collection.count()
@@ -327,8 +277,6 @@ def get_system_stats():
 
         final_stats['youtube_quota'] = _get_youtube_quota_info()
         final_stats['youtube_auth'] = _get_youtube_auth_status()
-        
-        final_stats['youtube_quota'] = _get_youtube_quota_info()
 
     except sqlite3.Error as e:
         final_stats['error'] = 'Si è verificato un errore nel caricamento dei dati.'
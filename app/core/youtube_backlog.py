@@ -0,0 +1,143 @@
+# FILE: app/core/youtube_backlog.py
+
+import logging
+import sqlite3
+import itertools
+from datetime import date, timedelta
+from typing import Iterable, Iterator, List, Tuple
+
+from app.api.models.video import Video
+from app.services.youtube.quota_ledger import UNIT_COSTS, get_quota_status
+
+logger = logging.getLogger(__name__)
+
+# Unità tenute da parte ogni giorno per le chiamate che non sono trascrizioni
+# (elenco dei video dei canali, verifica del token dalla pagina di stato).
+DEFAULT_QUOTA_RESERVE_UNITS = 100
+
+
+def estimate_video_cost(use_official_api_only: bool) -> int:
+    """
+    Unità di quota stimate per la trascrizione di un video. La libreria non ufficiale non consuma quota:
+    quando passa all'API ufficiale e la quota finisce, il video viene rimandato (vedi _process_youtube_channel_core).
+    """
+    if not use_official_api_only:
+        return 0
+    return UNIT_COSTS['captions.list'] + UNIT_COSTS['captions.download']
+
+
+def planned_quota_day(position: int, cost_per_video: int, remaining_today: int, daily_budget: int, today: date) -> str:
+    """
+    Giorno di quota del video in posizione `position` (0 = il più recente da elaborare):
+    i primi usano quel che resta di oggi, i successivi la quota piena dei giorni seguenti.
+    """
+    if cost_per_video <= 0:
+        return today.isoformat()
+    fit_today = max(0, remaining_today) // cost_per_video
+    if position < fit_today:
+        return today.isoformat()
+    per_day = max(1, daily_budget // cost_per_video)
+    return (today + timedelta(days=1 + (position - fit_today) // per_day)).isoformat()
+
+
+def _load_backlog(conn: sqlite3.Connection, user_id: str, channel_id: str) -> List[Video]:
+    rows = conn.execute(
+        "SELECT video_id, title, url, published_at, description FROM youtube_video_backlog WHERE user_id = ? AND channel_id = ? ORDER BY published_at DESC",
+        (user_id, channel_id)
+    ).fetchall()
+    return [Video(video_id=row[0], title=row[1], url=row[2], channel_id=channel_id, published_at=row[3], description=row[4] or '') for row in rows]
+
+
+def _queue_videos(db_path: str, user_id: str, channel_id: str, planned: List[Tuple[Video, str]]) -> None:
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO youtube_video_backlog (user_id, channel_id, video_id, title, url, published_at, description, planned_day) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(user_id, channel_id, v.video_id, v.title, v.url, str(v.published_at), v.description, day) for v, day in planned]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def stream_channel_plan(db_path: str, user_id: str, channel_id: str, video_pages: Iterable[list], use_official_api_only: bool, core_config: dict, summary: dict) -> Iterator[Video]:
+    """
+    Piano giornaliero in streaming. Consuma le pagine di video appena elencati (dal più recente),
+    poi la coda già salvata; ogni video ancora da elaborare finisce in youtube_video_backlog con il suo
+    giorno di quota (così un run interrotto non perde nulla) e quelli di oggi vengono restituiti subito,
+    senza aspettare la fine dell'elenco. A iterazione conclusa `summary` contiene quanti video restano
+    per i giorni successivi e l'ultimo giorno previsto.
+    """
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        existing_ids = {row[0] for row in conn.execute(
+            "SELECT video_id FROM videos WHERE channel_id = ? AND user_id = ?", (channel_id, user_id)
+        )}
+        backlog = _load_backlog(conn, user_id, channel_id)
+    finally:
+        conn.close()
+
+    quota = get_quota_status()
+    reserve = int(core_config.get('YOUTUBE_QUOTA_RESERVE_UNITS', DEFAULT_QUOTA_RESERVE_UNITS) or 0)
+    today = date.fromisoformat(quota['quota_day'])
+    cost_per_video = estimate_video_cost(use_official_api_only)
+    seen_ids = set()
+    position = 0
+    summary.update({'queued_videos': 0, 'last_day': None})
+
+    # Le nuove pagine prima, la coda (più vecchia) dopo
+    for page in itertools.chain(video_pages, [backlog]):
+        planned = []
+        for video in page:
+            if video.video_id in existing_ids or video.video_id in seen_ids:
+                continue
+            seen_ids.add(video.video_id)
+            day = planned_quota_day(position, cost_per_video, quota['remaining'] - reserve, quota['limit'] - reserve, today)
+            planned.append((video, day))
+            position += 1
+        if not planned:
+            continue
+        _queue_videos(db_path, user_id, channel_id, planned)
+        for video, day in planned:
+            if day == today.isoformat():
+                yield video
+            else:
+                summary['queued_videos'] += 1
+                summary['last_day'] = day
+
+    if summary['queued_videos']:
+        logger.info(f"[{channel_id}] Piano quota: {position - summary['queued_videos']} video oggi, {summary['queued_videos']} in coda fino al {summary['last_day']}.")
+
+
+def defer_videos(db_path: str, user_id: str, channel_id: str, videos: list) -> None:
+    """Rimette in coda, per il prossimo giorno di quota, i video saltati perché la quota è finita durante il run."""
+    next_day = (date.fromisoformat(get_quota_status()['quota_day']) + timedelta(days=1)).isoformat()
+    _queue_videos(db_path, user_id, channel_id, [(video, next_day) for video in videos])
+    logger.info(f"[{channel_id}] {len(videos)} video rimandati al {next_day} per quota YouTube esaurita.")
+
+
+def prune_channel_backlog(db_path: str, user_id: str, channel_id: str) -> dict:
+    """Toglie dalla coda i video ormai presenti nel DB e restituisce il riepilogo di quelli rimasti."""
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        conn.execute("""
+            DELETE FROM youtube_video_backlog WHERE user_id = ? AND channel_id = ?
+              AND video_id IN (SELECT video_id FROM videos WHERE user_id = ?)
+        """, (user_id, channel_id, user_id))
+        conn.commit()
+        queued, last_day = conn.execute(
+            "SELECT COUNT(*), MAX(planned_day) FROM youtube_video_backlog WHERE user_id = ? AND channel_id = ?",
+            (user_id, channel_id)
+        ).fetchone()
+    finally:
+        conn.close()
+    return {'queued_videos': queued, 'last_day': last_day}
+
+
+def channels_with_backlog(db_path: str) -> List[Tuple[str, str]]:
+    """Coppie (user_id, channel_id) con video ancora in coda, anche per canali non monitorati."""
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        return [tuple(row) for row in conn.execute("SELECT DISTINCT user_id, channel_id FROM youtube_video_backlog")]
+    finally:
+        conn.close()
@@ -5,25 +5,211 @@ import sqlite3
 import threading
 import textstat
 import copy
+import itertools
 import time 
-from typing import Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, Iterator, Optional
 from google.api_core import exceptions as google_exceptions
 
 from flask import current_app
 
 from app.services.youtube.client import YouTubeClient
+from app.api.models.video import Video
+from app.services.youtube.quota_ledger import remaining_units
+from app.core.youtube_backlog import stream_channel_plan, defer_videos, prune_channel_backlog
 from app.services.transcripts.youtube_transcript import TranscriptService
 from app.services.transcripts.youtube_transcript_unofficial_library import UnofficialTranscriptService
-from app.services.embedding.embedding_service import generate_embeddings
-from app.services.embedding.gemini_embedding import split_text_into_chunks, TASK_TYPE_DOCUMENT
+from app.services.embedding.embedding_service import generate_embeddings, ensure_collection_dimension
+from app.services.embedding.model_migration import get_active_collection_name
+from app.services.embedding.gemini_embedding import split_text_into_chunks, add_chunk_offsets, TASK_TYPE_DOCUMENT
 from app.services.chunking.agentic_chunker import chunk_text_agentically
 from app.utils import build_full_config_for_background_process
 
 
 logger = logging.getLogger(__name__)
 
+# Lock condiviso per gli aggiornamenti dei dizionari di stato letti dalla UI
+# (il thread di elaborazione e i worker delle trascrizioni scrivono, /progress legge).
+status_lock = threading.RLock()
 
-def _process_youtube_channel_core(channel_id: str, user_id: Optional[str], core_config: dict, videos_from_yt_models: list, status_dict: dict, use_official_api_only: bool = False) -> dict:
+
+def update_status(status_dict: dict, **fields) -> None:
+    with status_lock:
+        status_dict.update(fields)
+
+
+# Stato di un video con trascrizione già salvata ma embedding non ancora confermati:
+# è il punto da cui un import interrotto riprende senza riscaricare la trascrizione.
+CHECKPOINT_STATUS = 'processing_embedding'
+
+_SQL_SAVE_VIDEO = ''' INSERT OR REPLACE INTO videos (video_id, title, url, channel_id, published_at, description, transcript, transcript_language, captions_type, user_id, processing_status, fragment_count, added_at ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP) '''
+
+
+def _save_video_checkpoint(conn_sqlite: sqlite3.Connection, video_model, user_id: str, transcript_text, transcript_lang, transcript_type, status: str, fragment_count: int = 0) -> None:
+    """Scrive (e rende subito persistente) la riga di un video: un'interruzione non perde il lavoro già fatto."""
+    conn_sqlite.execute(_SQL_SAVE_VIDEO, (
+        video_model.video_id, video_model.title, video_model.url, video_model.channel_id, str(video_model.published_at),
+        video_model.description, transcript_text, transcript_lang, transcript_type, user_id, status, fragment_count
+    ))
+    conn_sqlite.commit()
+
+
+def _stored_chunk_count(collection, video_id: str) -> int:
+    """Frammenti già presenti in ChromaDB per un video (upsert riuscito prima dell'interruzione)."""
+    try:
+        return len(collection.get(where={"video_id": video_id}, include=[]).get('ids') or [])
+    except Exception as e:
+        logger.warning(f"[{video_id}] Impossibile leggere i frammenti già salvati: {e}")
+        return 0
+
+
+def iter_channel_videos(youtube_client: YouTubeClient, channel_id: str, user_id: str, db_path: str, listing_state: dict) -> Iterator[list]:
+    """
+    Pagine dei video del canale, man mano che arrivano. Se l'ultimo elenco era arrivato fino in fondo
+    la scansione è incrementale: si ferma ai video già elaborati e, se la prima pagina non è cambiata,
+    non costa nulla. Lo stato viene cancellato all'inizio e salvato solo a elenco completato, così dopo
+    un'interruzione il run successivo rifà l'elenco completo (i video visti sono già in coda).
+    """
+    known_video_ids = set()
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=10.0)
+        row = conn.execute(
+            "SELECT uploads_playlist_id, first_page_etag, total_results FROM youtube_channel_listing_state WHERE user_id = ? AND channel_id = ?",
+            (user_id, channel_id)
+        ).fetchone()
+        if row:
+            listing_state.update({'uploads_playlist_id': row[0], 'etag': row[1], 'total_results': row[2] or 0})
+            # I video fermi al checkpoint non contano come noti: vanno ancora completati
+            known_video_ids = {r[0] for r in conn.execute(
+                "SELECT video_id FROM videos WHERE channel_id = ? AND user_id = ? AND processing_status != ?",
+                (channel_id, user_id, CHECKPOINT_STATUS)
+            )}
+            conn.execute("DELETE FROM youtube_channel_listing_state WHERE user_id = ? AND channel_id = ?", (user_id, channel_id))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"[{channel_id}] Stato della scansione precedente non disponibile ({e}): elenco completo.")
+    finally:
+        if conn: conn.close()
+
+    yield from youtube_client.iter_channel_video_pages(channel_id, known_video_ids=known_video_ids, listing_state=listing_state)
+    _save_channel_listing_state(db_path, user_id, channel_id, listing_state)
+
+
+def _save_channel_listing_state(db_path: str, user_id: str, channel_id: str, listing_state: dict) -> None:
+    if not listing_state.get('uploads_playlist_id'):
+        return
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=10.0)
+        conn.execute(
+            "INSERT OR REPLACE INTO youtube_channel_listing_state (user_id, channel_id, uploads_playlist_id, first_page_etag, total_results, updated_at) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+            (user_id, channel_id, listing_state['uploads_playlist_id'], listing_state.get('etag'), listing_state.get('total_results', 0))
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"[{channel_id}] Impossibile salvare lo stato della scansione: {e}")
+    finally:
+        if conn: conn.close()
+
+
+def _transcript_limits(core_config: dict) -> dict:
+    """Semafori per fonte: la libreria non ufficiale regge più richieste insieme, l'API ufficiale consuma quota."""
+    unofficial = max(1, int(core_config.get('YOUTUBE_TRANSCRIPT_UNOFFICIAL_CONCURRENCY', 4) or 1))
+    official = max(1, int(core_config.get('YOUTUBE_TRANSCRIPT_OFFICIAL_CONCURRENCY', 1) or 1))
+    return {'unofficial': threading.BoundedSemaphore(unofficial), 'official': threading.BoundedSemaphore(official)}
+
+
+def _fetch_transcript(video_id: str, token_path: str, use_official_api_only: bool, limits: dict, thread_state: threading.local):
+    """
+    Recupera la trascrizione di un video (eseguita dai worker del pool).
+    Restituisce (transcript_result, ip_blocked). Il client dell'API ufficiale non è thread-safe:
+    ogni worker ne crea uno suo alla prima necessità.
+    """
+    def _official():
+        if remaining_units() <= 0:
+            # Inutile chiamare l'API: il video verrà rimandato al prossimo giorno di quota
+            return {'error': 'QUOTA_EXCEEDED', 'message': 'Quota API di YouTube esaurita per oggi.'}
+        with limits['official']:
+            youtube_client = getattr(thread_state, 'youtube_client', None)
+            if youtube_client is None:
+                youtube_client = thread_state.youtube_client = YouTubeClient(token_file=token_path)
+            return TranscriptService.get_transcript(video_id, youtube_client=youtube_client)
+
+    if use_official_api_only:
+        return _official(), False
+
+    with limits['unofficial']:
+        transcript_result = UnofficialTranscriptService.get_transcript(video_id)
+    if not transcript_result or transcript_result.get('error'):
+        ip_blocked = bool(transcript_result and transcript_result.get('error') == 'IP_BLOCKED')
+        return _official(), ip_blocked
+    return transcript_result, False
+
+
+def _prefilter_pages(video_pages: Iterable[list], youtube_client: YouTubeClient, db_path: str, user_id: str, channel_id: str, min_video_seconds: int) -> Iterator[list]:
+    """
+    Scarta, pagina per pagina, i video su cui non vale la pena spendere quota per i sottotitoli.
+    Una sola richiesta videos.list per pagina (fino a 50 ID, 1 unità di quota) per i video nuovi:
+    - dirette e prime visioni non hanno ancora sottotitoli: non le salviamo, il prossimo run le ritrova;
+    - video privati o rimossi non vengono restituiti dall'API: saltati;
+    - video più brevi di min_video_seconds (gli Shorts): salvati come 'skipped_short', per non riprovarli.
+    Se i dettagli non sono disponibili (quota esaurita, errore) la pagina passa intera.
+    """
+    existing_ids = set()
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=10.0)
+        existing_ids = {row[0] for row in conn.execute(
+            "SELECT video_id FROM videos WHERE channel_id = ? AND user_id = ?", (channel_id, user_id)
+        )}
+    except sqlite3.Error as e:
+        logger.warning(f"[{channel_id}] Video già salvati non disponibili ({e}): dettagli richiesti per tutta la pagina.")
+    finally:
+        if conn: conn.close()
+
+    for page in video_pages:
+        new_ids = [video.video_id for video in page if video.video_id not in existing_ids]
+        details = None
+        if new_ids and remaining_units() > 0:
+            try:
+                details = youtube_client.get_videos_details(new_ids)
+            except Exception as e:
+                logger.warning(f"[{channel_id}] Dettagli dei video non disponibili ({e}): pagina elaborata senza filtro.")
+        if details is None:
+            yield page
+            continue
+
+        kept, skipped_short = [], []
+        for video in page:
+            info = details.get(video.video_id)
+            if video.video_id in existing_ids:
+                kept.append(video)
+            elif not info:
+                logger.info(f"[{video.video_id}] Video privato o rimosso: saltato.")
+            elif info['live_broadcast_content'] in ('live', 'upcoming'):
+                logger.info(f"[{video.video_id}] Diretta o prima visione ({info['live_broadcast_content']}): rimandato.")
+            elif min_video_seconds and info['duration_seconds'] is not None and info['duration_seconds'] < min_video_seconds:
+                logger.info(f"[{video.video_id}] Video breve ({info['duration_seconds']}s): saltato.")
+                skipped_short.append(video)
+            else:
+                kept.append(video)
+        if skipped_short:
+            conn = sqlite3.connect(db_path, timeout=10.0)
+            try:
+                for video in skipped_short:
+                    _save_video_checkpoint(conn, video, user_id, None, None, None, 'skipped_short')
+            finally:
+                conn.close()
+        yield kept
+
+
+def _process_youtube_channel_core(channel_id: str, user_id: Optional[str], core_config: dict, videos_from_yt_models: Iterable, status_dict: dict, use_official_api_only: bool = False) -> dict:
+    """
+    Elabora i video di un canale. videos_from_yt_models può essere una lista o un iteratore:
+    un iteratore viene consumato man mano, così le trascrizioni partono mentre l'elenco è ancora in arrivo.
+    """
     logger.info(f"[CORE YT Process] Avvio per channel_id={channel_id}, user_id={user_id}, Solo API Ufficiale: {use_official_api_only}")
     
     if not user_id:
@@ -32,11 +218,11 @@ def _process_youtube_channel_core(channel_id: str, user_id: Optional[str], core_
 
     overall_success = False
     conn_sqlite = None
-    processed_videos_data_for_db = []
-    yt_count = len(videos_from_yt_models)
+    yt_count = 0
     to_process_count = 0
     saved_ok_count = 0
     transcript_errors, embedding_errors, chroma_errors, generic_errors = 0, 0, 0, 0
+    deferred_videos = []
 
     try:
         token_path = core_config.get('TOKEN_PATH')
@@ -49,135 +235,183 @@ def _process_youtube_channel_core(channel_id: str, user_id: Optional[str], core_
         conn_sqlite = sqlite3.connect(db_path_sqlite, timeout=10.0)
         cursor_sqlite = conn_sqlite.cursor()
         
-        existing_video_ids = set()
-        sql_check_existing = "SELECT video_id FROM videos WHERE channel_id = ? AND user_id = ?"
+        sql_check_existing = "SELECT video_id, processing_status, transcript, transcript_language, captions_type, title, url, published_at, description FROM videos WHERE channel_id = ? AND user_id = ?"
         cursor_sqlite.execute(sql_check_existing, (channel_id, user_id))
-        existing_video_ids = {row[0] for row in cursor_sqlite.fetchall()}
-        
-        videos_to_process_models = [v for v in videos_from_yt_models if v.video_id not in existing_video_ids]
-        to_process_count = len(videos_to_process_models)
-        
-        status_lock_ui = threading.Lock()
-        with status_lock_ui:
-             status_dict['total_videos'] = to_process_count
-
-        if to_process_count == 0:
+        existing_videos = {row[0]: row for row in cursor_sqlite.fetchall()}
+
+        # I video rimasti a metà (trascrizione salvata, embedding non confermati) si riprendono da lì
+        checkpointed_transcripts = {
+            video_id: {'text': row[2], 'language': row[3], 'type': row[4]}
+            for video_id, row in existing_videos.items()
+            if row[1] == CHECKPOINT_STATUS and row[2] and row[2].strip()
+        }
+        listed_ids = set()
+
+        def _videos_to_process():
+            nonlocal yt_count
+            for video in videos_from_yt_models:
+                yt_count += 1
+                listed_ids.add(video.video_id)
+                if video.video_id not in existing_videos or video.video_id in checkpointed_transcripts:
+                    yield video
+            # Con l'elenco incrementale un video interrotto può non comparire più tra quelli elencati:
+            # lo ricostruiamo dalla sua riga
+            for video_id in checkpointed_transcripts:
+                if video_id not in listed_ids:
+                    row = existing_videos[video_id]
+                    yield Video(
+                        video_id=video_id, title=row[5], url=row[6], channel_id=channel_id,
+                        published_at=row[7], description=row[8] or ''
+                    )
+
+        videos_to_process_models = _videos_to_process()
+        if isinstance(videos_from_yt_models, (list, tuple)):
+            # Lista già in memoria: il totale è noto da subito
+            videos_to_process_models = list(videos_to_process_models)
+            to_process_count = len(videos_to_process_models)
+        videos_iter = enumerate(videos_to_process_models, 1)
+        first_item = next(videos_iter, None)
+        if checkpointed_transcripts:
+            logger.info(f"[CORE YT Process] Riprendo {len(checkpointed_transcripts)} video interrotti dopo il download della trascrizione.")
+
+        update_status(status_dict, total_videos=to_process_count)
+
+        if first_item is None:
             logger.info("[CORE YT Process] Nessun nuovo video da processare."); overall_success = True
         else:
             chroma_collection_for_upsert = None
-            user_video_collection_name = f"{base_video_collection_name}_{user_id}"
+            user_video_collection_name = get_active_collection_name(base_video_collection_name, user_id, core_config)
             try:
                 chroma_collection_for_upsert = chroma_client_from_core_config.get_or_create_collection(name=user_video_collection_name)
             except Exception as e:
                 logger.error(f"Impossibile creare/accedere alla collezione ChromaDB '{user_video_collection_name}': {e}")
                 raise RuntimeError(f"Errore ChromaDB: {e}")
 
-            youtube_client = YouTubeClient(token_file=token_path)
-
-            for index, video_model in enumerate(videos_to_process_models, 1):
-                video_id = video_model.video_id
-                with status_lock_ui:
-                    status_dict.update({
-                        'current_video': {'title': video_model.title, 'index': index, 'total': to_process_count},
-                        'message': f"Processo video {index}/{to_process_count}: {video_model.title}",
-                        'indeterminate_step': False
-                    })
-
-                transcript_text, transcript_lang, transcript_type = None, None, None
-                current_video_status = 'pending'
-                
-                try:
-                    transcript_result = None
-                    if use_official_api_only:
-                        transcript_result = TranscriptService.get_transcript(video_id, youtube_client=youtube_client)
-                    else:
-                        transcript_result = UnofficialTranscriptService.get_transcript(video_id)
-                        if not transcript_result or transcript_result.get('error'):
-                            if transcript_result and transcript_result.get('error') == 'IP_BLOCKED':
-                                with status_lock_ui: status_dict['message'] = f"⚠️ Blocco IP! Uso API ufficiale... ({index}/{to_process_count})"
-                            transcript_result = TranscriptService.get_transcript(video_id, youtube_client=youtube_client)
-
-                    if transcript_result and not transcript_result.get('error'):
-                        transcript_text, transcript_lang, transcript_type = transcript_result['text'], transcript_result['language'], transcript_result['type']
-                        current_video_status = 'processing_embedding'
+            # Le trascrizioni (attesa di rete) vengono scaricate da un pool che lavora in anticipo
+            # sulla frammentazione e sugli embedding, che restano in ordine in questo thread.
+            transcript_workers = max(1, int(core_config.get('YOUTUBE_TRANSCRIPT_WORKERS', 4) or 1))
+            transcript_limits = _transcript_limits(core_config)
+            thread_state = threading.local()
+            videos_iter = itertools.chain([first_item], videos_iter)
+            pending_transcripts = deque()
+
+            def _submit_ahead():
+                # Al massimo 2 trascrizioni per worker in attesa di essere consumate
+                while len(pending_transcripts) < transcript_workers * 2:
+                    next_item = next(videos_iter, None)
+                    if next_item is None:
+                        return
+                    index_ahead, video_ahead = next_item
+                    if video_ahead.video_id in checkpointed_transcripts:
+                        future = Future() # Trascrizione già salvata al checkpoint: niente rete
+                        future.set_result((checkpointed_transcripts[video_ahead.video_id], False))
                     else:
-                        current_video_status = 'failed_transcript'; transcript_errors += 1
-                        error_msg = transcript_result.get('message', 'Errore recupero trascrizione.') if transcript_result else 'Errore sconosciuto'
-                        logger.error(f"[{video_id}] Fallimento trascrizione: {error_msg}")
+                        future = transcript_pool.submit(_fetch_transcript, video_ahead.video_id, token_path, use_official_api_only, transcript_limits, thread_state)
+                    pending_transcripts.append((index_ahead, video_ahead, future))
+
+            with ThreadPoolExecutor(max_workers=transcript_workers) as transcript_pool:
+                _submit_ahead()
+                while pending_transcripts:
+                    index, video_model, transcript_future = pending_transcripts.popleft()
+                    _submit_ahead()
+                    if index > to_process_count:
+                        # Elenco in streaming: il totale cresce con le pagine arrivate
+                        to_process_count = index + len(pending_transcripts)
+                        update_status(status_dict, total_videos=to_process_count)
+                    video_id = video_model.video_id
+                    update_status(status_dict,
+                        current_video={'title': video_model.title, 'index': index, 'total': to_process_count},
+                        message=f"Processo video {index}/{to_process_count}: {video_model.title}",
+                        indeterminate_step=False
+                    )
+
+                    transcript_text, transcript_lang, transcript_type = None, None, None
+                    current_video_status = 'pending'
+                    chunks = []
+                
+                    try:
+                        transcript_result, ip_blocked = transcript_future.result()
+                        if ip_blocked:
+                            update_status(status_dict, message=f"⚠️ Blocco IP! Uso API ufficiale... ({index}/{to_process_count})")
+
+                        if transcript_result and not transcript_result.get('error'):
+                            transcript_text, transcript_lang, transcript_type = transcript_result['text'], transcript_result['language'], transcript_result['type']
+                            current_video_status = CHECKPOINT_STATUS
+                            if video_id not in checkpointed_transcripts:
+                                _save_video_checkpoint(conn_sqlite, video_model, user_id, transcript_text, transcript_lang, transcript_type, CHECKPOINT_STATUS)
+                        elif transcript_result and transcript_result.get('error') == 'QUOTA_EXCEEDED':
+                            # Niente riga 'failed': il video resta in coda per il prossimo giorno di quota
+                            logger.warning(f"[{video_id}] Quota YouTube esaurita: video rimandato.")
+                            deferred_videos.append(video_model)
+                            continue
+                        else:
+                            current_video_status = 'failed_transcript'; transcript_errors += 1
+                            error_msg = transcript_result.get('message', 'Errore recupero trascrizione.') if transcript_result else 'Errore sconosciuto'
+                            logger.error(f"[{video_id}] Fallimento trascrizione: {error_msg}")
                 
-                    if current_video_status == 'processing_embedding' and transcript_text:
-                        use_agentic_chunking = str(core_config.get('USE_AGENTIC_CHUNKING', 'False')).lower() == 'true'
-                        chunks = []
-
-                        if use_agentic_chunking:
-                            with status_lock_ui:
-                                status_dict['message'] = f"({index}/{to_process_count}) Frammentazione semantica (il processo più lungo)..."
-                                status_dict['indeterminate_step'] = True
-                            try:
-                                chunks = chunk_text_agentically(transcript_text, llm_provider=core_config.get('llm_provider', 'google'), settings=core_config)
-                            except google_exceptions.ResourceExhausted as e:
-                                chunks = []
-                            finally:
-                                with status_lock_ui: status_dict['indeterminate_step'] = False
+                        if current_video_status == CHECKPOINT_STATUS and transcript_text:
+                            use_agentic_chunking = str(core_config.get('USE_AGENTIC_CHUNKING', 'False')).lower() == 'true'
+
+                            if use_agentic_chunking:
+                                update_status(status_dict,
+                                    message=f"({index}/{to_process_count}) Frammentazione semantica (il processo più lungo)...",
+                                    indeterminate_step=True
+                                )
+                                try:
+                                    chunks = chunk_text_agentically(transcript_text, llm_provider=core_config.get('llm_provider', 'google'), settings=core_config)
+                                except google_exceptions.ResourceExhausted as e:
+                                    chunks = []
+                                finally:
+                                    update_status(status_dict, indeterminate_step=False)
                             
-                            if not chunks:
+                                if not chunks:
+                                    chunks = split_text_into_chunks(transcript_text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+                            else:
                                 chunks = split_text_into_chunks(transcript_text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-                        else:
-                            chunks = split_text_into_chunks(transcript_text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
 
-                        if not chunks: current_video_status = 'completed'
+                            if not chunks: current_video_status = 'completed'
                     
-                    elif current_video_status != 'failed_transcript':
-                        current_video_status = 'failed_transcript'; transcript_errors += 1
+                        elif current_video_status != 'failed_transcript':
+                            current_video_status = 'failed_transcript'; transcript_errors += 1
+
+                        if current_video_status == CHECKPOINT_STATUS and chunks and video_id in checkpointed_transcripts \
+                                and _stored_chunk_count(chroma_collection_for_upsert, video_id) == len(chunks):
+                            # L'upsert era già andato a buon fine prima dell'interruzione: manca solo la conferma nel DB
+                            logger.info(f"[{video_id}] Frammenti già presenti in ChromaDB, salto gli embedding.")
+                            current_video_status = 'completed'
 
-                    if current_video_status == 'processing_embedding' and chunks:
-                        with status_lock_ui:
-                            status_dict['message'] = f"({index}/{to_process_count}) Creazione embeddings per '{video_model.title[:30]}...'"
+                        if current_video_status == CHECKPOINT_STATUS and chunks:
+                            update_status(status_dict, message=f"({index}/{to_process_count}) Creazione embeddings per '{video_model.title[:30]}...'")
                         
-                        user_settings_for_embedding = build_full_config_for_background_process(user_id)
-                        embeddings = generate_embeddings(chunks, user_settings=user_settings_for_embedding, task_type=TASK_TYPE_DOCUMENT)
+                            embeddings = generate_embeddings(chunks, user_settings=core_config, task_type=TASK_TYPE_DOCUMENT)
                         
-                        if embeddings and len(embeddings) == len(chunks):
-                            ids = [f"{video_id}_chunk_{i}" for i in range(len(chunks))]
-                            metadatas = [{"video_id": video_id, "channel_id": video_model.channel_id, "video_title": video_model.title, "published_at": str(video_model.published_at), "chunk_index": i, "language": transcript_lang, "caption_type": transcript_type, "user_id": user_id } for i in range(len(chunks))]
-                            chroma_collection_for_upsert.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=chunks)
-                            current_video_status = 'completed'
-                        else:
-                            current_video_status = 'failed_embedding'; embedding_errors += 1
+                            if embeddings and len(embeddings) == len(chunks):
+                                ids = [f"{video_id}_chunk_{i}" for i in range(len(chunks))]
+                                metadatas = [{"video_id": video_id, "channel_id": video_model.channel_id, "video_title": video_model.title, "published_at": str(video_model.published_at), "chunk_index": i, "language": transcript_lang, "caption_type": transcript_type, "user_id": user_id } for i in range(len(chunks))]
+                                add_chunk_offsets(metadatas, transcript_text, chunks)
+                                try:
+                                    ensure_collection_dimension(chroma_collection_for_upsert, embeddings)
+                                    chroma_collection_for_upsert.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=chunks)
+                                    current_video_status = 'completed'
+                                except Exception as e_chroma:
+                                    logger.error(f"[{video_id}] Errore scrittura ChromaDB: {e_chroma}")
+                                    current_video_status = 'failed_chroma_write'; chroma_errors += 1
+                            else:
+                                current_video_status = 'failed_embedding'; embedding_errors += 1
                 
-                except Exception as e_video_proc:
-                    current_video_status = 'failed_processing'; generic_errors += 1
-
-                # Calcola il numero di chunk (se esistono, altrimenti 0)
-                count_chunks = len(chunks) if 'chunks' in locals() and chunks else 0
-                video_data_dict = video_model.model_dump()
-                video_data_dict.update({
-                    'transcript': transcript_text, 
-                    'transcript_language': transcript_lang, 
-                    'captions_type': transcript_type, 
-                    'processing_status': current_video_status, 
-                    'user_id': user_id,
-                    'fragment_count': count_chunks 
-                })
-                processed_videos_data_for_db.append(video_data_dict)
-
-            if processed_videos_data_for_db:
-                # AGGIORNA LA QUERY SQL per includere fragment_count
-                sql_insert = ''' INSERT OR REPLACE INTO videos (video_id, title, url, channel_id, published_at, description, transcript, transcript_language, captions_type, user_id, processing_status, fragment_count, added_at ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP) '''
-                
-                # AGGIORNA I DATI DA INSERIRE aggiungendo vd['fragment_count']
-                data_to_insert = [(vd['video_id'], vd['title'], vd['url'], vd['channel_id'], str(vd['published_at']), vd['description'], vd['transcript'], vd['transcript_language'], vd['captions_type'], vd['user_id'], vd.get('processing_status', 'failed'), vd['fragment_count']) for vd in processed_videos_data_for_db]
-                
-                cursor_sqlite.executemany(sql_insert, data_to_insert)
-
-                # Commit delle modifiche al DB in modo che siano visibili anche da altre connessioni/tests
-                conn_sqlite.commit()
+                    except Exception as e_video_proc:
+                        current_video_status = 'failed_processing'; generic_errors += 1
 
-                # Conta quanti video sono stati salvati con stato 'completed'
-                saved_ok_count = sum(1 for vd in processed_videos_data_for_db if vd.get('processing_status') == 'completed')
+                    # Commit per video: un import interrotto conserva tutti i video già conclusi
+                    count_chunks = len(chunks) if chunks else 0
+                    _save_video_checkpoint(conn_sqlite, video_model, user_id, transcript_text, transcript_lang, transcript_type, current_video_status, count_chunks)
+                    if current_video_status == 'completed':
+                        saved_ok_count += 1
 
-                # Se siamo arrivati qui senza eccezioni, consideriamo il job riuscito
-                overall_success = True
+            if transcript_errors or embedding_errors or chroma_errors or generic_errors:
+                logger.warning(f"[CORE YT Process] Canale {channel_id}: errori trascrizione={transcript_errors}, embedding={embedding_errors}, ChromaDB={chroma_errors}, generici={generic_errors}.")
+            # Se siamo arrivati qui senza eccezioni, consideriamo il job riuscito
+            overall_success = True
 
     
     except Exception as e:
@@ -187,11 +421,51 @@ def _process_youtube_channel_core(channel_id: str, user_id: Optional[str], core_
     finally:
         if conn_sqlite: conn_sqlite.close()
 
-    return {"success": overall_success, "new_videos_processed": saved_ok_count, "total_videos_on_yt": yt_count}
+    return {"success": overall_success, "new_videos_processed": saved_ok_count, "total_videos_on_yt": yt_count, "deferred_videos": deferred_videos}
+
+
+def process_channel_with_backlog(youtube_client: YouTubeClient, channel_id: str, user_id: str, core_config: dict, status_dict: dict, use_official_api_only: bool = False, list_new_videos: bool = True) -> dict:
+    """
+    Un run su un canale: elenca i nuovi video, li unisce alla coda, elabora il lotto che sta nella quota
+    di oggi e lascia il resto in coda per i giorni successivi (lo scheduler la smaltisce da solo).
+    L'elenco arriva a pagine: il primo video viene elaborato mentre le pagine successive si caricano.
+    """
+    db_path = core_config.get('DATABASE_FILE')
+    listing_state, plan_summary = {}, {}
+    video_pages = iter([])
+    if list_new_videos:
+        video_pages = _prefilter_pages(
+            iter_channel_videos(youtube_client, channel_id, user_id, db_path, listing_state),
+            youtube_client, db_path, user_id, channel_id,
+            int(core_config.get('YOUTUBE_SKIP_VIDEOS_SHORTER_THAN_SECONDS', 0) or 0)
+        )
+        # La prima pagina subito: errori di quota o di canale arrivano al chiamante, non al core
+        first_page = next(video_pages, None)
+        if first_page is not None:
+            video_pages = itertools.chain([first_page], video_pages)
+
+    videos_today = stream_channel_plan(db_path, user_id, channel_id, video_pages, use_official_api_only, core_config, plan_summary)
+    if use_official_api_only:
+        # Il lotto giornaliero con l'API ufficiale è piccolo (la quota basta per poche decine di video)
+        videos_today = list(videos_today)
+    result_data = _process_youtube_channel_core(
+        channel_id=channel_id,
+        user_id=user_id,
+        core_config=core_config,
+        videos_from_yt_models=videos_today,
+        status_dict=status_dict,
+        use_official_api_only=use_official_api_only
+    )
+
+    if result_data.get("deferred_videos"):
+        # I rimandati non sono nel DB: restano in coda per il prossimo giorno di quota
+        defer_videos(db_path, user_id, channel_id, result_data["deferred_videos"])
+    result_data["backlog"] = prune_channel_backlog(db_path, user_id, channel_id)
+    result_data["total_videos_on_channel"] = listing_state.get('total_results')
+    return result_data
 
 
 def _background_channel_processing(app_context, channel_url: str, user_id: Optional[str], initial_status: dict, status_dict: dict):
-    status_lock = threading.Lock()
     thread_final_message = "Elaborazione terminata."
     job_success = False
     error_code_to_frontend = None # <-- NUOVA VARIABILE
@@ -229,22 +503,21 @@ def _background_channel_processing(app_context, channel_url: str, user_id: Optio
             if not channel_id_extracted:
                  raise ValueError(f"Impossibile estrarre un Channel ID da '{channel_url}'.")
 
-            videos_list, total_count = youtube_client.get_channel_videos_and_total_count(channel_id_extracted)
-            
-            with status_lock:
-                status_dict['total_videos_on_channel'] = total_count
-
             core_config_dict = build_full_config_for_background_process(user_id)
             
-            result_data = _process_youtube_channel_core(
-                channel_id_extracted, user_id, core_config_dict, videos_list, status_dict, use_official_api_only=False 
+            result_data = process_channel_with_backlog(
+                youtube_client, channel_id_extracted, user_id, core_config_dict, status_dict, use_official_api_only=False
             )
 
+            update_status(status_dict, total_videos_on_channel=result_data.get("total_videos_on_channel"))
             job_success = result_data.get("success", False)
             new_videos_count = result_data.get("new_videos_processed", 0)
+            backlog = result_data.get("backlog", {})
 
             if job_success:
                 thread_final_message = f"Processo completato! Aggiunti {new_videos_count} nuovi video." if new_videos_count > 0 else "Canale già aggiornato. Nessun nuovo video trovato."
+                if backlog.get("queued_videos"):
+                    thread_final_message += f" Altri {backlog['queued_videos']} video sono in coda per la quota YouTube: l'automazione li elaborerà a lotti giornalieri (fine prevista: {backlog['last_day']})."
             else:
                  thread_final_message = "Si sono verificati errori durante il processo. Controllare i log."
 
@@ -15,6 +15,12 @@ import atexit
 from .models.user import User
 from .utils import generate_api_key, format_datetime_filter
 from .core.setup import init_db, setup_chroma_directory, load_credentials, save_credentials
+from .services.rate_limiter.token_bucket import configure_rate_limiter
+from .services.embedding.embedding_cache import configure_embedding_cache
+from .services.chunking.chunk_cache import configure_chunk_cache
+from .services.youtube.quota_ledger import configure_quota_ledger
+from .services.transcripts.youtube_transcript_unofficial_library import configure_transcript_fetcher
+from .services.embedding.model_migration import seed_embedding_model_states
 from .core.system_info import get_system_stats
 
 # --- Import Flask e Correlati ---
@@ -191,6 +197,11 @@ def create_app(config_object=AppConfig):
         # Passa l'oggetto config all'inizializzazione
         init_db(app.config)
         setup_chroma_directory(app.config)
+        configure_rate_limiter(app.config)
+        configure_embedding_cache(app.config)
+        configure_chunk_cache(app.config)
+        configure_quota_ledger(app.config)
+        configure_transcript_fetcher(app.config)
     except Exception as e:
         logger.critical(f"Fallimento inizializzazione DB/Directory: {e}", exc_info=True)
         sys.exit(1)
@@ -206,6 +217,7 @@ def create_app(config_object=AppConfig):
         app.config['CHROMA_VIDEO_COLLECTION'] = None
         app.config['CHROMA_DOC_COLLECTION'] = None
         app.config['CHROMA_ARTICLE_COLLECTION'] = None
+        seed_embedding_model_states(app)
     except Exception as e:
         logger.exception("Errore CRITICO durante inizializzazione ChromaDB.")
         app.config['CHROMA_CLIENT'] = None
@@ -257,6 +269,18 @@ def create_app(config_object=AppConfig):
             )
             logger.info(f"Worker PID {os.getpid()}: Job '{job_id}' definito/aggiornato nella configurazione dello scheduler.")
 
+            # Job separato e frequente per le migrazioni del modello di embedding
+            from .scheduler_jobs import check_embedding_migrations_job
+            app.scheduler.add_job(
+                func=check_embedding_migrations_job,
+                trigger='interval',
+                minutes=max(1, app.config.get('EMBEDDING_MIGRATION_CHECK_MINUTES', 30)),
+                id='check_embedding_migrations_job',
+                name='Migrazione Modello di Embedding',
+                replace_existing=True,
+                misfire_grace_time=300
+            )
+
 
         # 2. SOLO UN worker avvia effettivamente lo scheduler.
         #    Usiamo la stessa logica del lock file di prima.
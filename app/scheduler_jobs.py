@@ -4,16 +4,19 @@ import sqlite3
 import traceback
 # RIMOSSO: from flask import current_app
 from app.utils import build_full_config_for_background_process
+from app.services.youtube.quota_ledger import get_quota_status
 
 # Importa solo le funzioni CORE, non più create_app o AppConfig
 try:
-    from app.core.youtube_processor import _process_youtube_channel_core
+    from app.core.youtube_processor import process_channel_with_backlog
+    from app.core.youtube_backlog import channels_with_backlog
     from .api.routes.rss import _process_rss_feed_core
 except ImportError as e:
     # Gestione fallback nel caso in cui le funzioni non siano ancora disponibili
     logging.critical(f"Errore importazione funzioni CORE in scheduler_jobs: {e}")
-    _process_youtube_channel_core = lambda c, u, cfg: False
-    _process_rss_feed_core = lambda f, u, cfg, s, l: False
+    process_channel_with_backlog = lambda *args, **kwargs: {"success": False}
+    channels_with_backlog = lambda db_path: []
+    _process_rss_feed_core = lambda f, u, cfg, s, l, **kwargs: False
 
 
 logger = logging.getLogger(__name__)
@@ -49,37 +52,45 @@ def check_monitored_sources_job():
             active_channels = cursor.fetchall()
             logger.info(f"Canali YT attivi trovati: {len(active_channels)}")
 
+            # Oltre ai canali monitorati, smaltiamo la coda dei canali grandi importati a mano
+            channel_runs = [(channel['id'], channel['user_id'], channel['channel_id'], True) for channel in active_channels]
+            monitored_pairs = {(user_id, channel_id) for _, user_id, channel_id, _ in channel_runs}
+            channel_runs += [(None, user_id, channel_id, False) for user_id, channel_id in channels_with_backlog(db_path)
+                             if (user_id, channel_id) not in monitored_pairs]
+
             channel_ids_processed = []
-            for channel in active_channels:
-                monitor_id, user_id, channel_id = channel['id'], channel['user_id'], channel['channel_id']
-                logger.info(f"Controllo YT Canale: {channel_id} (User: {user_id})")
+            for monitor_id, user_id, channel_id, list_new_videos in channel_runs:
+                quota = get_quota_status()
+                if quota['remaining'] <= 0:
+                    logger.warning(f"Quota YouTube esaurita per oggi ({quota['usage']}/{quota['limit']} unità): rimando i canali rimanenti a dopo le {quota['resets_at']}.")
+                    break
+                logger.info(f"Quota YouTube residua: {quota['remaining']}/{quota['limit']} unità.")
+                logger.info(f"Controllo YT Canale: {channel_id} (User: {user_id}){'' if list_new_videos else ' - solo coda'}")
                 try:
                     # --- MODIFICA CHIAVE: Costruisci la config completa per QUESTO utente ---
                     full_user_config = build_full_config_for_background_process(user_id)
                     
-                    # Lo scheduler deve prima recuperare la lista dei video
                     from app.services.youtube.client import YouTubeClient
                     token_path = full_user_config.get('TOKEN_PATH')
                     youtube_client = YouTubeClient(token_file=token_path)
-                    videos_list, _ = youtube_client.get_channel_videos_and_total_count(channel_id)
-
-                    # Ora chiama il core con la lista dei video e il nuovo parametro
-                    result_data = _process_youtube_channel_core(
-                        channel_id=channel_id, 
-                        user_id=user_id, 
-                        core_config=full_user_config,
-                        videos_from_yt_models=videos_list,
+
+                    # Nuovi video e coda insieme: elaboriamo il lotto che sta nella quota di oggi
+                    result_data = process_channel_with_backlog(
+                        youtube_client, channel_id, user_id, full_user_config,
                         status_dict={}, # Lo status_dict non serve allo scheduler
-                        use_official_api_only=True 
+                        use_official_api_only=True,
+                        list_new_videos=list_new_videos
                     )
                     
                     if result_data.get("success", False):
-                        channel_ids_processed.append(monitor_id)
-                        logger.info(f"Processo Canale {channel_id} completato.")
+                        if monitor_id is not None:
+                            channel_ids_processed.append(monitor_id)
+                        queued = result_data.get("backlog", {}).get("queued_videos", 0)
+                        logger.info(f"Processo Canale {channel_id} completato.{f' In coda: {queued} video.' if queued else ''}")
                     else:
                         logger.error(f"Fallimento processo core canale {channel_id}.")
                 except Exception as e_ch_proc:
-                    logger.error(f"Errore durante chiamata _process_youtube_channel_core per {channel_id}: {e_ch_proc}\n{traceback.format_exc()}")
+                    logger.error(f"Errore durante l'elaborazione del canale {channel_id}: {e_ch_proc}\n{traceback.format_exc()}")
 
             if channel_ids_processed:
                 placeholders = ','.join('?' * len(channel_ids_processed))
@@ -101,7 +112,7 @@ def check_monitored_sources_job():
                     full_user_config = build_full_config_for_background_process(user_id)
 
                     # Ora passiamo la configurazione completa alla funzione core
-                    success = _process_rss_feed_core(feed_url, user_id, full_user_config, None, None)
+                    success = _process_rss_feed_core(feed_url, user_id, full_user_config, None, None, use_conditional_get=True)
                     if success:
                         feed_ids_processed.append(monitor_id)
                         logger.info(f"Processo Feed {feed_url} completato.")
@@ -123,4 +134,18 @@ def check_monitored_sources_job():
         finally:
             if conn:
                 conn.close()
-                logger.debug("SCHEDULER JOB: Connessione DB chiusa.")
\ No newline at end of file
+                logger.debug("SCHEDULER JOB: Connessione DB chiusa.")
+
+def check_embedding_migrations_job():
+    """
+    Job periodico: avvia la migrazione delle collezioni quando il modello di embedding
+    è cambiato (anche da configurazione del deployment) e riprende quelle interrotte.
+    """
+    logger.info("SCHEDULER JOB (migrazioni embedding): Inizio esecuzione...")
+    from app.main import create_app
+    from app.services.embedding.model_migration import check_embedding_migrations
+    app = create_app()
+    try:
+        check_embedding_migrations(app)
+    except Exception as e_job:
+        logger.error(f"SCHEDULER JOB (migrazioni embedding): Errore imprevisto: {e_job}", exc_info=True)
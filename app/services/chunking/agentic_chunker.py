@@ -2,11 +2,28 @@ import logging
 import json
 import re
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from google.api_core import exceptions as google_exceptions
+from app.services.rate_limiter.token_bucket import acquire, BUCKET_GEMINI, BUCKET_OLLAMA, LANE_BACKGROUND
+from app.services.embedding.gemini_embedding import iter_chunk_spans, iter_sentence_spans, find_chunk_offsets
+from app.services.chunking.chunk_cache import make_chunk_cache_key, load_cached_chunks, store_chunks
 
 logger = logging.getLogger(__name__)
 
+# Da incrementare a ogni modifica del prompt: invalida i chunk salvati in cache
+AGENTIC_CHUNKER_PROMPT_VERSION = "1"
+AGENTIC_CHUNKER_BOUNDARY_PROMPT_VERSION = "1"
+
+# Modalità di output (AGENTIC_CHUNKING_OUTPUT_MODE):
+# - 'boundaries': il testo arriva diviso in frasi numerate e l'LLM restituisce solo gli indici di inizio dei chunk
+# - 'text': l'LLM riscrive ogni chunk per intero (output lungo quanto l'input)
+OUTPUT_MODE_BOUNDARIES = 'boundaries'
+OUTPUT_MODE_TEXT = 'text'
+
+# Oltre questo numero di parole una "frase" senza punteggiatura (tipico delle trascrizioni) viene spezzata
+_MAX_SENTENCE_WORDS = 40
+
 AGENTIC_CHUNKER_PROMPT_TEMPLATE = """
 Sei un assistente esperto nell'analisi di documenti. Il tuo compito è suddividere il testo fornito in sezioni o "chunk" semanticamente coerenti.
 **Istruzioni:**
@@ -24,85 +41,198 @@ Restituisci la tua risposta come un array JSON di stringhe, dove ogni stringa è
 ---
 """
 
+AGENTIC_CHUNKER_BOUNDARY_PROMPT_TEMPLATE = """
+Sei un assistente esperto nell'analisi di documenti. Il testo qui sotto è diviso in frasi numerate. Il tuo compito è raggrupparle in sezioni o "chunk" semanticamente coerenti.
+**Istruzioni:**
+1.  Leggi attentamente tutte le frasi per capire la struttura e gli argomenti principali.
+2.  Un nuovo chunk inizia dove l'argomento principale cambia o dove comincia un nuovo concetto completo.
+3.  Cerca di creare chunk che non siano né troppo corti (inutili) né troppo lunghi (troppo generici). Una buona lunghezza è tra le 150 e le 400 parole, ma la coerenza semantica è più importante della lunghezza.
+**Formato di output:**
+Restituisci SOLO un array JSON di numeri interi in ordine crescente: i numeri delle frasi con cui inizia un nuovo chunk. Non includere la frase 0 (il primo chunk inizia sempre lì) e non riscrivere il testo.
+**Esempio di output corretto:**
+[4, 11, 19]
+**Frasi da raggruppare:**
+---
+{numbered_sentences}
+---
+"""
+
 def chunk_text_agentically(text_to_chunk: str, llm_provider: str, settings: dict) -> list[str]:
     """
     Usa un LLM per suddividere un testo, con logica di fallback intelligente per la selezione del modello.
+    I testi più lunghi di AGENTIC_CHUNKING_WINDOW_WORDS parole vengono divisi in finestre
+    sovrapposte elaborate in parallelo (vedi _chunk_text_in_windows).
     """
     if not text_to_chunk or not text_to_chunk.strip():
         return []
 
-    final_prompt = AGENTIC_CHUNKER_PROMPT_TEMPLATE.format(text_to_chunk=text_to_chunk)
-    raw_llm_response = ""
+    window_words = int(settings.get('AGENTIC_CHUNKING_WINDOW_WORDS', 0) or 0)
+    if window_words > 0 and len(text_to_chunk.split()) > window_words:
+        return _chunk_text_in_windows(text_to_chunk, llm_provider, settings, window_words)
+    return _chunk_single_text(text_to_chunk, llm_provider, settings)
+
+
+def _select_chunking_model(llm_provider: str, settings: dict):
+    """Il modello che farà il chunking: serve sia per la chiamata sia per la chiave della cache."""
+    if llm_provider == 'ollama':
+        return settings.get('llm_model_name')
+    if llm_provider != 'google':
+        return None
+
+    user_models = settings.get('RAG_MODELS_LIST', [])
+    default_models_from_env = settings.get('DEFAULT_RAG_MODELS_LIST_FROM_ENV', [])
+
+    model_to_use = None
+    # Priorità 1: Il modello di ripiego dell'utente (se specificato)
+    if len(user_models) > 1 and user_models[1].strip():
+        model_to_use = user_models[1].strip()
+        logger.info(f"Agentic Chunker: Selezionato modello di ripiego specificato dall'utente: '{model_to_use}'.")
+    # Priorità 2: Il modello di ripiego del sistema (se l'utente ha specificato un solo modello pro)
+    elif len(user_models) == 1 and len(default_models_from_env) > 1 and default_models_from_env[1].strip():
+        model_to_use = default_models_from_env[1].strip()
+        logger.info(f"Agentic Chunker: L'utente ha specificato un solo modello. Uso il fallback di sistema per ottimizzare: '{model_to_use}'.")
+    # Priorità 3: Il primo (e unico) modello dell'utente
+    elif user_models and user_models[0].strip():
+        model_to_use = user_models[0].strip()
+        logger.info(f"Agentic Chunker: Nessun ripiego disponibile. Uso il modello primario dell'utente: '{model_to_use}'.")
+    # Priorità 4: Il primo modello di default del sistema
+    elif default_models_from_env and default_models_from_env[0].strip():
+        model_to_use = default_models_from_env[0].strip()
+        logger.info(f"Agentic Chunker: Nessuna configurazione utente. Uso il modello primario di sistema: '{model_to_use}'.")
+    return model_to_use
+
+
+def _output_mode(settings: dict) -> str:
+    mode = str(settings.get('AGENTIC_CHUNKING_OUTPUT_MODE') or OUTPUT_MODE_BOUNDARIES).strip().lower()
+    return mode if mode in (OUTPUT_MODE_BOUNDARIES, OUTPUT_MODE_TEXT) else OUTPUT_MODE_BOUNDARIES
+
+
+def _chunk_single_text(text_to_chunk: str, llm_provider: str, settings: dict) -> list[str]:
+    """
+    Chunk di un singolo testo (o finestra): prima la cache persistente, poi l'LLM.
+    Vengono salvati solo i risultati non vuoti, così un errore non resta in cache.
+    """
+    model_name = _select_chunking_model(llm_provider, settings)
+    if _output_mode(settings) == OUTPUT_MODE_BOUNDARIES:
+        prompt_version = f"{OUTPUT_MODE_BOUNDARIES}-{AGENTIC_CHUNKER_BOUNDARY_PROMPT_VERSION}"
+    else:
+        prompt_version = AGENTIC_CHUNKER_PROMPT_VERSION
+    cache_key = make_chunk_cache_key(text_to_chunk, llm_provider, model_name or '', prompt_version)
+    cached_chunks = load_cached_chunks(cache_key, text_to_chunk)
+    if cached_chunks is not None:
+        logger.info(f"Agentic Chunker: {len(cached_chunks)} chunk recuperati dalla cache, nessuna chiamata all'LLM.")
+        return cached_chunks
+
+    chunks = _request_llm_chunks(text_to_chunk, llm_provider, model_name, settings)
+    if chunks:
+        store_chunks(cache_key, text_to_chunk, chunks, find_chunk_offsets(text_to_chunk, chunks))
+    return chunks
+
+
+def _call_llm(final_prompt: str, llm_provider: str, model_name, settings: dict):
+    """Invia il prompt al provider e restituisce il testo grezzo della risposta (None se il provider non è supportato)."""
+    if llm_provider == 'ollama':
+        base_url = settings.get('ollama_base_url')
+        if not base_url or not model_name:
+            raise ValueError("URL o nome modello di Ollama non forniti.")
+
+        api_url = base_url.rstrip('/') + "/api/generate"
+        payload = {"model": model_name, "prompt": final_prompt, "stream": False, "format": "json"}
+
+        logger.info(f"Agentic Chunker: Invio richiesta a Ollama (Modello: {model_name})")
+        acquire(BUCKET_OLLAMA, lane=LANE_BACKGROUND)
+        response = requests.post(api_url, json=payload, timeout=180)
+        response.raise_for_status()
+        return response.json().get("response", "")
+
+    if llm_provider == 'google':
+        api_key = settings.get('GOOGLE_API_KEY')
+        if not api_key or not model_name:
+            raise ValueError("API Key di Google o un modello valido non sono stati determinati per il chunking.")
+
+        genai.configure(api_key=api_key)
+
+        logger.info(f"Agentic Chunker: Invio richiesta a Google Gemini (Modello: {model_name})")
+        acquire(BUCKET_GEMINI, lane=LANE_BACKGROUND)
+        model = genai.GenerativeModel(model_name)
+        response = model.generate_content(
+            final_prompt,
+            generation_config=genai.types.GenerationConfig(response_mime_type="application/json")
+        )
+        return response.text
+
+    logger.error(f"Provider LLM non supportato: {llm_provider}")
+    return None
+
+
+def _parse_boundary_response(parsed, sentence_count: int):
+    """
+    Valida gli indici restituiti dall'LLM. Accetta un array di interi (anche come stringhe numeriche)
+    o un oggetto con un solo array (Ollama in modalità JSON tende a restituire oggetti).
+    Restituisce gli indici ordinati senza lo 0, oppure None se la risposta non è utilizzabile.
+    """
+    if isinstance(parsed, dict):
+        lists = [value for value in parsed.values() if isinstance(value, list)]
+        parsed = lists[0] if len(lists) == 1 else None
+    if not isinstance(parsed, list):
+        logger.error("Agentic Chunker: la risposta JSON non è un array di indici.")
+        return None
+
+    breaks = set()
+    for item in parsed:
+        if isinstance(item, str) and item.strip().isdigit():
+            item = int(item.strip())
+        if isinstance(item, bool) or not isinstance(item, int):
+            logger.error(f"Agentic Chunker: indice non valido nella risposta: {item!r}.")
+            return None
+        if item < 0 or item >= sentence_count:
+            logger.error(f"Agentic Chunker: indice {item} fuori intervallo (frasi: {sentence_count}).")
+            return None
+        if item > 0:
+            breaks.add(item)
+    return sorted(breaks)
+
+
+def _request_llm_chunks(text_to_chunk: str, llm_provider: str, model_name, settings: dict) -> list[str]:
+    """
+    Una singola chiamata all'LLM sull'intero testo ricevuto. In modalità 'boundaries' i chunk
+    vengono ricostruiti localmente come porzioni del testo, a partire dagli indici delle frasi.
+    """
+    boundary_mode = _output_mode(settings) == OUTPUT_MODE_BOUNDARIES
+    if boundary_mode:
+        sentence_spans = list(iter_sentence_spans(text_to_chunk, max_words=_MAX_SENTENCE_WORDS))
+        if len(sentence_spans) <= 1:
+            return [text_to_chunk.strip()]
+        numbered_sentences = "\n".join(f"[{i}] {text_to_chunk[start:end]}" for i, (start, end) in enumerate(sentence_spans))
+        final_prompt = AGENTIC_CHUNKER_BOUNDARY_PROMPT_TEMPLATE.format(numbered_sentences=numbered_sentences)
+    else:
+        final_prompt = AGENTIC_CHUNKER_PROMPT_TEMPLATE.format(text_to_chunk=text_to_chunk)
 
     try:
-        if llm_provider == 'ollama':
-            # ... (la logica per Ollama non cambia) ...
-            base_url = settings.get('ollama_base_url')
-            model_name = settings.get('llm_model_name')
-            if not base_url or not model_name:
-                raise ValueError("URL o nome modello di Ollama non forniti.")
-            
-            api_url = base_url.rstrip('/') + "/api/generate"
-            payload = {"model": model_name, "prompt": final_prompt, "stream": False, "format": "json"}
-            
-            logger.info(f"Agentic Chunker: Invio richiesta a Ollama (Modello: {model_name})")
-            response = requests.post(api_url, json=payload, timeout=180)
-            response.raise_for_status()
-            raw_llm_response = response.json().get("response", "")
-
-        elif llm_provider == 'google':
-            api_key = settings.get('GOOGLE_API_KEY')
-            
-            # --- INIZIO NUOVA LOGICA DI SELEZIONE MODELLO ---
-            user_models = settings.get('RAG_MODELS_LIST', [])
-            default_models_from_env = settings.get('DEFAULT_RAG_MODELS_LIST_FROM_ENV', [])
-            
-            model_to_use = None
-            # Priorità 1: Il modello di ripiego dell'utente (se specificato)
-            if len(user_models) > 1 and user_models[1].strip():
-                model_to_use = user_models[1].strip()
-                logger.info(f"Agentic Chunker: Selezionato modello di ripiego specificato dall'utente: '{model_to_use}'.")
-            # Priorità 2: Il modello di ripiego del sistema (se l'utente ha specificato un solo modello pro)
-            elif len(user_models) == 1 and len(default_models_from_env) > 1 and default_models_from_env[1].strip():
-                model_to_use = default_models_from_env[1].strip()
-                logger.info(f"Agentic Chunker: L'utente ha specificato un solo modello. Uso il fallback di sistema per ottimizzare: '{model_to_use}'.")
-            # Priorità 3: Il primo (e unico) modello dell'utente
-            elif user_models and user_models[0].strip():
-                model_to_use = user_models[0].strip()
-                logger.info(f"Agentic Chunker: Nessun ripiego disponibile. Uso il modello primario dell'utente: '{model_to_use}'.")
-            # Priorità 4: Il primo modello di default del sistema
-            elif default_models_from_env and default_models_from_env[0].strip():
-                model_to_use = default_models_from_env[0].strip()
-                logger.info(f"Agentic Chunker: Nessuna configurazione utente. Uso il modello primario di sistema: '{model_to_use}'.")
-            
-            if not api_key or not model_to_use:
-                raise ValueError("API Key di Google o un modello valido non sono stati determinati per il chunking.")
-            # --- FINE NUOVA LOGICA DI SELEZIONE MODELLO ---
-
-            genai.configure(api_key=api_key)
-
-            logger.info(f"Agentic Chunker: Invio richiesta a Google Gemini (Modello: {model_to_use})")
-            model = genai.GenerativeModel(model_to_use)
-            response = model.generate_content(
-                final_prompt,
-                generation_config=genai.types.GenerationConfig(response_mime_type="application/json")
-            )
-            raw_llm_response = response.text
-        
-        else:
-            logger.error(f"Provider LLM non supportato: {llm_provider}")
+        raw_llm_response = _call_llm(final_prompt, llm_provider, model_name, settings)
+        if raw_llm_response is None:
             return []
 
         json_string = re.sub(r'^```json\s*|\s*```$', '', raw_llm_response, flags=re.DOTALL).strip()
-        chunks = json.loads(json_string)
-        
-        if not isinstance(chunks, list) or not all(isinstance(c, str) for c in chunks):
+        parsed = json.loads(json_string)
+
+        if boundary_mode:
+            breaks = _parse_boundary_response(parsed, len(sentence_spans))
+            if breaks is None:
+                return []
+            starts = [0] + breaks
+            ends = [b - 1 for b in breaks] + [len(sentence_spans) - 1]
+            chunks = [text_to_chunk[sentence_spans[a][0]:sentence_spans[b][1]] for a, b in zip(starts, ends)]
+            logger.info(f"Agentic Chunker: {len(sentence_spans)} frasi raggruppate in {len(chunks)} chunk.")
+            return chunks
+
+        if not isinstance(parsed, list) or not all(isinstance(c, str) for c in parsed):
             logger.error("La risposta JSON non è un array di stringhe.")
             return []
-            
-        logger.info(f"Agentic Chunker: Testo suddiviso in {len(chunks)} chunk.")
-        return chunks
-    
+
+        logger.info(f"Agentic Chunker: Testo suddiviso in {len(parsed)} chunk.")
+        return parsed
+
     except google_exceptions.ResourceExhausted as e:
         logger.warning(f"Agentic Chunker: Rilevato rate limit. Lo segnalo allo script chiamante.")
         raise e
@@ -111,4 +241,48 @@ def chunk_text_agentically(text_to_chunk: str, llm_provider: str, settings: dict
         return []
     except Exception as e:
         logger.error(f"Agentic Chunker: Errore finale: {e}", exc_info=True)
-        raise e
\ No newline at end of file
+        raise e
+
+
+def _window_boundaries(text: str, window_start: int, window_end: int, chunks: list[str], settings: dict) -> list[int]:
+    """
+    Posizioni assolute di inizio dei chunk proposti dall'LLM per una finestra.
+    Se nessun chunk è una porzione letterale della finestra, ripiega sulle posizioni del chunking classico.
+    """
+    window_text = text[window_start:window_end]
+    starts = [window_start + span[0] for span in find_chunk_offsets(window_text, chunks) if span]
+    if not starts:
+        logger.warning(f"Agentic Chunker: chunk della finestra {window_start}-{window_end} non ritrovati nel testo. Uso il chunking classico per questa zona.")
+        spans = iter_chunk_spans(window_text, chunk_size=settings.get('DEFAULT_CHUNK_SIZE_WORDS', 300), chunk_overlap=0)
+        starts = [window_start + start for start, _ in spans]
+    return starts
+
+
+def _chunk_text_in_windows(text: str, llm_provider: str, settings: dict, window_words: int) -> list[str]:
+    """
+    Divide il testo in finestre sovrapposte (chiuse a fine frase), le manda all'LLM in parallelo
+    e ricostruisce i chunk dal testo originale. Nelle zone di sovrapposizione valgono i confini
+    della finestra precedente fino a metà zona e quelli della successiva da lì in poi.
+    Il parallelismo è limitato da AGENTIC_CHUNKING_MAX_WORKERS e dal rate limiter del provider.
+    """
+    overlap_words = int(settings.get('AGENTIC_CHUNKING_WINDOW_OVERLAP_WORDS', 200) or 0)
+    max_workers = max(1, int(settings.get('AGENTIC_CHUNKING_MAX_WORKERS', 4) or 1))
+    windows = list(iter_chunk_spans(text, chunk_size=window_words, chunk_overlap=overlap_words))
+    logger.info(f"Agentic Chunker: testo lungo diviso in {len(windows)} finestre da ~{window_words} parole (overlap {overlap_words}, {max_workers} in parallelo).")
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(windows))) as executor:
+        # map conserva l'ordine delle finestre e rilancia la prima eccezione (es. ResourceExhausted)
+        window_chunks = list(executor.map(lambda span: _chunk_single_text(text[span[0]:span[1]], llm_provider, settings), windows))
+
+    boundaries = {windows[0][0]}
+    for i, ((start, end), chunks) in enumerate(zip(windows, window_chunks)):
+        # Regione "di competenza" della finestra: tra i punti medi delle sovrapposizioni con le vicine
+        own_start = start if i == 0 else (start + windows[i - 1][1]) // 2
+        own_end = len(text) if i == len(windows) - 1 else (windows[i + 1][0] + end) // 2
+        boundaries.update(b for b in _window_boundaries(text, start, end, chunks, settings) if own_start <= b < own_end)
+
+    ordered = sorted(boundaries) + [len(text)]
+    final_chunks = [text[a:b].strip() for a, b in zip(ordered, ordered[1:])]
+    final_chunks = [chunk for chunk in final_chunks if chunk]
+    logger.info(f"Agentic Chunker: {len(windows)} finestre riconciliate in {len(final_chunks)} chunk.")
+    return final_chunks
@@ -0,0 +1,119 @@
+# FILE: app/services/chunking/chunk_cache.py
+
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Stato del modulo, impostato da configure_chunk_cache() in create_app.
+# Se non configurato la cache è disattivata e ogni testo viene mandato all'LLM.
+_cache_settings: Dict = {}
+
+
+def configure_chunk_cache(config) -> None:
+    """
+    Prepara il file SQLite con i confini dei chunk già calcolati dal chunker agentico,
+    accanto al DB principale. Un reindex di testi invariati non deve rifare la chiamata all'LLM.
+    """
+    db_file = config.get('DATABASE_FILE')
+    if not db_file:
+        logger.warning("Cache chunking agentico: DATABASE_FILE mancante, cache disattivata.")
+        _cache_settings.clear()
+        return
+
+    db_path = os.path.join(os.path.dirname(db_file), 'agentic_chunk_cache.db')
+    max_age_days = config.get('AGENTIC_CHUNK_CACHE_MAX_AGE_DAYS', 180)
+    _cache_settings.clear()
+    _cache_settings.update({'db_path': db_path, 'max_age_days': max_age_days})
+
+    try:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS agentic_chunk_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    boundaries TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            if max_age_days and max_age_days > 0:
+                cutoff = time.time() - max_age_days * 86400
+                deleted = conn.execute("DELETE FROM agentic_chunk_cache WHERE created_at < ?", (cutoff,)).rowcount
+                if deleted:
+                    logger.info(f"Cache chunking agentico: rimosse {deleted} voci più vecchie di {max_age_days} giorni.")
+            conn.commit()
+        finally:
+            conn.close()
+        logger.info(f"Cache chunking agentico configurata (db={db_path}).")
+    except sqlite3.Error as e:
+        logger.error(f"Cache chunking agentico: impossibile inizializzare {db_path}: {e}. Cache disattivata.")
+        _cache_settings.clear()
+
+
+def make_chunk_cache_key(text: str, provider: str, model_name: str, prompt_version: str) -> str:
+    """Chiave deterministica: stesso testo, provider, modello e versione del prompt danno gli stessi chunk."""
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    raw = f"{provider}|{model_name}|{prompt_version}|{text_hash}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def load_cached_chunks(cache_key: str, text: str) -> Optional[List[str]]:
+    """
+    Ricostruisce i chunk dal testo usando i confini salvati. None se la voce non c'è
+    o non è utilizzabile (in quel caso si rifà la chiamata all'LLM).
+    """
+    if not _cache_settings:
+        return None
+    try:
+        conn = sqlite3.connect(_cache_settings['db_path'], timeout=30)
+        try:
+            row = conn.execute("SELECT boundaries FROM agentic_chunk_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Cache chunking agentico: lettura fallita ({e}). Procedo senza cache.")
+        return None
+    if not row:
+        return None
+
+    try:
+        entry = json.loads(row[0])
+        # Formato compatto: coppie [inizio, fine] sul testo originale
+        if 'spans' in entry:
+            return [text[start:end] for start, end in entry['spans']]
+        # L'LLM ha riformulato qualche chunk: sono stati salvati così come restituiti
+        return list(entry['chunks'])
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Cache chunking agentico: voce {cache_key[:12]} non valida ({e}). La ignoro.")
+        return None
+
+
+def store_chunks(cache_key: str, text: str, chunks: List[str], spans: List[Optional[tuple]]) -> None:
+    """
+    Salva il risultato di una chiamata riuscita. Se ogni chunk è una porzione letterale del testo
+    (spans senza None) salva solo i confini, altrimenti i chunk completi.
+    """
+    if not _cache_settings or not chunks:
+        return
+    if spans and all(spans):
+        entry = {'spans': [[start, end] for start, end in spans]}
+    else:
+        entry = {'chunks': chunks}
+    try:
+        conn = sqlite3.connect(_cache_settings['db_path'], timeout=30)
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO agentic_chunk_cache (cache_key, boundaries, created_at) VALUES (?, ?, ?)",
+                (cache_key, json.dumps(entry), time.time())
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Cache chunking agentico: scrittura fallita ({e}). Il prossimo reindex rifarà la chiamata all'LLM.")
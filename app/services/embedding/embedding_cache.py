@@ -0,0 +1,108 @@
+# FILE: app/services/embedding/embedding_cache.py
+
+import os
+import time
+import hashlib
+import sqlite3
+import logging
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Quanti parametri mettiamo al massimo in una singola query "IN (...)"
+_SQL_IN_CHUNK = 500
+
+# Stato del modulo, impostato da configure_embedding_cache() in create_app.
+# Se non configurato la cache è disattivata e ogni embedding viene richiesto al provider.
+_cache_settings: Dict = {}
+
+
+def configure_embedding_cache(config) -> None:
+    """
+    Prepara il file SQLite che conserva i vettori già calcolati, accanto al DB principale.
+    È separato dal DB principale per non contendere il lock con le transazioni di indicizzazione.
+    """
+    db_file = config.get('DATABASE_FILE')
+    if not db_file:
+        logger.warning("Cache embedding: DATABASE_FILE mancante, cache disattivata.")
+        _cache_settings.clear()
+        return
+
+    db_path = os.path.join(os.path.dirname(db_file), 'embedding_cache.db')
+    max_age_days = config.get('EMBEDDING_CACHE_MAX_AGE_DAYS', 7)
+    _cache_settings.clear()
+    _cache_settings.update({'db_path': db_path, 'max_age_days': max_age_days})
+
+    try:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            # Pulizia: la cache serve a riprendere i lavori interrotti, non a conservare tutto per sempre
+            if max_age_days and max_age_days > 0:
+                cutoff = time.time() - max_age_days * 86400
+                deleted = conn.execute("DELETE FROM embedding_cache WHERE created_at < ?", (cutoff,)).rowcount
+                if deleted:
+                    logger.info(f"Cache embedding: rimossi {deleted} vettori più vecchi di {max_age_days} giorni.")
+            conn.commit()
+        finally:
+            conn.close()
+        logger.info(f"Cache embedding configurata (db={db_path}).")
+    except sqlite3.Error as e:
+        logger.error(f"Cache embedding: impossibile inizializzare {db_path}: {e}. Cache disattivata.")
+        _cache_settings.clear()
+
+
+def make_cache_key(text: str, model_name: str, task_type: str, output_dimensionality: Optional[int] = None) -> str:
+    """Chiave deterministica: stesso testo, modello, task e dimensione danno lo stesso vettore."""
+    raw = f"{model_name}|{task_type}|{output_dimensionality or 0}|{text}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def load_cached_embeddings(cache_keys: List[str]) -> Dict[str, List[float]]:
+    """Restituisce i vettori già presenti in cache per le chiavi richieste."""
+    if not _cache_settings or not cache_keys:
+        return {}
+
+    found = {}
+    unique_keys = list(dict.fromkeys(cache_keys))
+    try:
+        conn = sqlite3.connect(_cache_settings['db_path'], timeout=30)
+        try:
+            for i in range(0, len(unique_keys), _SQL_IN_CHUNK):
+                chunk = unique_keys[i:i + _SQL_IN_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for cache_key, blob in conn.execute(f"SELECT cache_key, vector FROM embedding_cache WHERE cache_key IN ({placeholders})", chunk):
+                    found[cache_key] = array('f', blob).tolist()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Cache embedding: lettura fallita ({e}). Procedo senza cache.")
+        return {}
+    return found
+
+
+def store_embeddings(entries: List[Tuple[str, List[float]]]) -> None:
+    """Salva i vettori di un batch completato, così un nuovo tentativo non li richiede di nuovo."""
+    if not _cache_settings or not entries:
+        return
+    now = time.time()
+    try:
+        conn = sqlite3.connect(_cache_settings['db_path'], timeout=30)
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (cache_key, vector, created_at) VALUES (?, ?, ?)",
+                [(cache_key, array('f', vector).tobytes(), now) for cache_key, vector in entries]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Cache embedding: scrittura fallita ({e}). I vettori di questo batch non saranno riutilizzabili.")
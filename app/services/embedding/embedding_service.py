@@ -1,3 +1,4 @@
+import math
 import logging
 import requests
 from typing import List, Optional
@@ -5,10 +6,85 @@ from flask import current_app
 
 # Importiamo le funzioni che già abbiamo per non riscrivere codice
 from .gemini_embedding import get_gemini_embeddings, TASK_TYPE_QUERY, TASK_TYPE_DOCUMENT
+from app.services.rate_limiter.token_bucket import acquire, BUCKET_OLLAMA, LANE_INTERACTIVE, LANE_BACKGROUND
 
 logger = logging.getLogger(__name__)
 
-def _get_ollama_embeddings(texts: List[str], base_url: str, model_name: str) -> Optional[List[List[float]]]:
+# Chiave dei metadati Chroma in cui ogni collezione registra la dimensione dei suoi vettori
+EMBEDDING_DIMENSION_METADATA_KEY = "embedding_dimension"
+
+
+def get_output_dimensionality(user_settings: dict) -> Optional[int]:
+    """
+    Dimensione ridotta richiesta per gli embedding (impostazione utente o di deployment).
+    Restituisce None se va usata la dimensione piena del modello.
+    """
+    value = user_settings.get('EMBEDDING_OUTPUT_DIMENSIONALITY')
+    if value is None:
+        try:
+            value = current_app.config.get('EMBEDDING_OUTPUT_DIMENSIONALITY')
+        except RuntimeError:
+            value = None # Fuori da un app context
+    try:
+        value = int(value) if value else 0
+    except (ValueError, TypeError):
+        logger.warning(f"EMBEDDING_OUTPUT_DIMENSIONALITY non valida ('{value}'), uso la dimensione piena.")
+        return None
+    return value if value > 0 else None
+
+
+def truncate_and_normalize(embeddings: List[List[float]], dimension: int) -> List[List[float]]:
+    """
+    Riduzione in stile Matryoshka: tiene le prime `dimension` componenti e
+    ri-normalizza a norma unitaria, così la distanza coseno resta confrontabile.
+    """
+    reduced = []
+    for vector in embeddings:
+        head = list(vector[:dimension])
+        norm = math.sqrt(sum(v * v for v in head))
+        reduced.append([v / norm for v in head] if norm > 0 else head)
+    return reduced
+
+
+def ensure_collection_dimension(collection, embeddings: List[List[float]]) -> None:
+    """
+    Registra nei metadati della collezione la dimensione dei vettori al primo inserimento
+    e rifiuta scritture con una dimensione diversa da quella registrata.
+    """
+    if not embeddings:
+        return
+    dimension = len(embeddings[0])
+    metadata = dict(collection.metadata) if isinstance(collection.metadata, dict) else {}
+    recorded = metadata.get(EMBEDDING_DIMENSION_METADATA_KEY)
+    if recorded is None:
+        metadata[EMBEDDING_DIMENSION_METADATA_KEY] = dimension
+        collection.modify(metadata=metadata)
+        logger.info(f"Collezione '{collection.name}': registrata dimensione embedding {dimension}.")
+    elif int(recorded) != dimension:
+        raise ValueError(
+            f"Dimensione embedding {dimension} incompatibile con la collezione '{collection.name}' "
+            f"(registrata: {recorded}). Serve una re-indicizzazione o una migrazione del modello."
+        )
+
+
+def align_query_embedding(query_embedding: List[float], collection) -> Optional[List[float]]:
+    """
+    Adatta il vettore della query alla dimensione registrata nella collezione.
+    Una query più lunga viene troncata e ri-normalizzata; se è più corta non è
+    confrontabile e restituiamo None (la collezione va saltata).
+    """
+    metadata = getattr(collection, 'metadata', None)
+    if not isinstance(metadata, dict) or not metadata.get(EMBEDDING_DIMENSION_METADATA_KEY):
+        return query_embedding # Collezione senza dimensione registrata: nessun adattamento
+    dimension = int(metadata[EMBEDDING_DIMENSION_METADATA_KEY])
+    if len(query_embedding) == dimension:
+        return query_embedding
+    if len(query_embedding) > dimension:
+        return truncate_and_normalize([query_embedding], dimension)[0]
+    logger.warning(f"Query con dimensione {len(query_embedding)} < {dimension} della collezione '{getattr(collection, 'name', '?')}': collezione saltata.")
+    return None
+
+def _get_ollama_embeddings(texts: List[str], base_url: str, model_name: str, lane: str = LANE_BACKGROUND) -> Optional[List[List[float]]]:
     """Genera embeddings per una lista di testi usando un'API Ollama."""
     if not base_url.endswith('/'):
         base_url += '/'
@@ -19,6 +95,7 @@ def _get_ollama_embeddings(texts: List[str], base_url: str, model_name: str) ->
     
     for text in texts:
         payload = {"model": model_name, "prompt": text}
+        acquire(BUCKET_OLLAMA, lane=lane)
         try:
             response = requests.post(api_url, json=payload, timeout=60)
             response.raise_for_status()
@@ -40,16 +117,29 @@ def generate_embeddings(texts: List[str], user_settings: dict, task_type: str =
     Funzione "intelligente" che genera embeddings scegliendo il provider corretto
     (Google o Ollama) in base alle impostazioni dell'utente.
     """
-    llm_provider = user_settings.get('llm_provider')
+    # EMBEDDING_PROVIDER viene dal profilo di embedding attivo dell'utente: durante una migrazione
+    # resta quello del vecchio modello finché le nuove collezioni non sono complete.
+    llm_provider = user_settings.get('EMBEDDING_PROVIDER') or user_settings.get('llm_provider')
     embedding_model_ollama = user_settings.get('llm_embedding_model')
     ollama_base_url = user_settings.get('ollama_base_url')
+    output_dimensionality = get_output_dimensionality(user_settings)
 
     if llm_provider == 'ollama' and embedding_model_ollama and ollama_base_url:
         logger.info(f"Usando Ollama per embedding con il modello: {embedding_model_ollama}")
-        return _get_ollama_embeddings(texts, ollama_base_url, embedding_model_ollama)
+        lane = LANE_INTERACTIVE if task_type == TASK_TYPE_QUERY else LANE_BACKGROUND
+        embeddings = _get_ollama_embeddings(texts, ollama_base_url, embedding_model_ollama, lane=lane)
     else:
         logger.info(f"Usando Google Gemini per embedding.")
         google_api_key = user_settings.get('llm_api_key') or current_app.config.get('GOOGLE_API_KEY')
-        google_embedding_model = current_app.config.get('GEMINI_EMBEDDING_MODEL')
+        google_embedding_model = user_settings.get('GEMINI_EMBEDDING_MODEL') or current_app.config.get('GEMINI_EMBEDDING_MODEL')
         
-        return get_gemini_embeddings(texts, api_key=google_api_key, model_name=google_embedding_model, task_type=task_type)
\ No newline at end of file
+        if output_dimensionality:
+            embeddings = get_gemini_embeddings(texts, api_key=google_api_key, model_name=google_embedding_model, task_type=task_type, output_dimensionality=output_dimensionality)
+        else:
+            embeddings = get_gemini_embeddings(texts, api_key=google_api_key, model_name=google_embedding_model, task_type=task_type)
+
+    # I vettori ridotti dall'API non sono normalizzati e Ollama non sa ridurli:
+    # in entrambi i casi tronchiamo (se serve) e ri-normalizziamo qui.
+    if embeddings and output_dimensionality:
+        embeddings = truncate_and_normalize(embeddings, output_dimensionality)
+    return embeddings
\ No newline at end of file
@@ -1,13 +1,19 @@
 # FILE: app/services/embedding/gemini_embedding.py
 
+import re
+import math
 import logging
-from typing import List, Optional, Tuple, Dict
+from collections import deque
+from typing import List, Optional, Tuple, Dict, Iterator
 import google.generativeai as genai
 import os # Mantenuto per os.environ.get() nel caso serva altrove, ma non in queste funzioni
 import time
 from google.api_core import exceptions as google_exceptions
 # Importa current_app qui SOLO per l'helper get_gemini_embeddings
 from flask import current_app
+from app.services.rate_limiter.token_bucket import acquire, RateLimitTimeout, BUCKET_GEMINI, LANE_INTERACTIVE, LANE_BACKGROUND
+from app.services.embedding.embedding_cache import make_cache_key, load_cached_embeddings, store_embeddings
+from app.services.embedding.token_budget import get_embedding_limits, split_by_tokens, pack_batches
 
 logger = logging.getLogger(__name__)
 
@@ -15,18 +21,25 @@ logger = logging.getLogger(__name__)
 TASK_TYPE_DOCUMENT = "retrieval_document"
 TASK_TYPE_QUERY = "retrieval_query"
 
+# Modelli Gemini addestrati in stile Matryoshka che accettano 'output_dimensionality'.
+# Per gli altri chiediamo la dimensione piena e tronchiamo localmente.
+GEMINI_MODELS_WITH_REDUCED_DIMENSIONS = ("gemini-embedding", "text-embedding-004", "text-embedding-005")
+
+
+def gemini_model_supports_output_dimensionality(model_name: str) -> bool:
+    """True se il modello Gemini accetta il parametro output_dimensionality."""
+    return bool(model_name) and any(marker in model_name for marker in GEMINI_MODELS_WITH_REDUCED_DIMENSIONS)
+
 
 # --- Funzione di Chunking (NON usa current_app) ---
-def split_text_into_chunks(
-    text: str,
-    chunk_size: int = 300,  # Default fisso se non passato
-    chunk_overlap: int = 50 # Default fisso se non passato
-) -> List[str]:
-    """
-    Divide un testo lungo in chunk più piccoli basandosi su parole.
-    Usa i valori di chunk_size e chunk_overlap passati come argomenti.
-    """
-    # Validazione input (usa i valori passati o i default della funzione)
+_WORD_RE = re.compile(r"\S+")
+_SENTENCE_TERMINATORS = ".!?…"
+_SENTENCE_CLOSERS = "\"'”’»)]"
+# Un chunk può accorciarsi fino a questa frazione di chunk_size per finire a fine frase
+_SENTENCE_SNAP_MIN_FRACTION = 0.8
+
+def _validate_chunk_params(chunk_size: int, chunk_overlap: int) -> Tuple[int, int]:
+    """Corregge chunk_size e chunk_overlap non validi con gli stessi default di sempre."""
     if not isinstance(chunk_size, int) or chunk_size <= 0:
         logger.warning(f"Chunk size non valido ({chunk_size}), uso default 300.")
         chunk_size = 300
@@ -36,35 +49,142 @@ def split_text_into_chunks(
     if chunk_overlap >= chunk_size:
         logger.warning(f"Chunk overlap ({chunk_overlap}) >= chunk size ({chunk_size}). Imposto overlap a {chunk_size // 3}.")
         chunk_overlap = chunk_size // 3
+    return chunk_size, chunk_overlap
 
-    if not text: return []
-    words = text.split()
-    if len(words) <= chunk_size: return [text]
 
-    chunks = []
-    start_index = 0
-    step = chunk_size - chunk_overlap
-    step = max(1, step) # Assicura avanzamento minimo
+def _ends_sentence(text: str, word_end: int) -> bool:
+    """True se la parola che termina in word_end chiude una frase (ignorando virgolette e parentesi finali)."""
+    i = word_end - 1
+    while i >= 0 and text[i] in _SENTENCE_CLOSERS:
+        i -= 1
+    return i >= 0 and text[i] in _SENTENCE_TERMINATORS
 
-    while start_index < len(words):
-        end_index = min(start_index + chunk_size, len(words))
-        chunks.append(" ".join(words[start_index:end_index]))
-        start_index += step
 
-    logger.info(f"Diviso testo ({len(words)} parole) in {len(chunks)} chunk (size={chunk_size}, overlap={chunk_overlap}).")
+def iter_chunk_spans(
+    text: str,
+    chunk_size: int = 300,
+    chunk_overlap: int = 50,
+    snap_to_sentence: bool = True
+) -> Iterator[Tuple[int, int]]:
+    """
+    Generatore di intervalli (start_char, end_char) sul testo originale, senza copiarlo.
+    Ogni intervallo contiene al massimo chunk_size parole; con snap_to_sentence il chunk
+    termina, se possibile, alla fine di una frase nell'ultimo quinto della finestra.
+    In memoria resta solo la finestra di posizioni delle parole del chunk corrente.
+    """
+    chunk_size, chunk_overlap = _validate_chunk_params(chunk_size, chunk_overlap)
+    if not text:
+        return
+
+    words = _WORD_RE.finditer(text)
+    window = deque() # (start, end) delle parole del chunk corrente
+    exhausted = False
+    min_snapped_words = max(chunk_overlap + 1, int(chunk_size * _SENTENCE_SNAP_MIN_FRACTION))
+
+    while True:
+        while len(window) < chunk_size and not exhausted:
+            match = next(words, None)
+            if match is None:
+                exhausted = True
+            else:
+                window.append(match.span())
+        if not window:
+            return
+
+        end_count = len(window)
+        if snap_to_sentence and len(window) == chunk_size:
+            for count in range(len(window), min_snapped_words - 1, -1):
+                if _ends_sentence(text, window[count - 1][1]):
+                    end_count = count
+                    break
+
+        yield window[0][0], window[end_count - 1][1]
+
+        if exhausted and end_count == len(window):
+            return
+        for _ in range(max(1, end_count - chunk_overlap)):
+            window.popleft()
+
+
+def iter_sentence_spans(text: str, max_words: int = 40) -> Iterator[Tuple[int, int]]:
+    """
+    Intervalli (start_char, end_char) delle frasi del testo. Una frase finisce con la punteggiatura
+    di fine frase o con una riga vuota; le trascrizioni senza punteggiatura vengono
+    spezzate ogni max_words parole, così nessuna "frase" diventa l'intero testo.
+    """
+    sentence_start = None
+    previous_end = 0
+    word_count = 0
+    for match in _WORD_RE.finditer(text):
+        if sentence_start is not None and text.count('\n', previous_end, match.start()) >= 2:
+            yield sentence_start, previous_end
+            sentence_start = None
+        if sentence_start is None:
+            sentence_start, word_count = match.start(), 0
+        word_count += 1
+        previous_end = match.end()
+        if _ends_sentence(text, previous_end) or word_count >= max_words:
+            yield sentence_start, previous_end
+            sentence_start = None
+    if sentence_start is not None:
+        yield sentence_start, previous_end
+
+
+def split_text_into_chunks(
+    text: str,
+    chunk_size: int = 300,  # Default fisso se non passato
+    chunk_overlap: int = 50 # Default fisso se non passato
+) -> List[str]:
+    """
+    Divide un testo lungo in chunk più piccoli basandosi su parole.
+    Usa i valori di chunk_size e chunk_overlap passati come argomenti.
+    I chunk sono porzioni del testo originale (vedi iter_chunk_spans).
+    """
+    chunks = [text[start:end] for start, end in iter_chunk_spans(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)]
+    if len(chunks) > 1:
+        logger.info(f"Diviso testo ({len(text)} caratteri) in {len(chunks)} chunk (size={chunk_size}, overlap={chunk_overlap}).")
     return chunks
 
 
+def find_chunk_offsets(text: str, chunks: List[str]) -> List[Optional[Tuple[int, int]]]:
+    """
+    Ritrova la posizione (start_char, end_char) di ogni chunk nel testo originale.
+    None per i chunk che non sono porzioni letterali del testo (es. riscritti dall'LLM).
+    """
+    offsets = []
+    cursor = 0
+    for chunk in chunks:
+        position = text.find(chunk, cursor) if chunk else -1
+        if position < 0:
+            offsets.append(None)
+            continue
+        offsets.append((position, position + len(chunk)))
+        cursor = position + 1 # I chunk successivi possono sovrapporsi a questo
+    return offsets
+
+
+def add_chunk_offsets(metadatas: List[Dict], text: str, chunks: List[str]) -> List[Dict]:
+    """Aggiunge start_char/end_char ai metadati dei chunk (utili per evidenziare la fonte)."""
+    for metadata, span in zip(metadatas, find_chunk_offsets(text, chunks)):
+        if span:
+            metadata['start_char'], metadata['end_char'] = span
+    return metadatas
+
+
 # --- Servizio Embedding (Riceve config all'init) ---
 class GeminiEmbeddingService:
     """Servizio per generare embedding usando Gemini API."""
 
-    def __init__(self, api_key: str, model_name: str): # Riceve config
-        """Inizializza con API Key e nome modello forniti."""
+    def __init__(self, api_key: str, model_name: str, limits: Optional[Dict] = None): # Riceve config
+        """
+        Inizializza con API Key e nome modello forniti.
+        limits: testi e token per richiesta (vedi token_budget.get_embedding_limits).
+        """
         if not api_key: raise ValueError("API Key is required for GeminiEmbeddingService.")
         if not model_name: raise ValueError("Model name is required for GeminiEmbeddingService.")
 
         self.model_name = model_name
+        self.limits = limits or get_embedding_limits()
         self.api_key = api_key # Potrebbe servire salvarla se genai.configure non è globale
 
         try:
@@ -76,65 +196,136 @@ class GeminiEmbeddingService:
             logger.exception("Errore configurazione client Google Generative AI.")
             raise
 
-    def get_embeddings(self, texts: List[str], task_type: Optional[str] = None) -> Optional[List[List[float]]]:
-        """Genera embeddings usando il modello configurato."""
+    def get_embeddings(self, texts: List[str], task_type: Optional[str] = None, output_dimensionality: Optional[int] = None) -> Optional[List[List[float]]]:
+        """
+        Genera embeddings usando il modello configurato.
+        Se output_dimensionality è indicato (e il modello lo supporta) chiede all'API vettori ridotti.
+        Restituisce None se anche un solo batch fallisce: i batch riusciti restano però
+        in cache e un nuovo tentativo richiederà solo quelli mancanti.
+        """
+        progress = self.get_embeddings_with_progress(texts, task_type=task_type, output_dimensionality=output_dimensionality)
+        if progress['completed'] == progress['total']:
+            return progress['embeddings']
+        logger.error(f"Embedding incompleti: {progress['completed']}/{progress['total']} testi pronti. "
+                     f"Il prossimo tentativo riprenderà dai batch mancanti.")
+        return None
+
+    def get_embeddings_with_progress(self, texts: List[str], task_type: Optional[str] = None, output_dimensionality: Optional[int] = None) -> Dict:
+        """
+        Come get_embeddings, ma non butta via il lavoro fatto: restituisce un dizionario
+        {'embeddings': [...], 'completed': n, 'total': m} dove i testi non ancora
+        elaborati hanno None al posto del vettore. Ogni batch riuscito viene salvato in cache
+        (tranne per le query di ricerca).
+        """
+        if output_dimensionality and not gemini_model_supports_output_dimensionality(self.model_name):
+            logger.info(f"Il modello {self.model_name} non supporta output_dimensionality: richiedo la dimensione piena.")
+            output_dimensionality = None
+        extra_args = {'output_dimensionality': output_dimensionality} if output_dimensionality else {}
+
         if task_type is None: task_type = TASK_TYPE_DOCUMENT
         if task_type not in [TASK_TYPE_DOCUMENT, TASK_TYPE_QUERY]:
              logger.warning(f"Task type '{task_type}' non riconosciuto, uso '{TASK_TYPE_DOCUMENT}'.")
              task_type = TASK_TYPE_DOCUMENT
-        if not texts: return []
+        if not texts: return {'embeddings': [], 'completed': 0, 'total': 0}
 
-        embeddings = []
         retries = 5
         delay = 10
 
-        logger.info(f"Tentativo generazione embedding per {len(texts)} testi con modello {self.model_name}...")
+        # Le query di ricerca arrivano da un utente in attesa: corsia prioritaria
+        lane = LANE_INTERACTIVE if task_type == TASK_TYPE_QUERY else LANE_BACKGROUND
+
+        # Riprendiamo da dove eravamo rimasti: i vettori già calcolati non vengono richiesti di nuovo.
+        # Solo per l'indicizzazione: le query sono una tantum e non devono scrivere su disco durante la ricerca.
+        use_cache = task_type != TASK_TYPE_QUERY
+        cache_keys = [make_cache_key(text, self.model_name, task_type, output_dimensionality) for text in texts] if use_cache else []
+        cached = load_cached_embeddings(cache_keys) if use_cache else {}
+        embeddings = [cached.get(key) for key in cache_keys] if use_cache else [None] * len(texts)
+        missing_indices = [i for i, vector in enumerate(embeddings) if vector is None]
+        if len(missing_indices) < len(texts):
+            logger.info(f"Ripresa embedding: {len(texts) - len(missing_indices)}/{len(texts)} testi già in cache.")
+
+        # I testi oltre il limite di token per testo vengono divisi in porzioni; il vettore del testo
+        # è la media (ri-normalizzata) dei vettori delle porzioni, pesata per numero di token
+        pieces = [] # (indice del testo, porzione, token)
+        for idx in missing_indices:
+            for piece_text, piece_tokens in split_by_tokens(texts[idx], self.limits['max_text_tokens']):
+                pieces.append((idx, piece_text, piece_tokens))
+        pieces_per_text = {}
+        for idx, _, _ in pieces:
+            pieces_per_text[idx] = pieces_per_text.get(idx, 0) + 1
+        split_count = sum(1 for count in pieces_per_text.values() if count > 1)
+        if split_count:
+            logger.info(f"{split_count} testi oltre {self.limits['max_text_tokens']} token divisi in porzioni prima dell'invio.")
 
-        for i, text_batch in enumerate(self._batch_texts(texts)):
-            logger.debug(f"Processo batch {i+1}/{ (len(texts) + 99) // 100 }...")
+        batches = pack_batches([tokens for _, _, tokens in pieces], self.limits['max_items'], self.limits['max_batch_tokens'])
+        logger.info(f"Tentativo generazione embedding per {len(missing_indices)} testi con modello {self.model_name} ({len(batches)} richieste)...")
+        total_batches = len(batches)
+        piece_vectors = {} # indice del testo -> [(vettore, token)] delle porzioni già pronte
+
+        for i, piece_batch in enumerate(batches):
+            logger.debug(f"Processo batch {i+1}/{total_batches}...")
+            text_batch = [pieces[p][1] for p in piece_batch]
             batch_embeddings = None # Inizializza per controllo
             for attempt in range(retries):
+                acquire(BUCKET_GEMINI, lane=lane)
                 try:
                     result = genai.embed_content(
                         model=self.model_name, # Usa il modello salvato nell'istanza
                         content=text_batch,
-                        task_type=task_type
+                        task_type=task_type,
+                        **extra_args
                     )
                     batch_embeddings = result.get('embedding', [])
-                    if batch_embeddings:
+                    if batch_embeddings and len(batch_embeddings) == len(text_batch):
                         logger.debug(f"Ottenuti {len(batch_embeddings)} embedding per il batch {i+1}.")
                         break # Successo per questo batch
                     else:
-                        logger.error("Risposta API embed_content non valida (manca 'embedding') per batch %d.", i+1)
-                        if attempt == retries - 1: logger.error(f"Fallimento persistente batch {i+1}."); return None
-                        else: time.sleep(delay); delay *= 1.5
+                        logger.error("Risposta API embed_content non valida (embedding mancanti o incompleti) per batch %d.", i+1)
+                        batch_embeddings = None
+                        if attempt < retries - 1: time.sleep(delay); delay *= 1.5
 
                 except google_exceptions.ResourceExhausted as e:
                     logger.warning(f"Rate limit API (batch {i+1}, tentativo {attempt + 1}/{retries}). Attesa {int(delay)}s...")
                     time.sleep(delay); delay *= 1.5
-                    if attempt == retries - 1: logger.error(f"Rate limit superato dopo {retries} tentativi per batch {i+1}."); return None
+                    if attempt == retries - 1: logger.error(f"Rate limit superato dopo {retries} tentativi per batch {i+1}.")
                 except Exception as e:
                     logger.exception(f"Errore imprevisto chiamata embed_content (batch {i+1}, tentativo {attempt + 1}/{retries}).")
                     time.sleep(delay); delay *= 1.5
-                    if attempt == retries - 1: logger.error(f"Errore API/rete persistente dopo {retries} tentativi per batch {i+1}."); return None
+                    if attempt == retries - 1: logger.error(f"Errore API/rete persistente dopo {retries} tentativi per batch {i+1}.")
             # Fine ciclo retry
             if not batch_embeddings: # Se tutti i tentativi sono falliti e non abbiamo embeddings
-                 logger.error(f"Tutti i {retries} tentativi di retry falliti per batch {i+1}. Interruzione.")
-                 return None
-            embeddings.extend(batch_embeddings) # Aggiungi il batch valido alla lista totale
+                 logger.error(f"Tutti i {retries} tentativi di retry falliti per batch {i+1}. Interruzione (i batch precedenti restano salvati).")
+                 break
+
+            completed_now = []
+            for p, vector in zip(piece_batch, batch_embeddings):
+                idx, _, piece_tokens = pieces[p]
+                piece_vectors.setdefault(idx, []).append((vector, piece_tokens))
+                if len(piece_vectors[idx]) == pieces_per_text[idx]:
+                    embeddings[idx] = _combine_piece_vectors(piece_vectors.pop(idx))
+                    completed_now.append(idx)
+            if use_cache:
+                store_embeddings([(cache_keys[idx], embeddings[idx]) for idx in completed_now])
 
-        # Verifica finale
-        if len(embeddings) == len(texts):
+        completed = sum(1 for vector in embeddings if vector is not None)
+        if completed == len(texts):
             logger.info(f"Generazione embedding completata con successo per {len(texts)} testi.")
-            return embeddings
-        else:
-             logger.error(f"Errore finale: numero embedding ({len(embeddings)}) != numero testi ({len(texts)}).")
-             return None
+        return {'embeddings': embeddings, 'completed': completed, 'total': len(texts)}
+
 
-    def _batch_texts(self, texts: List[str], batch_size: int = 100) -> List[List[str]]:
-        """Divide la lista di testi in batch."""
-        for i in range(0, len(texts), batch_size):
-            yield texts[i:i + batch_size]
+def _combine_piece_vectors(piece_vectors: List[Tuple[List[float], int]]) -> List[float]:
+    """Vettore unico per un testo diviso in porzioni: media pesata per token, ri-normalizzata."""
+    if len(piece_vectors) == 1:
+        return piece_vectors[0][0]
+    total_weight = sum(max(1, tokens) for _, tokens in piece_vectors)
+    dimension = len(piece_vectors[0][0])
+    combined = [0.0] * dimension
+    for vector, tokens in piece_vectors:
+        weight = max(1, tokens) / total_weight
+        for k in range(dimension):
+            combined[k] += vector[k] * weight
+    norm = math.sqrt(sum(v * v for v in combined))
+    return [v / norm for v in combined] if norm > 0 else combined
 
 
 # --- Funzione Helper (Modificata per ACCETTARE config e passarla) ---
@@ -142,7 +333,8 @@ def get_gemini_embeddings(
     texts: List[str],
     api_key: str,      
     model_name: str,   
-    task_type: Optional[str] = None
+    task_type: Optional[str] = None,
+    output_dimensionality: Optional[int] = None
 ) -> Optional[List[List[float]]]:
     """
     Helper per ottenere embedding. Richiede api_key e model_name espliciti.
@@ -157,7 +349,9 @@ def get_gemini_embeddings(
         # Crea istanza del servizio PASSANDO la config ricevuta
         service = GeminiEmbeddingService(api_key=api_key, model_name=model_name)
         # Chiama il metodo dell'istanza creata
-        return service.get_embeddings(texts, task_type=task_type)
+        return service.get_embeddings(texts, task_type=task_type, output_dimensionality=output_dimensionality)
+    except RateLimitTimeout:
+        raise # Il chiamante interattivo deve poter rispondere con un 429
     except (ValueError, RuntimeError, Exception) as e: # Cattura errori creazione servizio o embedding
         # Logga l'errore completo per debug
         logger.error(f"Fallimento in get_gemini_embeddings: {e}", exc_info=True)
@@ -0,0 +1,581 @@
+# FILE: app/services/embedding/model_migration.py
+
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from flask import current_app
+
+from .embedding_service import generate_embeddings, get_output_dimensionality, ensure_collection_dimension, EMBEDDING_DIMENSION_METADATA_KEY
+from .gemini_embedding import TASK_TYPE_DOCUMENT
+
+logger = logging.getLogger(__name__)
+
+# Stati della migrazione registrati in embedding_model_state
+STATUS_IDLE = 'idle'
+STATUS_PENDING = 'pending'
+STATUS_MIGRATING = 'migrating'
+STATUS_FAILED = 'failed'
+
+# Una migrazione "in corso" senza avanzamenti da questo tempo è considerata orfana
+# (processo terminato) e può essere ripresa da un altro worker o dallo scheduler.
+_STALE_MIGRATION_MINUTES = 15
+
+_BASE36_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# Metadato dei frammenti copiati nelle collezioni ombra: impronta del testo e dei metadati
+# di origine, per accorgersi dei contenuti re-indicizzati (stessi ID) durante la migrazione.
+MIGRATION_FINGERPRINT_KEY = "migration_source_fingerprint"
+
+# Utenti con una migrazione attiva in questo processo
+_running_migrations = set()
+_running_lock = threading.Lock()
+
+
+class _MigrationCancelled(Exception):
+    """La migrazione in corso è stata sostituita o annullata (l'utente ha cambiato di nuovo modello)."""
+
+
+def get_collection_base_names(config) -> List[str]:
+    """Nomi base di tutte le collezioni Chroma di un utente."""
+    return [
+        config.get('VIDEO_COLLECTION_NAME', 'video_transcripts'),
+        config.get('DOCUMENT_COLLECTION_NAME', 'document_content'),
+        config.get('ARTICLE_COLLECTION_NAME', 'article_content'),
+        "page_content",
+    ]
+
+
+def user_collection_name(base_name: str, user_id: str, suffix: str = '') -> str:
+    """Nome fisico della collezione. Senza suffisso è il nome storico '<base>_<user_id>'."""
+    return f"{base_name}_{user_id}_{suffix}" if suffix else f"{base_name}_{user_id}"
+
+
+def get_embedding_profile(config) -> Dict:
+    """
+    Provider, modello e dimensione che generate_embeddings userebbe con questa configurazione.
+    Due profili diversi producono vettori non confrontabili tra loro.
+    """
+    provider = config.get('EMBEDDING_PROVIDER') or config.get('llm_provider') or 'google'
+    if provider == 'ollama' and config.get('llm_embedding_model') and config.get('ollama_base_url'):
+        profile = {'provider': 'ollama', 'model': config.get('llm_embedding_model'), 'base_url': config.get('ollama_base_url')}
+    else:
+        profile = {'provider': 'google', 'model': config.get('GEMINI_EMBEDDING_MODEL')}
+    profile['dimension'] = get_output_dimensionality(config) or 0
+    return profile
+
+
+def same_embedding_model(profile_a: Optional[Dict], profile_b: Optional[Dict]) -> bool:
+    """Confronta due profili ignorando i dettagli che non cambiano i vettori (es. l'URL di Ollama)."""
+    if not profile_a or not profile_b:
+        return False
+    keys = ('provider', 'model', 'dimension')
+    return all((profile_a.get(k) or 0) == (profile_b.get(k) or 0) for k in keys)
+
+
+def apply_embedding_profile(config, profile: Dict, suffix: str) -> Dict:
+    """Restituisce una copia della configurazione che genera embedding con `profile` e scrive nelle collezioni con `suffix`."""
+    overlaid = dict(config)
+    overlaid['EMBEDDING_PROVIDER'] = profile.get('provider')
+    if profile.get('provider') == 'ollama':
+        overlaid['llm_embedding_model'] = profile.get('model')
+        if profile.get('base_url'):
+            overlaid['ollama_base_url'] = profile['base_url']
+    else:
+        overlaid['GEMINI_EMBEDDING_MODEL'] = profile.get('model')
+    overlaid['EMBEDDING_OUTPUT_DIMENSIONALITY'] = profile.get('dimension') or 0
+    overlaid['EMBEDDING_COLLECTION_SUFFIX'] = suffix or ''
+    return overlaid
+
+
+def get_embedding_model_state(db_path: str, user_id: str) -> Optional[Dict]:
+    """Legge lo stato del modello di embedding dell'utente. None se l'utente non ne ha ancora uno."""
+    if not db_path or not user_id:
+        return None
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM embedding_model_state WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        state = dict(row)
+        state['active_profile'] = json.loads(state['active_profile'])
+        state['target_profile'] = json.loads(state['target_profile']) if state.get('target_profile') else None
+        return state
+    except Exception as e:
+        logger.warning(f"Stato modello embedding non leggibile per l'utente {user_id}: {e}. Uso le impostazioni correnti.")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+
+def apply_active_embedding_state(config, user_id: str) -> Dict:
+    """
+    Sovrappone alla configurazione il profilo di embedding ATTIVO dell'utente.
+    Durante una migrazione ricerca e indicizzazione continuano così a usare il vecchio
+    modello e le vecchie collezioni, finché quelle ombra non sono complete.
+    """
+    state = get_embedding_model_state(config.get('DATABASE_FILE'), user_id)
+    if not state:
+        overlaid = dict(config)
+        overlaid['EMBEDDING_COLLECTION_SUFFIX'] = ''
+        return overlaid
+    return apply_embedding_profile(config, state['active_profile'], state['active_suffix'])
+
+
+def get_active_collection_name(base_name: str, user_id: str, config) -> str:
+    """Nome della collezione attiva: usa il suffisso già risolto nella configurazione, altrimenti lo legge dal DB."""
+    suffix = config.get('EMBEDDING_COLLECTION_SUFFIX')
+    if suffix is None:
+        state = get_embedding_model_state(config.get('DATABASE_FILE'), user_id)
+        suffix = state['active_suffix'] if state else ''
+    return user_collection_name(base_name, user_id, suffix)
+
+
+def _new_collection_suffix() -> str:
+    # Suffisso breve (i nomi Chroma hanno un limite di lunghezza e lo user_id è già un UUID)
+    value, digits = int(time.time()), ''
+    while value:
+        value, remainder = divmod(value, 36)
+        digits = _BASE36_ALPHABET[remainder] + digits
+    return f"m{digits}"
+
+
+def _drop_collections(chroma_client, user_id: str, bases: List[str], suffix: str) -> None:
+    for base_name in bases:
+        name = user_collection_name(base_name, user_id, suffix)
+        try:
+            chroma_client.delete_collection(name=name)
+            logger.info(f"Migrazione embedding: collezione '{name}' eliminata.")
+        except Exception:
+            pass # Collezione mai creata
+
+
+def _recorded_collection_dimension(chroma_client, user_id: str, bases: List[str]) -> Optional[int]:
+    """Dimensione dei vettori nelle collezioni storiche dell'utente: dai metadati, altrimenti da un vettore salvato."""
+    if not chroma_client:
+        return None
+    for base_name in bases:
+        collection = _get_collection_or_none(chroma_client, user_collection_name(base_name, user_id))
+        if collection is None:
+            continue
+        metadata = collection.metadata if isinstance(collection.metadata, dict) else {}
+        if metadata.get(EMBEDDING_DIMENSION_METADATA_KEY):
+            return int(metadata[EMBEDDING_DIMENSION_METADATA_KEY])
+        sample = collection.get(limit=1, include=['embeddings'])
+        if sample['ids'] and sample['embeddings'] is not None and len(sample['embeddings']):
+            return len(sample['embeddings'][0])
+    return None
+
+
+def _existing_collections_profile(config, user_id: str, desired: Dict) -> Dict:
+    """
+    Profilo con cui sono state costruite le collezioni di un utente senza stato registrato.
+    Il modello è EMBEDDING_LEGACY_MODEL se indicato, altrimenti quello configurato; la dimensione
+    è quella registrata nelle collezioni quando la configurazione ne chiede una ridotta diversa.
+    Con la dimensione piena (0) non sappiamo quanti valori produce il modello: resta quella richiesta.
+    """
+    baseline = dict(desired)
+    if config.get('EMBEDDING_LEGACY_MODEL'):
+        baseline['model'] = config['EMBEDDING_LEGACY_MODEL']
+    recorded = _recorded_collection_dimension(config.get('CHROMA_CLIENT'), user_id, get_collection_base_names(config))
+    if recorded and desired.get('dimension') and recorded != desired['dimension']:
+        baseline['dimension'] = recorded
+    return baseline
+
+
+def seed_embedding_model_states(app) -> None:
+    """
+    All'avvio registra lo stato del modello per gli utenti che non ne hanno ancora uno, con il profilo
+    delle loro collezioni esistenti (vedi _existing_collections_profile). Così il job dello scheduler
+    confronta le impostazioni correnti con il modello delle collezioni, non con se stesse.
+    """
+    from app.utils import build_full_config_for_background_process
+
+    with app.app_context():
+        db_path = app.config.get('DATABASE_FILE')
+        conn = None
+        try:
+            conn = sqlite3.connect(db_path, timeout=30)
+            user_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM users WHERE id NOT IN (SELECT user_id FROM embedding_model_state)"
+            ).fetchall()]
+            for user_id in user_ids:
+                desired = get_embedding_profile(build_full_config_for_background_process(user_id, apply_embedding_state=False))
+                baseline = _existing_collections_profile(app.config, user_id, desired)
+                conn.execute(
+                    "INSERT OR IGNORE INTO embedding_model_state (user_id, active_suffix, active_profile, status) VALUES (?, '', ?, ?)",
+                    (user_id, json.dumps(baseline), STATUS_IDLE)
+                )
+            conn.commit()
+            if user_ids:
+                logger.info(f"Stato del modello di embedding registrato per {len(user_ids)} utenti.")
+        except Exception as e:
+            logger.error(f"Registrazione iniziale dello stato del modello di embedding fallita: {e}", exc_info=True)
+            if conn: conn.rollback()
+        finally:
+            if conn:
+                conn.close()
+
+
+def request_embedding_migration(user_id: str, previous_profile: Optional[Dict] = None) -> Optional[str]:
+    """
+    Confronta il modello di embedding richiesto dalle impostazioni correnti con quello attivo.
+    Se sono diversi prepara una migrazione verso nuove collezioni ombra e restituisce STATUS_PENDING;
+    se coincidono annulla un'eventuale migrazione non più necessaria e restituisce None.
+    `previous_profile` è il modello con cui sono state costruite le collezioni esistenti, usato
+    solo la prima volta (utenti senza stato registrato); di default lo si ricava dalle collezioni.
+    """
+    from app.utils import build_full_config_for_background_process
+
+    config = current_app.config
+    db_path = config.get('DATABASE_FILE')
+    chroma_client = config.get('CHROMA_CLIENT')
+    desired = get_embedding_profile(build_full_config_for_background_process(user_id, apply_embedding_state=False))
+    bases = get_collection_base_names(config)
+
+    state = get_embedding_model_state(db_path, user_id)
+    conn = None
+    suffix_to_drop = None
+    result = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        cursor = conn.cursor()
+        if state is None:
+            baseline = previous_profile or _existing_collections_profile(config, user_id, desired)
+            cursor.execute(
+                "INSERT OR IGNORE INTO embedding_model_state (user_id, active_suffix, active_profile, status) VALUES (?, '', ?, ?)",
+                (user_id, json.dumps(baseline), STATUS_IDLE)
+            )
+            state = {'active_suffix': '', 'active_profile': baseline, 'target_suffix': None, 'target_profile': None, 'status': STATUS_IDLE}
+
+        if same_embedding_model(desired, state['active_profile']):
+            if state.get('target_suffix'):
+                # L'utente è tornato al modello attivo: la migrazione in corso non serve più
+                cursor.execute("""
+                    UPDATE embedding_model_state
+                    SET target_suffix = NULL, target_profile = NULL, status = ?, last_error = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ?
+                """, (STATUS_IDLE, user_id))
+                suffix_to_drop = state['target_suffix']
+                logger.info(f"Migrazione embedding annullata per l'utente {user_id}: il modello richiesto è già quello attivo.")
+        elif state.get('target_suffix') and same_embedding_model(desired, state.get('target_profile')):
+            result = state['status'] # Migrazione già pianificata verso questo modello
+        else:
+            new_suffix = _new_collection_suffix()
+            cursor.execute("""
+                UPDATE embedding_model_state
+                SET target_suffix = ?, target_profile = ?, status = ?, total_chunks = 0, migrated_chunks = 0,
+                    last_error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            """, (new_suffix, json.dumps(desired), STATUS_PENDING, user_id))
+            suffix_to_drop = state.get('target_suffix')
+            result = STATUS_PENDING
+            logger.info(f"Migrazione embedding pianificata per l'utente {user_id}: {state['active_profile']} -> {desired} (collezioni '_{new_suffix}').")
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Errore DB pianificando la migrazione embedding per l'utente {user_id}: {e}")
+        if conn: conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+    if suffix_to_drop and chroma_client:
+        _drop_collections(chroma_client, user_id, bases, suffix_to_drop)
+    return result
+
+
+def _claim_migration(db_path: str, user_id: str) -> bool:
+    """Segna la migrazione come in corso, solo se nessun altro processo la sta già eseguendo."""
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE embedding_model_state
+            SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND target_suffix IS NOT NULL
+              AND (status IN (?, ?) OR (status = ? AND updated_at < datetime('now', '-{_STALE_MIGRATION_MINUTES} minutes')))
+        """, (STATUS_MIGRATING, user_id, STATUS_PENDING, STATUS_FAILED, STATUS_MIGRATING))
+        conn.commit()
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        logger.error(f"Errore DB avviando la migrazione embedding per l'utente {user_id}: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+
+def start_embedding_migration(app, user_id: str) -> bool:
+    """Avvia in un thread la migrazione pianificata dell'utente. False se non c'è nulla da avviare."""
+    with _running_lock:
+        if user_id in _running_migrations:
+            return False
+        if not _claim_migration(app.config.get('DATABASE_FILE'), user_id):
+            return False
+        _running_migrations.add(user_id)
+
+    def _worker():
+        try:
+            with app.app_context():
+                run_embedding_migration(user_id)
+        finally:
+            with _running_lock:
+                _running_migrations.discard(user_id)
+
+    thread = threading.Thread(target=_worker, name=f"embedding-migration-{user_id}", daemon=True)
+    thread.start()
+    logger.info(f"Thread di migrazione embedding avviato per l'utente {user_id}.")
+    return True
+
+
+def _update_progress(db_path: str, user_id: str, target_suffix: str, total: int, migrated: int) -> None:
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE embedding_model_state
+            SET total_chunks = ?, migrated_chunks = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND target_suffix = ?
+        """, (total, migrated, user_id, target_suffix))
+        conn.commit()
+        if cursor.rowcount == 0:
+            raise _MigrationCancelled()
+    finally:
+        conn.close()
+
+
+def _get_collection_or_none(chroma_client, name: str):
+    try:
+        return chroma_client.get_collection(name=name)
+    except Exception:
+        return None
+
+
+def _chunk_fingerprint(document: Optional[str], metadata: Optional[Dict]) -> str:
+    metadata = {k: v for k, v in (metadata or {}).items() if k != MIGRATION_FINGERPRINT_KEY}
+    payload = json.dumps([document, metadata], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _sync_shadow_collections(chroma_client, user_id: str, bases: List[str], source_suffix: str, target_suffix: str,
+                             target_config: Dict, batch_size: int, db_path: str, final_pass: bool = False) -> int:
+    """
+    Porta le collezioni ombra allo stesso contenuto di quelle attive, ri-calcolando con il nuovo
+    modello (letti direttamente da Chroma, senza ri-chunking) i frammenti mancanti e quelli la cui
+    impronta è cambiata: un contenuto re-indicizzato durante la migrazione mantiene gli stessi ID.
+    Nel passaggio finale (dopo lo switch) non rimuove né aggiorna l'avanzamento, e non tocca i
+    frammenti senza impronta: li ha scritti l'indicizzazione sulle collezioni ormai attive.
+    Restituisce il numero di frammenti copiati.
+    """
+    plan = []
+    total = migrated = 0
+    for base_name in bases:
+        source = _get_collection_or_none(chroma_client, user_collection_name(base_name, user_id, source_suffix))
+        source_data = source.get(include=['documents', 'metadatas']) if source else {'ids': [], 'documents': [], 'metadatas': []}
+        source_fingerprints = {
+            chunk_id: _chunk_fingerprint(document, metadata)
+            for chunk_id, document, metadata in zip(source_data['ids'], source_data['documents'], source_data['metadatas'])
+        }
+        target_name = user_collection_name(base_name, user_id, target_suffix)
+        target = _get_collection_or_none(chroma_client, target_name)
+        if target is None:
+            if not source_fingerprints:
+                continue
+            target = chroma_client.get_or_create_collection(name=target_name)
+        target_data = target.get(include=['metadatas'])
+        target_fingerprints = {
+            chunk_id: (metadata or {}).get(MIGRATION_FINGERPRINT_KEY)
+            for chunk_id, metadata in zip(target_data['ids'], target_data['metadatas'])
+        }
+
+        # Frammenti eliminati dalle collezioni attive mentre la migrazione era in corso
+        stale_ids = set(target_fingerprints) - set(source_fingerprints)
+        if stale_ids and not final_pass:
+            target.delete(ids=list(stale_ids))
+
+        to_copy = []
+        for chunk_id, fingerprint in source_fingerprints.items():
+            if chunk_id not in target_fingerprints:
+                to_copy.append(chunk_id)
+            elif target_fingerprints[chunk_id] != fingerprint and (target_fingerprints[chunk_id] is not None or not final_pass):
+                to_copy.append(chunk_id) # Contenuto re-indicizzato dopo la copia
+        to_copy.sort()
+        total += len(source_fingerprints)
+        migrated += len(source_fingerprints) - len(to_copy)
+        if to_copy:
+            plan.append((source, target, to_copy))
+
+    if not final_pass:
+        _update_progress(db_path, user_id, target_suffix, total, migrated)
+
+    copied = 0
+    for source, target, to_copy in plan:
+        for i in range(0, len(to_copy), batch_size):
+            batch = source.get(ids=to_copy[i:i + batch_size], include=['documents', 'metadatas'])
+            ids, documents, metadatas = batch['ids'], batch['documents'], batch['metadatas']
+            if not ids:
+                continue # Eliminati nel frattempo
+            if any(doc is None for doc in documents):
+                raise RuntimeError(f"Frammenti senza testo in '{source.name}': impossibile ricalcolarne gli embedding.")
+
+            # generate_embeddings usa la corsia "background" del rate limiter: la chat ha sempre la precedenza
+            embeddings = generate_embeddings(documents, user_settings=target_config, task_type=TASK_TYPE_DOCUMENT)
+            if not embeddings or len(embeddings) != len(ids):
+                raise RuntimeError(f"Generazione embedding fallita per {len(ids)} frammenti di '{source.name}'.")
+            ensure_collection_dimension(target, embeddings)
+            # L'impronta è calcolata su quanto appena letto: una modifica successiva verrà vista al prossimo passaggio
+            metadatas = [{**(metadata or {}), MIGRATION_FINGERPRINT_KEY: _chunk_fingerprint(document, metadata)}
+                         for document, metadata in zip(documents, metadatas)]
+            target.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+            copied += len(ids)
+            migrated += len(ids)
+            if not final_pass:
+                _update_progress(db_path, user_id, target_suffix, total, migrated)
+    return copied
+
+
+def _switch_active_collections(db_path: str, user_id: str, target_suffix: str) -> bool:
+    """Rende attive le collezioni ombra con un singolo UPDATE: ricerca e indicizzazione cambiano insieme."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE embedding_model_state
+            SET active_suffix = target_suffix, active_profile = target_profile,
+                target_suffix = NULL, target_profile = NULL, status = ?, last_error = NULL,
+                migrated_chunks = total_chunks, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND target_suffix = ?
+        """, (STATUS_IDLE, user_id, target_suffix))
+        conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def _mark_failed(db_path: str, user_id: str, target_suffix: str, error: str) -> None:
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.execute("""
+            UPDATE embedding_model_state SET status = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND target_suffix = ?
+        """, (STATUS_FAILED, error[:500], user_id, target_suffix))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Impossibile registrare il fallimento della migrazione per l'utente {user_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+
+def run_embedding_migration(user_id: str) -> bool:
+    """
+    Esegue (bloccando) la migrazione pianificata dell'utente. Va chiamata in un app context.
+    Le vecchie collezioni restano attive finché le collezioni ombra non coprono il 100% dei
+    frammenti; poi lo switch è atomico e le vecchie collezioni vengono eliminate.
+    Una migrazione fallita resta in stato 'failed' e riparte dai frammenti mancanti.
+    """
+    from app.utils import build_full_config_for_background_process
+
+    config = current_app.config
+    db_path = config.get('DATABASE_FILE')
+    chroma_client = config.get('CHROMA_CLIENT')
+    state = get_embedding_model_state(db_path, user_id)
+    if not chroma_client or not state or not state.get('target_suffix'):
+        return False
+
+    source_suffix, target_suffix = state['active_suffix'], state['target_suffix']
+    bases = get_collection_base_names(config)
+    batch_size = max(1, int(config.get('EMBEDDING_MIGRATION_BATCH_SIZE', 50) or 50))
+    base_config = build_full_config_for_background_process(user_id, apply_embedding_state=False)
+    target_config = apply_embedding_profile(base_config, state['target_profile'], target_suffix)
+    logger.info(f"Migrazione embedding utente {user_id}: '{source_suffix or '(storiche)'}' -> '{target_suffix}' con {state['target_profile']}.")
+
+    try:
+        # Si ripete finché un passaggio completo non trova più nulla da copiare:
+        # nel frattempo l'indicizzazione può aggiungere o togliere frammenti dalle collezioni attive.
+        while _sync_shadow_collections(chroma_client, user_id, bases, source_suffix, target_suffix,
+                                       target_config, batch_size, db_path) > 0:
+            pass
+
+        if not _switch_active_collections(db_path, user_id, target_suffix):
+            raise _MigrationCancelled()
+        logger.info(f"Migrazione embedding utente {user_id}: copertura 100%, collezioni '{target_suffix}' ora attive.")
+    except _MigrationCancelled:
+        logger.info(f"Migrazione embedding utente {user_id} verso '{target_suffix}' annullata o sostituita.")
+        return False
+    except Exception as e:
+        logger.error(f"Migrazione embedding utente {user_id} fallita: {e}", exc_info=True)
+        _mark_failed(db_path, user_id, target_suffix, str(e))
+        return False
+
+    try:
+        # Recupera i frammenti scritti nelle vecchie collezioni tra l'ultimo controllo e lo switch
+        _sync_shadow_collections(chroma_client, user_id, bases, source_suffix, target_suffix,
+                                 target_config, batch_size, db_path, final_pass=True)
+    except Exception as e:
+        logger.error(f"Migrazione embedding utente {user_id}: recupero finale fallito ({e}). Vecchie collezioni conservate.")
+        return True
+
+    _drop_collections(chroma_client, user_id, bases, source_suffix)
+    return True
+
+
+def get_embedding_migration_status(db_path: str, user_id: str) -> Optional[Dict]:
+    """Riepilogo della migrazione per le pagine di stato. None se non c'è nessuna migrazione da mostrare."""
+    state = get_embedding_model_state(db_path, user_id)
+    if not state or not state.get('target_suffix'):
+        return None
+    total = state.get('total_chunks') or 0
+    migrated = state.get('migrated_chunks') or 0
+    return {
+        'status': state['status'],
+        'active_model': state['active_profile'].get('model'),
+        'target_model': state['target_profile'].get('model') if state.get('target_profile') else None,
+        'total_chunks': total,
+        'migrated_chunks': migrated,
+        'percentage': round(migrated / total * 100, 1) if total else 0.0,
+        'last_error': state.get('last_error'),
+    }
+
+
+def check_embedding_migrations(app) -> None:
+    """
+    Per ogni utente rileva un cambio di modello non ancora migrato (es. GEMINI_EMBEDDING_MODEL
+    aggiornato nel deployment) e riprende le migrazioni fallite o rimaste orfane. Il confronto è con
+    lo stato registrato all'avvio da seed_embedding_model_states: per le collezioni costruite prima
+    del registro, un cambio di modello con la stessa dimensione si vede solo con EMBEDDING_LEGACY_MODEL.
+    """
+    with app.app_context():
+        db_path = app.config.get('DATABASE_FILE')
+        conn = None
+        try:
+            conn = sqlite3.connect(db_path, timeout=30)
+            user_ids = [row[0] for row in conn.execute("SELECT id FROM users").fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Controllo migrazioni embedding: impossibile leggere gli utenti: {e}")
+            return
+        finally:
+            if conn:
+                conn.close()
+
+        for user_id in user_ids:
+            try:
+                request_embedding_migration(user_id)
+                state = get_embedding_model_state(db_path, user_id)
+                if state and state.get('target_suffix'):
+                    start_embedding_migration(app, user_id)
+            except Exception as e:
+                logger.error(f"Controllo migrazioni embedding: errore per l'utente {user_id}: {e}", exc_info=True)
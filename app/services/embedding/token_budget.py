@@ -0,0 +1,130 @@
+# FILE: app/services/embedding/token_budget.py
+
+import os
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+from flask import current_app
+from tokenizers import Tokenizer
+from tokenizers.pre_tokenizers import BertPreTokenizer
+
+logger = logging.getLogger(__name__)
+
+# Limiti dell'API Gemini (embed_content in batch): al massimo 100 testi per richiesta,
+# 2048 token per testo (oltre, il testo viene troncato in silenzio dal provider).
+DEFAULT_MAX_BATCH_ITEMS = 100
+DEFAULT_MAX_TEXT_TOKENS = 2048
+
+# Senza un vocabolario configurato stimiamo i token per eccesso: ogni parola o segno
+# di punteggiatura vale almeno un token, più uno ogni 4 caratteri oltre i primi 4.
+_ESTIMATE_CHARS_PER_TOKEN = 4
+_PRE_TOKENIZER = BertPreTokenizer()
+
+_tokenizer_cache: Dict[str, Optional[Tokenizer]] = {}
+_tokenizer_lock = threading.Lock()
+
+
+def _config_value(name: str, default):
+    try:
+        return current_app.config.get(name, default)
+    except RuntimeError:
+        return default # Fuori da un app context
+
+
+def get_embedding_limits(user_settings: Optional[dict] = None) -> Dict[str, int]:
+    """Limiti per richiesta di embedding: impostazione utente, poi di deployment, poi default del provider."""
+    user_settings = user_settings or {}
+    limits = {}
+    for key, name, default in (
+        ('max_items', 'EMBEDDING_MAX_BATCH_ITEMS', DEFAULT_MAX_BATCH_ITEMS),
+        ('max_batch_tokens', 'EMBEDDING_MAX_BATCH_TOKENS', 0),
+        ('max_text_tokens', 'EMBEDDING_MAX_TEXT_TOKENS', DEFAULT_MAX_TEXT_TOKENS),
+    ):
+        value = user_settings.get(name)
+        if value is None:
+            value = _config_value(name, default)
+        try:
+            limits[key] = max(0, int(value))
+        except (ValueError, TypeError):
+            limits[key] = default
+    limits['max_items'] = limits['max_items'] or DEFAULT_MAX_BATCH_ITEMS
+    return limits
+
+
+def _get_tokenizer() -> Optional[Tokenizer]:
+    """
+    Tokenizer indicato da EMBEDDING_TOKENIZER (percorso di un tokenizer.json o nome su Hugging Face).
+    Caricato una sola volta; se manca o non si carica usiamo la stima per eccesso.
+    """
+    name = (_config_value('EMBEDDING_TOKENIZER', '') or '').strip()
+    if not name:
+        return None
+    with _tokenizer_lock:
+        if name not in _tokenizer_cache:
+            try:
+                tokenizer = Tokenizer.from_file(name) if os.path.isfile(name) else Tokenizer.from_pretrained(name)
+                logger.info(f"Token budget: tokenizer '{name}' caricato.")
+            except Exception as e:
+                logger.warning(f"Token budget: impossibile caricare il tokenizer '{name}' ({e}). Uso la stima per eccesso.")
+                tokenizer = None
+            _tokenizer_cache[name] = tokenizer
+        return _tokenizer_cache[name]
+
+
+def _token_units(text: str) -> List[Tuple[int, int, int]]:
+    """Unità indivisibili del testo come (start_char, end_char, token)."""
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        encoding = tokenizer.encode(text, add_special_tokens=False)
+        return [(start, end, 1) for start, end in encoding.offsets]
+    return [
+        (start, end, 1 + max(0, end - start - 1) // _ESTIMATE_CHARS_PER_TOKEN)
+        for _, (start, end) in _PRE_TOKENIZER.pre_tokenize_str(text)
+    ]
+
+
+def count_tokens(text: str) -> int:
+    return sum(tokens for _, _, tokens in _token_units(text))
+
+
+def split_by_tokens(text: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """
+    Divide un testo troppo lungo per il provider in porzioni da al massimo max_tokens token,
+    tagliando tra un token e l'altro. Restituisce [(porzione, token)]; un testo che
+    rientra nel limite resta intero.
+    """
+    units = _token_units(text)
+    total = sum(tokens for _, _, tokens in units)
+    if not max_tokens or total <= max_tokens or not units:
+        return [(text, total)]
+
+    pieces = []
+    piece_start, piece_end, piece_tokens = units[0][0], units[0][0], 0
+    for start, end, tokens in units:
+        if piece_tokens and piece_tokens + tokens > max_tokens:
+            pieces.append((text[piece_start:piece_end], piece_tokens))
+            piece_start, piece_tokens = start, 0
+        piece_end = end
+        piece_tokens += tokens
+    pieces.append((text[piece_start:piece_end], piece_tokens))
+    return pieces
+
+
+def pack_batches(token_counts: List[int], max_items: int, max_batch_tokens: int = 0) -> List[List[int]]:
+    """
+    Raggruppa (in ordine) gli indici dei testi in batch che rispettano sia il numero massimo
+    di testi sia, se indicato, il totale di token per richiesta.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for index, tokens in enumerate(token_counts):
+        too_many_items = len(current) >= max_items
+        too_many_tokens = max_batch_tokens and current_tokens + tokens > max_batch_tokens
+        if current and (too_many_items or too_many_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
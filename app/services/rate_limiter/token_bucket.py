@@ -0,0 +1,232 @@
+# FILE: app/services/rate_limiter/token_bucket.py
+
+import os
+import time
+import sqlite3
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Corsie di priorità: le richieste "interactive" (chat, ricerca) possono usare
+# tutto il secchio, quelle "background" (indicizzazione, scheduler) devono
+# lasciare libera una riserva per non affamare l'utente che sta aspettando.
+LANE_INTERACTIVE = "interactive"
+LANE_BACKGROUND = "background"
+
+# Nomi dei secchi, uno per provider esterno.
+BUCKET_GEMINI = "gemini"
+BUCKET_OLLAMA = "ollama"
+BUCKET_GROQ = "groq"
+BUCKET_COHERE = "cohere"
+BUCKET_YOUTUBE_TRANSCRIPT = "youtube_transcript"
+
+_POLL_MIN_SECONDS = 0.05
+_POLL_MAX_SECONDS = 2.0
+
+# Stato del modulo, impostato da configure_rate_limiter() in create_app.
+# Se non configurato (es. script o test unitari senza app) il limitatore è un no-op.
+_limiter_settings: Dict = {}
+
+
+class RateLimitTimeout(Exception):
+    """Sollevata quando una richiesta non ottiene un gettone entro il tempo massimo di attesa."""
+
+    def __init__(self, bucket: str, lane: str, waited: float):
+        self.bucket = bucket
+        self.lane = lane
+        self.waited = waited
+        super().__init__(f"Rate limit locale per '{bucket}' (corsia {lane}): nessun gettone dopo {waited:.1f}s.")
+
+
+def configure_rate_limiter(config) -> None:
+    """
+    Legge dalla configurazione dell'app i limiti per provider e il percorso del
+    database condiviso. Il file SQLite vive accanto al DB principale, così
+    tutti i worker gunicorn e lo scheduler vedono gli stessi secchi.
+    """
+    db_file = config.get('DATABASE_FILE')
+    if not db_file:
+        logger.warning("Rate limiter: DATABASE_FILE mancante, limitatore disattivato.")
+        _limiter_settings.clear()
+        return
+
+    db_path = os.path.join(os.path.dirname(db_file), 'rate_limiter.db')
+    rates = {
+        BUCKET_GEMINI: config.get('GEMINI_RATE_LIMIT_RPM', 0),
+        BUCKET_OLLAMA: config.get('OLLAMA_RATE_LIMIT_RPM', 0),
+        BUCKET_GROQ: config.get('GROQ_RATE_LIMIT_RPM', 0),
+        BUCKET_COHERE: config.get('COHERE_RATE_LIMIT_RPM', 0),
+        BUCKET_YOUTUBE_TRANSCRIPT: config.get('YOUTUBE_TRANSCRIPT_RATE_LIMIT_RPM', 0),
+    }
+    _limiter_settings.clear()
+    _limiter_settings.update({
+        'db_path': db_path,
+        'rates_per_minute': {name: float(rpm or 0) for name, rpm in rates.items()},
+        'interactive_reserve': float(config.get('RATE_LIMIT_INTERACTIVE_RESERVE', 0.25)),
+        'interactive_max_wait': float(config.get('RATE_LIMIT_INTERACTIVE_MAX_WAIT_SECONDS', 15)),
+    })
+
+    try:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = _connect(db_path)
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    capacity REAL NOT NULL,
+                    refill_per_second REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    total_acquired INTEGER NOT NULL DEFAULT 0,
+                    total_throttled INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+        finally:
+            conn.close()
+        logger.info(f"Rate limiter configurato (db={db_path}, limiti RPM={_limiter_settings['rates_per_minute']}).")
+    except sqlite3.Error as e:
+        logger.error(f"Rate limiter: impossibile inizializzare il database {db_path}: {e}. Limitatore disattivato.")
+        _limiter_settings.clear()
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    # isolation_level=None: gestiamo noi le transazioni con BEGIN IMMEDIATE,
+    # che prende subito il lock in scrittura e serializza i processi concorrenti.
+    return sqlite3.connect(db_path, timeout=30, isolation_level=None)
+
+
+def _try_take(conn: sqlite3.Connection, bucket: str, lane: str, cost: float, rpm: float, reserve_fraction: float) -> float:
+    """
+    Esegue una singola transazione atomica sul secchio.
+    Restituisce 0 se il gettone è stato preso, altrimenti i secondi di attesa stimati.
+    """
+    capacity = max(rpm, cost)
+    refill_per_second = rpm / 60.0
+    now = time.time()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE name = ?", (bucket,)).fetchone()
+        if row is None:
+            tokens = capacity
+        else:
+            elapsed = max(0.0, now - row[1])
+            tokens = min(capacity, row[0] + elapsed * refill_per_second)
+
+        # La corsia background non può scendere sotto la riserva interattiva
+        # (limitata in modo che un secchio pieno basti sempre per una richiesta).
+        floor = 0.0 if lane == LANE_INTERACTIVE else min(capacity * reserve_fraction, capacity - cost)
+        if tokens - cost >= floor:
+            conn.execute("""
+                INSERT INTO rate_limit_buckets (name, tokens, capacity, refill_per_second, updated_at, total_acquired, total_throttled)
+                VALUES (?, ?, ?, ?, ?, 1, 0)
+                ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, capacity = excluded.capacity,
+                    refill_per_second = excluded.refill_per_second, updated_at = excluded.updated_at,
+                    total_acquired = total_acquired + 1
+            """, (bucket, tokens - cost, capacity, refill_per_second, now))
+            conn.execute("COMMIT")
+            return 0.0
+
+        conn.execute("""
+            INSERT INTO rate_limit_buckets (name, tokens, capacity, refill_per_second, updated_at, total_acquired, total_throttled)
+            VALUES (?, ?, ?, ?, ?, 0, 1)
+            ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, capacity = excluded.capacity,
+                refill_per_second = excluded.refill_per_second, updated_at = excluded.updated_at,
+                total_throttled = total_throttled + 1
+        """, (bucket, tokens, capacity, refill_per_second, now))
+        conn.execute("COMMIT")
+        missing = (floor + cost) - tokens
+        return max(_POLL_MIN_SECONDS, missing / refill_per_second)
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def acquire(bucket: str, lane: str = LANE_BACKGROUND, cost: float = 1.0, max_wait: Optional[float] = None) -> float:
+    """
+    Attende (bloccando) finché il secchio `bucket` non concede `cost` gettoni.
+    La corsia interattiva ha un'attesa massima (default da config) oltre la quale
+    solleva RateLimitTimeout; la corsia background attende indefinitamente se max_wait è None.
+    Restituisce i secondi effettivamente attesi.
+    """
+    if not _limiter_settings:
+        return 0.0
+    rpm = _limiter_settings['rates_per_minute'].get(bucket, 0.0)
+    if rpm <= 0:
+        return 0.0  # Nessun limite configurato per questo provider
+
+    if max_wait is None and lane == LANE_INTERACTIVE:
+        max_wait = _limiter_settings['interactive_max_wait']
+    reserve_fraction = _limiter_settings['interactive_reserve']
+
+    start = time.time()
+    logged_wait = False
+    while True:
+        try:
+            conn = _connect(_limiter_settings['db_path'])
+            try:
+                wait_seconds = _try_take(conn, bucket, lane, cost, rpm, reserve_fraction)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # Un problema del limitatore non deve bloccare il lavoro: lasciamo passare la richiesta.
+            logger.error(f"Rate limiter: errore DB sul secchio '{bucket}': {e}. Richiesta lasciata passare.")
+            return time.time() - start
+
+        waited = time.time() - start
+        if wait_seconds == 0.0:
+            if logged_wait:
+                logger.info(f"Rate limiter: gettone '{bucket}' ({lane}) ottenuto dopo {waited:.1f}s.")
+            return waited
+
+        if max_wait is not None and waited + wait_seconds > max_wait:
+            logger.warning(f"Rate limiter: attesa massima superata per '{bucket}' ({lane}) dopo {waited:.1f}s.")
+            raise RateLimitTimeout(bucket, lane, waited)
+
+        if not logged_wait:
+            logger.info(f"Rate limiter: secchio '{bucket}' vuoto per corsia {lane}, attendo ~{wait_seconds:.1f}s...")
+            logged_wait = True
+        time.sleep(min(_POLL_MAX_SECONDS, wait_seconds))
+
+
+def get_bucket_states() -> List[Dict]:
+    """Restituisce lo stato corrente dei secchi configurati (per la pagina di stato del sistema)."""
+    if not _limiter_settings:
+        return []
+
+    rows = {}
+    try:
+        conn = _connect(_limiter_settings['db_path'])
+        try:
+            for row in conn.execute("SELECT name, tokens, updated_at, total_acquired, total_throttled FROM rate_limit_buckets"):
+                rows[row[0]] = row
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Rate limiter: impossibile leggere lo stato dei secchi: {e}")
+
+    now = time.time()
+    states = []
+    for name, rpm in _limiter_settings['rates_per_minute'].items():
+        if rpm <= 0:
+            states.append({'name': name, 'limit_per_minute': 0, 'available': None, 'capacity': None,
+                           'total_acquired': 0, 'total_throttled': 0})
+            continue
+        capacity = rpm
+        row = rows.get(name)
+        if row:
+            available = min(capacity, row[1] + max(0.0, now - row[2]) * rpm / 60.0)
+            acquired, throttled = row[3], row[4]
+        else:
+            available, acquired, throttled = capacity, 0, 0
+        states.append({
+            'name': name,
+            'limit_per_minute': int(rpm),
+            'available': round(available, 1),
+            'capacity': int(capacity),
+            'interactive_reserve': round(capacity * _limiter_settings['interactive_reserve'], 1),
+            'total_acquired': acquired,
+            'total_throttled': throttled,
+        })
+    return states
@@ -1,12 +1,104 @@
 from youtube_transcript_api import YouTubeTranscriptApi
 from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptFound 
 from app.utils import log_system_alert
-from typing import Optional, Dict
+from app.services.rate_limiter.token_bucket import acquire, BUCKET_YOUTUBE_TRANSCRIPT, LANE_BACKGROUND
+from typing import Optional, Dict, List
+from urllib.parse import urlsplit
 import xml.etree.ElementTree as ET
+import itertools
+import threading
+import requests
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_PROXY_COOLDOWN_SECONDS = 900
+# Dopo blocchi consecutivi la pausa di un instradamento raddoppia, fino a questo fattore
+_MAX_COOLDOWN_FACTOR = 8
+
+
+class _Route:
+    """Un instradamento verso YouTube (connessione diretta o un proxy) con il suo stato di salute."""
+
+    def __init__(self, proxy_url: Optional[str] = None):
+        self.proxy_url = proxy_url
+        self.label = 'diretta' if not proxy_url else f"{urlsplit(proxy_url).hostname}:{urlsplit(proxy_url).port}"
+        self.consecutive_blocks = 0
+        self.blocked_until = 0.0
+
+
+# Stato del modulo, impostato da configure_transcript_fetcher() in create_app.
+# Senza configurazione si usa la sola connessione diretta.
+_fetcher_settings: Dict = {'routes': [_Route()], 'cooldown_seconds': DEFAULT_PROXY_COOLDOWN_SECONDS}
+_routes_lock = threading.Lock()
+_route_counter = itertools.count()
+# requests.Session non è thread-safe: una sessione keep-alive per thread e per instradamento
+_thread_sessions = threading.local()
+
+
+def configure_transcript_fetcher(config) -> None:
+    """
+    Legge i proxy per la libreria non ufficiale (YOUTUBE_TRANSCRIPT_PROXIES, separati da virgola).
+    Con dei proxy configurati le richieste ruotano tra quelli sani; senza, si usa la connessione diretta.
+    """
+    proxies = [p.strip() for p in (config.get('YOUTUBE_TRANSCRIPT_PROXIES') or '').split(',') if p.strip()]
+    routes = [_Route(proxy_url) for proxy_url in proxies] or [_Route()]
+    with _routes_lock:
+        _fetcher_settings['routes'] = routes
+        _fetcher_settings['cooldown_seconds'] = int(config.get('YOUTUBE_TRANSCRIPT_PROXY_COOLDOWN_SECONDS', DEFAULT_PROXY_COOLDOWN_SECONDS) or 0)
+    if proxies:
+        logger.info(f"Trascrizioni non ufficiali: {len(routes)} proxy configurati ({', '.join(r.label for r in routes)}).")
+
+
+def _available_routes() -> List[_Route]:
+    """Instradamenti non in pausa, a partire dal prossimo della rotazione."""
+    now = time.monotonic()
+    with _routes_lock:
+        routes = _fetcher_settings['routes']
+        start = next(_route_counter) % len(routes)
+        rotated = routes[start:] + routes[:start]
+        return [route for route in rotated if route.blocked_until <= now]
+
+
+def _mark_blocked(route: _Route) -> None:
+    with _routes_lock:
+        route.consecutive_blocks += 1
+        pause = _fetcher_settings['cooldown_seconds'] * min(2 ** (route.consecutive_blocks - 1), _MAX_COOLDOWN_FACTOR)
+        route.blocked_until = time.monotonic() + pause
+    logger.warning(f"[Unofficial Lib] Instradamento '{route.label}' bloccato da YouTube: in pausa per {pause}s.")
+
+
+def _mark_ok(route: _Route) -> None:
+    if route.consecutive_blocks:
+        with _routes_lock:
+            route.consecutive_blocks = 0
+
+
+def _session_for(route: _Route) -> requests.Session:
+    sessions = getattr(_thread_sessions, 'sessions', None)
+    if sessions is None:
+        sessions = _thread_sessions.sessions = {}
+    session = sessions.get(route.proxy_url)
+    if session is None:
+        session = requests.Session()
+        if route.proxy_url:
+            session.proxies = {'http': route.proxy_url, 'https': route.proxy_url}
+        sessions[route.proxy_url] = session
+    return session
+
+
+def _is_ip_block(error: Exception) -> bool:
+    error_text = str(error).lower()
+    # AGGIORNAMENTO CRITICO: Riconoscimento esteso dei messaggi di blocco IP/Cloud
+    return (
+        'http error 429' in error_text or 
+        'blocking requests from your ip' in error_text or
+        'cloud provider' in error_text or
+        'bot detection' in error_text
+    )
+
+
 class UnofficialTranscriptService:
     """
     Servizio per recuperare trascrizioni utilizzando la libreria non ufficiale
@@ -16,89 +108,104 @@ class UnofficialTranscriptService:
     @staticmethod
     def get_transcript(video_id: str, preferred_languages: list = ['it', 'en']) -> Optional[Dict[str, str]]:
         """
-        Tenta di recuperare la trascrizione per un dato video_id.
+        Tenta di recuperare la trascrizione per un dato video_id, provando gli instradamenti sani
+        uno dopo l'altro. Se sono tutti in pausa per un blocco recente risponde subito IP_BLOCKED,
+        senza pagare un'altra richiesta destinata a fallire.
         """
         logger.info(f"[Unofficial Lib] Avvio recupero trascrizione per video ID: {video_id}")
-        
-        try:
-            api = YouTubeTranscriptApi()
-            transcript_list = api.list(video_id)
-            
-            transcript_to_fetch = None
-            found_lang_code = None
+        blocked_message = {'error': 'IP_BLOCKED', 'message': 'YouTube ha bloccato l\'IP (normale su VPS). Necessario fallback API ufficiale.'}
+
+        routes = _available_routes()
+        if not routes:
+            logger.info(f"[Unofficial Lib] Instradamenti tutti in pausa per blocco IP: {video_id} passa subito all'API ufficiale.")
+            return blocked_message
+
+        last_block = None
+        for route in routes:
+            acquire(BUCKET_YOUTUBE_TRANSCRIPT, lane=LANE_BACKGROUND)
+            try:
+                result = UnofficialTranscriptService._fetch(video_id, preferred_languages, route)
+                _mark_ok(route)
+                return result
             
-            # Cerca la trascrizione nelle lingue preferite
-            for lang_code in preferred_languages:
-                try:
-                    transcript_to_fetch = transcript_list.find_transcript([lang_code])
-                    found_lang_code = lang_code
-                    logger.info(f"[Unofficial Lib] Trovata trascrizione preferita in '{lang_code}' per {video_id}.")
-                    break
-                except NoTranscriptFound:
+            except (TranscriptsDisabled, NoTranscriptFound) as e:
+                _mark_ok(route)
+                message = f"Le trascrizioni sono disabilitate per il video {video_id}." if isinstance(e, TranscriptsDisabled) else f"Nessuna trascrizione trovata per il video {video_id}."
+                error_code = 'TRANSCRIPTS_DISABLED' if isinstance(e, TranscriptsDisabled) else 'NO_TRANSCRIPT_FOUND'
+                logger.warning(f"[Unofficial Lib] {message}")
+                return {'error': error_code, 'message': message}
+                
+            except ET.ParseError as e_xml:
+                logger.warning(f"[Unofficial Lib] Errore parsing XML per {video_id} (risposta vuota da YouTube): {e_xml}")
+                return {'error': 'XML_PARSE_ERROR', 'message': 'YouTube ha restituito una risposta vuota o malformattata.'}
+                
+            except Exception as e:
+                # Un proxy che non risponde conta come bloccato: si passa al successivo
+                if _is_ip_block(e) or (route.proxy_url and isinstance(e, requests.exceptions.RequestException)):
+                    _mark_blocked(route)
+                    last_block = e
                     continue
-            
-            # Se non trovata, prova un fallback su qualsiasi lingua generabile automaticamente
-            if not transcript_to_fetch:
-                try:
-                    transcript_to_fetch = transcript_list.find_generated_transcript(preferred_languages)
-                    found_lang_code = transcript_to_fetch.language_code
-                    logger.info(f"[Unofficial Lib] Trovata trascrizione generata automaticamente in '{found_lang_code}' per {video_id}.")
-                except NoTranscriptFound:
-                    logger.warning(f"[Unofficial Lib] Nessuna trascrizione preferita o generata trovata. Tento fallback sulla prima disponibile.")
-                    first_transcript = next(iter(transcript_list), None)
-                    if first_transcript:
-                        transcript_to_fetch = first_transcript
-                        found_lang_code = first_transcript.language_code
-
-            if not transcript_to_fetch:
-                raise NoTranscriptFound(video_id)
-
-            # Scarica i dati della trascrizione
-            transcript_pieces = transcript_to_fetch.fetch()
-            
-            # Usiamo piece.text (accesso all'attributo) invece di piece['text']
-            full_transcript_text = " ".join(piece.text for piece in transcript_pieces)
-            
-            caption_type = 'manual' if not transcript_to_fetch.is_generated else 'auto'
-            
-            logger.info(f"[Unofficial Lib] Trascrizione recuperata con successo per {video_id} (Lingua: {found_lang_code}, Tipo: {caption_type}).")
-            
-            return {
-                'text': full_transcript_text,
-                'language': found_lang_code,
-                'type': caption_type
-            }
-        
-        except (TranscriptsDisabled, NoTranscriptFound) as e:
-            message = f"Le trascrizioni sono disabilitate per il video {video_id}." if isinstance(e, TranscriptsDisabled) else f"Nessuna trascrizione trovata per il video {video_id}."
-            error_code = 'TRANSCRIPTS_DISABLED' if isinstance(e, TranscriptsDisabled) else 'NO_TRANSCRIPT_FOUND'
-            logger.warning(f"[Unofficial Lib] {message}")
-            return {'error': error_code, 'message': message}
-            
-        except ET.ParseError as e_xml:
-            logger.warning(f"[Unofficial Lib] Errore parsing XML per {video_id} (risposta vuota da YouTube): {e_xml}")
-            return {'error': 'XML_PARSE_ERROR', 'message': 'YouTube ha restituito una risposta vuota o malformattata.'}
-            
-        except Exception as e:
-            error_text = str(e).lower()
-            # AGGIORNAMENTO CRITICO: Riconoscimento esteso dei messaggi di blocco IP/Cloud
-            is_ip_blocked = (
-                'http error 429' in error_text or 
-                'blocking requests from your ip' in error_text or
-                'cloud provider' in error_text or
-                'bot detection' in error_text
+                logger.error(f"[Unofficial Lib] Errore imprevisto per {video_id}: {e}", exc_info=True)
+                return {'error': 'UNKNOWN_ERROR', 'message': f'Errore imprevisto: {e}'}
+
+        logger.warning(f"[Unofficial Lib] RILEVATO BLOCCO IP/CLOUD per il video {video_id}. Questo è normale su VPS. Passo all'API Ufficiale.")
+        try:
+            log_system_alert(
+                alert_type='youtube_ip_block', 
+                message=f"Blocco IP rilevato su video {video_id}. Passaggio automatico ad API Ufficiale.",
+                details=str(last_block)[:200]
             )
-            
-            if is_ip_blocked:
-                logger.warning(f"[Unofficial Lib] RILEVATO BLOCCO IP/CLOUD per il video {video_id}. Questo è normale su VPS. Passo all'API Ufficiale.")
-                try:
-                    log_system_alert(
-                        alert_type='youtube_ip_block', 
-                        message=f"Blocco IP rilevato su video {video_id}. Passaggio automatico ad API Ufficiale.",
-                        details=str(e)[:200]
-                    )
-                except Exception: pass
-                return {'error': 'IP_BLOCKED', 'message': 'YouTube ha bloccato l\'IP (normale su VPS). Necessario fallback API ufficiale.'}
-            
-            logger.error(f"[Unofficial Lib] Errore imprevisto per {video_id}: {e}", exc_info=True)
-            return {'error': 'UNKNOWN_ERROR', 'message': f'Errore imprevisto: {e}'}
\ No newline at end of file
+        except Exception: pass
+        return blocked_message
+
+    @staticmethod
+    def _fetch(video_id: str, preferred_languages: list, route: _Route) -> Dict[str, str]:
+        """Scarica la trascrizione attraverso un instradamento; gli errori arrivano al chiamante."""
+        # La sessione (e le sue connessioni keep-alive) resta al thread tra un video e l'altro
+        api = YouTubeTranscriptApi(http_client=_session_for(route))
+        transcript_list = api.list(video_id)
+        
+        transcript_to_fetch = None
+        found_lang_code = None
+        
+        # Cerca la trascrizione nelle lingue preferite
+        for lang_code in preferred_languages:
+            try:
+                transcript_to_fetch = transcript_list.find_transcript([lang_code])
+                found_lang_code = lang_code
+                logger.info(f"[Unofficial Lib] Trovata trascrizione preferita in '{lang_code}' per {video_id}.")
+                break
+            except NoTranscriptFound:
+                continue
+        
+        # Se non trovata, prova un fallback su qualsiasi lingua generabile automaticamente
+        if not transcript_to_fetch:
+            try:
+                transcript_to_fetch = transcript_list.find_generated_transcript(preferred_languages)
+                found_lang_code = transcript_to_fetch.language_code
+                logger.info(f"[Unofficial Lib] Trovata trascrizione generata automaticamente in '{found_lang_code}' per {video_id}.")
+            except NoTranscriptFound:
+                logger.warning(f"[Unofficial Lib] Nessuna trascrizione preferita o generata trovata. Tento fallback sulla prima disponibile.")
+                first_transcript = next(iter(transcript_list), None)
+                if first_transcript:
+                    transcript_to_fetch = first_transcript
+                    found_lang_code = first_transcript.language_code
+
+        if not transcript_to_fetch:
+            raise NoTranscriptFound(video_id)
+
+        # Scarica i dati della trascrizione
+        transcript_pieces = transcript_to_fetch.fetch()
+        
+        # Usiamo piece.text (accesso all'attributo) invece di piece['text']
+        full_transcript_text = " ".join(piece.text for piece in transcript_pieces)
+        
+        caption_type = 'manual' if not transcript_to_fetch.is_generated else 'auto'
+        
+        logger.info(f"[Unofficial Lib] Trascrizione recuperata con successo per {video_id} (Lingua: {found_lang_code}, Tipo: {caption_type}, via {route.label}).")
+        
+        return {
+            'text': full_transcript_text,
+            'language': found_lang_code,
+            'type': caption_type
+        }
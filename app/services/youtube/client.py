@@ -1,18 +1,32 @@
 from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from typing import List, Optional, Union, Dict, Tuple
+from typing import List, Optional, Union, Dict, Tuple, Set, Iterator
 from googleapiclient.errors import HttpError
 import logging
 import re
 import time
-import os
 import html
 
 from app.api.models.video import Video
+from app.services.youtube.quota_ledger import record_call, record_quota_exceeded
+from app.services.youtube.service_factory import get_youtube_service
 
 logger = logging.getLogger(__name__)
 
+# videos.list accetta al massimo 50 ID per richiesta
+VIDEOS_LIST_MAX_IDS = 50
+
+_ISO8601_DURATION = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
+
+
+def _parse_iso8601_duration(value: Optional[str]) -> Optional[int]:
+    """Durata ISO 8601 di YouTube (es. 'PT1H2M3S') in secondi; None se assente o non riconosciuta."""
+    match = _ISO8601_DURATION.fullmatch(value or '')
+    if not value or not match:
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
 class YouTubeClient:
     def __init__(self, token_file: str = "token.json"):
         self.token_file = token_file
@@ -20,17 +34,25 @@ class YouTubeClient:
         self._init_service()
 
     def _init_service(self):
-        """Inizializza il servizio YouTube con le credenziali"""
+        """Prende il servizio YouTube dalla cache del processo (credenziali e discovery già pronti)"""
         try:
-            if not os.path.exists(self.token_file):
+            self.youtube = get_youtube_service(self.token_file)
+            if self.youtube is None:
                 raise ValueError("Credentials not found. Please authenticate first.")
-                
-            credentials = Credentials.from_authorized_user_file(self.token_file)
-            self.youtube = build('youtube', 'v3', credentials=credentials)
         except Exception as e:
             logger.error(f"Error initializing YouTube service: {str(e)}")
             raise
 
+    def _execute(self, request, method: str):
+        """Esegue una richiesta all'API registrandone il costo nel registro locale della quota."""
+        record_call(method)
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status == 403 and ('quotaExceeded' in str(e) or 'quotaExceeded' in str(e.content)):
+                record_quota_exceeded()
+            raise
+
     def extract_channel_info(self, url_or_id: str) -> str:
         """Estrae l'ID del canale da vari formati di URL"""
         try:
@@ -56,7 +78,7 @@ class YouTubeClient:
                             request = self.youtube.search().list(
                                 part='snippet', q=identifier, type='channel', maxResults=1
                             )
-                            response = request.execute()
+                            response = self._execute(request, 'search.list')
                             if response['items']:
                                 return response['items'][0]['id']['channelId']
                         except Exception as e:
@@ -66,7 +88,7 @@ class YouTubeClient:
                             request = self.youtube.channels().list(
                                 part='id', forUsername=identifier
                             )
-                            response = request.execute()
+                            response = self._execute(request, 'channels.list')
                             if response['items']:
                                 return response['items'][0]['id']
                         except Exception as e:
@@ -77,30 +99,47 @@ class YouTubeClient:
             logger.error(f"Error extracting channel info: {str(e)}")
             raise
 
-    def get_channel_videos_and_total_count(self, channel_id: str) -> Tuple[List[Video], int]:
+    def get_channel_videos_and_total_count(self, channel_id: str, known_video_ids: Optional[Set[str]] = None, listing_state: Optional[Dict] = None) -> Tuple[List[Video], int]:
+        """Come iter_channel_video_pages, ma raccoglie tutte le pagine in un'unica lista."""
+        if listing_state is None:
+            listing_state = {}
+        all_videos = [video for page in self.iter_channel_video_pages(channel_id, known_video_ids, listing_state) for video in page]
+        return all_videos, listing_state.get('total_results', 0)
+
+    def iter_channel_video_pages(self, channel_id: str, known_video_ids: Optional[Set[str]] = None, listing_state: Optional[Dict] = None) -> Iterator[List[Video]]:
         """
-        Recupera TUTTI i video di un canale usando il metodo robusto della playlist "Uploads".
+        Restituisce, una pagina alla volta e man mano che arrivano, i video di un canale usando
+        il metodo robusto della playlist "Uploads" (dal più recente).
+        Con known_video_ids la scansione si ferma alla prima pagina che contiene solo video già noti.
+        listing_state (aggiornato sul posto) conserva tra un run e l'altro l'ID della playlist e l'ETag
+        della prima pagina: se la prima pagina non è cambiata YouTube risponde 304 e non ci sono video nuovi.
+        Dopo la prima pagina listing_state['total_results'] contiene il numero di video del canale.
         """
-        all_videos = []
         next_page_token = None
-        total_results = 0
+        found_count = 0
+        incremental = bool(known_video_ids)
+        if listing_state is None:
+            listing_state = {}
 
-        logger.info(f"Inizio recupero video per canale {channel_id} (Metodo Playlist).")
+        logger.info(f"Inizio recupero video per canale {channel_id} (Metodo Playlist{', incrementale' if incremental else ''}).")
 
         try:
             # 1. Trova la playlist "Uploads" del canale. Ogni canale ne ha una.
-            channels_response = self.youtube.channels().list(
-                part='contentDetails',
-                id=channel_id
-            ).execute()
-            
-            if not channels_response.get('items'):
-                raise ValueError(f"Canale con ID {channel_id} non trovato.")
-            
-            uploads_playlist_id = channels_response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
+            uploads_playlist_id = listing_state.get('uploads_playlist_id')
+            if not uploads_playlist_id:
+                channels_response = self._execute(self.youtube.channels().list(
+                    part='contentDetails',
+                    id=channel_id
+                ), 'channels.list')
+
+                if not channels_response.get('items'):
+                    raise ValueError(f"Canale con ID {channel_id} non trovato.")
+
+                uploads_playlist_id = channels_response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
+                listing_state['uploads_playlist_id'] = uploads_playlist_id
             logger.info(f"Trovato ID playlist 'Uploads': {uploads_playlist_id}")
 
-            # 2. Scansiona la playlist "Uploads" per recuperare tutti i video.
+            # 2. Scansiona la playlist "Uploads" per recuperare i video.
             while True:
                 logger.debug(f"Recupero pagina video dalla playlist... Token: {next_page_token}")
                 playlist_request = self.youtube.playlistItems().list(
@@ -109,32 +148,47 @@ class YouTubeClient:
                     maxResults=50,
                     pageToken=next_page_token
                 )
-                playlist_response = playlist_request.execute()
+                if next_page_token is None and incremental and listing_state.get('etag'):
+                    playlist_request.headers['If-None-Match'] = listing_state['etag']
+                try:
+                    playlist_response = self._execute(playlist_request, 'playlistItems.list')
+                except HttpError as e:
+                    if next_page_token is None and e.resp.status == 304:
+                        logger.info(f"Prima pagina della playlist invariata (ETag): nessun nuovo video per il canale {channel_id}.")
+                        return
+                    raise
 
                 if next_page_token is None:
-                    total_results = playlist_response.get('pageInfo', {}).get('totalResults', 0)
-                    logger.info(f"Conteggio totale video dalla playlist: {total_results}")
+                    listing_state['etag'] = playlist_response.get('etag')
+                    listing_state['total_results'] = playlist_response.get('pageInfo', {}).get('totalResults', 0)
+                    logger.info(f"Conteggio totale video dalla playlist: {listing_state['total_results']}")
 
+                page_videos = []
                 for item in playlist_response.get('items', []):
                     snippet = item.get('snippet', {})
                     if snippet.get('resourceId', {}).get('kind') == 'youtube#video':
                         video_id = snippet['resourceId']['videoId']
-                        video = Video(
+                        page_videos.append(Video(
                             video_id=video_id,
                             title=html.unescape(snippet.get('title', 'Senza Titolo')),
                             url=f"https://www.youtube.com/watch?v={video_id}",
                             channel_id=channel_id,
                             published_at=snippet.get('publishedAt'),
                             description=html.unescape(snippet.get('description', ''))
-                        )
-                        all_videos.append(video)
-
+                        ))
+                found_count += len(page_videos)
                 next_page_token = playlist_response.get('nextPageToken')
+                all_known = incremental and page_videos and all(video.video_id in known_video_ids for video in page_videos)
+                yield page_videos
+
                 if not next_page_token:
                     break
+                if all_known:
+                    # Le pagine successive sono più vecchie: le conosciamo già
+                    logger.info("Pagina composta solo da video già noti: interrompo la scansione.")
+                    break
             
-            logger.info(f"Recupero video completato. Trovati: {len(all_videos)} video.")
-            return all_videos, total_results
+            logger.info(f"Recupero video completato. Trovati: {found_count} video.")
 
         except HttpError as e:
             if e.resp.status == 403 and 'quotaExceeded' in str(e):
@@ -151,31 +205,53 @@ class YouTubeClient:
 
     def get_video_details(self, video_id: str) -> Video:
         try:
-            request = self.youtube.videos().list(
-                part='snippet,contentDetails,statistics',
-                id=video_id
-            )
-            response = request.execute()
-
-            if not response['items']:
+            details = self.get_videos_details([video_id]).get(video_id)
+            if not details:
                 raise ValueError(f"No details found for video ID {video_id}")
-
-            item = response['items'][0]
-            
-            video = Video(
-                video_id=video_id,
-                title=html.unescape(item['snippet']['title']),
-                url=f"https://www.youtube.com/watch?v={video_id}",
-                channel_id=item['snippet']['channelId'],
-                published_at=item['snippet']['publishedAt'],
-                description=html.unescape(item['snippet']['description'])
-            )
-            return video
+            return details['video']
 
         except Exception as e:
             logger.error(f"Error getting video details for {video_id}: {str(e)}")
             raise 
 
+    def get_videos_details(self, video_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Dettagli di molti video con una richiesta videos.list ogni 50 ID (1 unità di quota per richiesta).
+        Restituisce {video_id: {'video', 'duration_seconds', 'live_broadcast_content', 'has_captions'}};
+        gli ID inesistenti o privati non compaiono. has_captions riflette solo i sottotitoli caricati
+        dall'autore: quelli automatici non vengono segnalati dall'API.
+        """
+        details = {}
+        unique_ids = list(dict.fromkeys(video_ids))
+        for start in range(0, len(unique_ids), VIDEOS_LIST_MAX_IDS):
+            batch = unique_ids[start:start + VIDEOS_LIST_MAX_IDS]
+            request = self.youtube.videos().list(
+                part='snippet,contentDetails',
+                id=','.join(batch),
+                maxResults=VIDEOS_LIST_MAX_IDS
+            )
+            response = self._execute(request, 'videos.list')
+
+            for item in response.get('items', []):
+                snippet = item.get('snippet', {})
+                content_details = item.get('contentDetails', {})
+                video_id = item['id']
+                details[video_id] = {
+                    'video': Video(
+                        video_id=video_id,
+                        title=html.unescape(snippet.get('title', 'Senza Titolo')),
+                        url=f"https://www.youtube.com/watch?v={video_id}",
+                        channel_id=snippet.get('channelId', ''),
+                        published_at=snippet.get('publishedAt'),
+                        description=html.unescape(snippet.get('description', ''))
+                    ),
+                    'duration_seconds': _parse_iso8601_duration(content_details.get('duration')),
+                    'live_broadcast_content': snippet.get('liveBroadcastContent', 'none'),
+                    'has_captions': content_details.get('caption') == 'true',
+                }
+        logger.debug(f"Dettagli recuperati per {len(details)}/{len(unique_ids)} video.")
+        return details
+
     def get_transcript_by_api(self, video_id: str, preferred_languages: list = ['it', 'en']) -> Optional[Dict[str, str]]:
         logger.info(f"[API Ufficiale] Avvio recupero trascrizione per video ID: {video_id}")
         
@@ -188,7 +264,7 @@ class YouTubeClient:
                     part='snippet',
                     videoId=video_id
                 )
-                list_response = list_request.execute()
+                list_response = self._execute(list_request, 'captions.list')
 
                 available_tracks = {}
                 for item in list_response.get('items', []):
@@ -217,7 +293,7 @@ class YouTubeClient:
                     id=track_to_download['id'],
                     tfmt='srt'
                 )
-                srt_captions = download_request.execute().decode('utf-8')
+                srt_captions = self._execute(download_request, 'captions.download').decode('utf-8')
                 
                 text_no_seq = re.sub(r'^\d+\s*$', '', srt_captions, flags=re.MULTILINE)
                 text_no_ts = re.sub(r'\d{2}:\d{2}:\d{2},\d{3} --> \d{2}:\d{2}:\d{2},\d{3}\s*$', '', text_no_seq, flags=re.MULTILINE)
@@ -0,0 +1,174 @@
+# FILE: app/services/youtube/quota_ledger.py
+
+import os
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# La quota della YouTube Data API si azzera a mezzanotte, ora del Pacifico.
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+DEFAULT_DAILY_LIMIT = 10000
+
+# Costo in unità di ogni metodo, dalla tabella ufficiale dei costi della YouTube Data API v3.
+# Le chiamate fallite costano comunque: le registriamo prima di eseguirle.
+UNIT_COSTS = {
+    'channels.list': 1,
+    'playlistItems.list': 1,
+    'playlists.list': 1,
+    'videos.list': 1,
+    'search.list': 100,
+    'captions.list': 50,
+    'captions.download': 200,
+}
+
+# Stato del modulo, impostato da configure_quota_ledger() in create_app.
+# Se non configurato (script o test senza app) il registro è un no-op.
+_ledger_settings: Dict = {}
+
+
+def configure_quota_ledger(config) -> None:
+    """
+    Il registro vive in un file SQLite accanto al DB principale: tutti i worker gunicorn,
+    i thread di import e lo scheduler sommano sugli stessi contatori giornalieri.
+    """
+    db_file = config.get('DATABASE_FILE')
+    if not db_file:
+        logger.warning("Registro quota YouTube: DATABASE_FILE mancante, registro disattivato.")
+        _ledger_settings.clear()
+        return
+
+    db_path = os.path.join(os.path.dirname(db_file), 'youtube_quota.db')
+    _ledger_settings.clear()
+    _ledger_settings.update({
+        'db_path': db_path,
+        'daily_limit': int(config.get('YOUTUBE_QUOTA_DAILY_LIMIT', DEFAULT_DAILY_LIMIT) or DEFAULT_DAILY_LIMIT),
+    })
+
+    try:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = _connect(db_path)
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS youtube_quota_usage (
+                    quota_day TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    calls INTEGER NOT NULL DEFAULT 0,
+                    units INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (quota_day, method)
+                )
+            """)
+            # Giorni in cui YouTube ha risposto quotaExceeded: il nostro conteggio non basta
+            # (la quota è del progetto Google Cloud, altri client possono consumarla)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS youtube_quota_exhausted (
+                    quota_day TEXT PRIMARY KEY,
+                    exhausted_at TEXT NOT NULL
+                )
+            """)
+        finally:
+            conn.close()
+        logger.info(f"Registro quota YouTube configurato (db={db_path}, limite giornaliero={_ledger_settings['daily_limit']}).")
+    except sqlite3.Error as e:
+        logger.error(f"Registro quota YouTube: impossibile inizializzare il database {db_path}: {e}. Registro disattivato.")
+        _ledger_settings.clear()
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    return sqlite3.connect(db_path, timeout=30)
+
+
+def _now() -> datetime:
+    return datetime.now(QUOTA_TIMEZONE)
+
+
+def quota_day(now: Optional[datetime] = None) -> str:
+    """Giorno di quota corrente (data del Pacifico) in formato ISO."""
+    return (now or _now()).astimezone(QUOTA_TIMEZONE).date().isoformat()
+
+
+def record_call(method: str, units: Optional[int] = None) -> None:
+    """Registra una chiamata all'API con il suo costo (di default quello documentato per il metodo)."""
+    if not _ledger_settings:
+        return
+    if units is None:
+        units = UNIT_COSTS.get(method, 1)
+    conn = None
+    try:
+        conn = _connect(_ledger_settings['db_path'])
+        conn.execute("""
+            INSERT INTO youtube_quota_usage (quota_day, method, calls, units) VALUES (?, ?, 1, ?)
+            ON CONFLICT(quota_day, method) DO UPDATE SET calls = calls + 1, units = units + excluded.units
+        """, (quota_day(), method, units))
+        conn.commit()
+    except sqlite3.Error as e:
+        # Un problema del registro non deve bloccare la chiamata
+        logger.error(f"Registro quota YouTube: impossibile registrare '{method}': {e}")
+    finally:
+        if conn: conn.close()
+
+
+def record_quota_exceeded() -> None:
+    """YouTube ha risposto quotaExceeded: per oggi il budget residuo è zero, qualunque sia il conteggio locale."""
+    if not _ledger_settings:
+        return
+    conn = None
+    try:
+        conn = _connect(_ledger_settings['db_path'])
+        conn.execute(
+            "INSERT OR IGNORE INTO youtube_quota_exhausted (quota_day, exhausted_at) VALUES (?, ?)",
+            (quota_day(), _now().isoformat())
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Registro quota YouTube: impossibile segnare la quota esaurita: {e}")
+    finally:
+        if conn: conn.close()
+
+
+def get_quota_status() -> Dict:
+    """Consumo del giorno di quota corrente, per la pagina di stato e per lo scheduler."""
+    now = _now()
+    day = quota_day(now)
+    next_reset = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=QUOTA_TIMEZONE)
+    limit = _ledger_settings.get('daily_limit', DEFAULT_DAILY_LIMIT)
+    status = {
+        'enabled': bool(_ledger_settings),
+        'quota_day': day,
+        'limit': limit,
+        'usage': 0,
+        'remaining': limit,
+        'percentage': 0,
+        'exhausted': False,
+        'by_method': {},
+        'resets_at': next_reset.astimezone().strftime('%d/%m/%Y %H:%M'),
+    }
+    if not _ledger_settings:
+        return status
+
+    conn = None
+    try:
+        conn = _connect(_ledger_settings['db_path'])
+        for method, calls, units in conn.execute(
+            "SELECT method, calls, units FROM youtube_quota_usage WHERE quota_day = ? ORDER BY units DESC", (day,)
+        ):
+            status['by_method'][method] = {'calls': calls, 'units': units}
+            status['usage'] += units
+        status['exhausted'] = conn.execute(
+            "SELECT 1 FROM youtube_quota_exhausted WHERE quota_day = ?", (day,)
+        ).fetchone() is not None
+    except sqlite3.Error as e:
+        logger.warning(f"Registro quota YouTube: impossibile leggere i consumi: {e}")
+    finally:
+        if conn: conn.close()
+
+    status['remaining'] = 0 if status['exhausted'] else max(0, limit - status['usage'])
+    status['percentage'] = 100 if status['exhausted'] else round(min(status['usage'], limit) / limit * 100, 2)
+    return status
+
+
+def remaining_units() -> int:
+    return get_quota_status()['remaining']
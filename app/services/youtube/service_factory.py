@@ -0,0 +1,161 @@
+# FILE: app/services/youtube/service_factory.py
+
+import os
+import json
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+import google.auth.transport.requests
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock tra processi, resta quello tra thread
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Il token viene rinnovato un po' prima della scadenza: una chiamata partita
+# con un token a pochi secondi dalla fine fallirebbe a metà.
+REFRESH_MARGIN = timedelta(minutes=5)
+
+# Stato del processo. Le credenziali sono condivise tra i thread e ricaricate dal file solo
+# quando cambia (un altro worker le ha rinnovate, OAuth rifatto, token revocato).
+_credentials_cache: Dict[str, dict] = {}
+_discovery_documents: Dict[Tuple[str, str], Optional[dict]] = {}
+_cache_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+# I servizi googleapiclient usano httplib2, che non è thread-safe: uno per thread.
+_thread_services = threading.local()
+
+
+def _token_mtime(token_path: str) -> Optional[int]:
+    try:
+        return os.stat(token_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _needs_refresh(credentials: Credentials) -> bool:
+    if not credentials.refresh_token:
+        return False
+    if not credentials.token:
+        return True
+    if credentials.expiry is None:
+        return False
+    # google-auth usa datetime UTC senza fuso
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return credentials.expiry - REFRESH_MARGIN <= now
+
+
+def _write_token(token_path: str, credentials: Credentials) -> None:
+    """Scrittura atomica: gli altri worker leggono il vecchio file o il nuovo, mai uno a metà."""
+    tmp_path = f"{token_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as token:
+        token.write(credentials.to_json())
+    os.replace(tmp_path, token_path)
+
+
+def _refresh(token_path: str, scopes) -> Credentials:
+    """
+    Rinnova il token tenendo un lock sul file accanto al token: con più worker gunicorn
+    solo il primo chiama Google, gli altri trovano il file già aggiornato e lo rileggono.
+    """
+    with _refresh_lock, open(f"{token_path}.lock", 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            credentials = Credentials.from_authorized_user_file(token_path, scopes)
+            if _needs_refresh(credentials):
+                logger.info("Token YouTube in scadenza: rinnovo.")
+                credentials.refresh(google.auth.transport.requests.Request())
+                _write_token(token_path, credentials)
+            else:
+                logger.info("Token YouTube già rinnovato da un altro processo: lo riuso.")
+            with _cache_lock:
+                _credentials_cache[token_path] = {'credentials': credentials, 'mtime': _token_mtime(token_path)}
+            return credentials
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_credentials(token_path: str, scopes=None) -> Optional[Credentials]:
+    """
+    Credenziali OAuth dalla cache del processo; None se il file del token non esiste.
+    Il file viene riletto solo se è cambiato. Un token in scadenza viene rinnovato e salvato
+    (gli errori di rinnovo arrivano al chiamante). Un token scaduto senza refresh token
+    viene restituito così com'è: decide il chiamante.
+    """
+    mtime = _token_mtime(token_path)
+    if mtime is None:
+        invalidate(token_path)
+        return None
+
+    with _cache_lock:
+        entry = _credentials_cache.get(token_path)
+        if not entry or entry['mtime'] != mtime:
+            entry = {'credentials': Credentials.from_authorized_user_file(token_path, scopes), 'mtime': mtime}
+            _credentials_cache[token_path] = entry
+        credentials = entry['credentials']
+
+    if _needs_refresh(credentials):
+        credentials = _refresh(token_path, scopes)
+    return credentials
+
+
+def store_credentials(token_path: str, credentials: Credentials) -> None:
+    """Salva le credenziali (es. dopo il flusso OAuth) e le mette subito in cache."""
+    _write_token(token_path, credentials)
+    with _cache_lock:
+        _credentials_cache[token_path] = {'credentials': credentials, 'mtime': _token_mtime(token_path)}
+
+
+def invalidate(token_path: str) -> None:
+    """Dimentica le credenziali in cache (token revocato o cancellato)."""
+    with _cache_lock:
+        _credentials_cache.pop(token_path, None)
+
+
+def _discovery_document(api: str, version: str) -> Optional[dict]:
+    """Documento di discovery incluso nella libreria, letto e interpretato una volta per processo."""
+    key = (api, version)
+    with _cache_lock:
+        if key not in _discovery_documents:
+            document = get_static_doc(api, version)
+            _discovery_documents[key] = json.loads(document) if document else None
+        return _discovery_documents[key]
+
+
+def get_service(api: str, version: str, token_path: str, scopes=None):
+    """
+    Servizio googleapiclient autenticato, costruito una volta per thread e per credenziali.
+    None se il token non esiste.
+    """
+    credentials = get_credentials(token_path, scopes)
+    if credentials is None:
+        return None
+
+    services = getattr(_thread_services, 'services', None)
+    if services is None:
+        services = _thread_services.services = {}
+    key = (token_path, api, version)
+    cached = services.get(key)
+    if cached and cached[0] is credentials:
+        return cached[1]
+
+    document = _discovery_document(api, version)
+    if document is not None:
+        service = build_from_document(document, credentials=credentials)
+    else:
+        service = build(api, version, credentials=credentials)
+    services[key] = (credentials, service)
+    return service
+
+
+def get_youtube_service(token_path: str, scopes=None):
+    return get_service('youtube', 'v3', token_path, scopes)
@@ -259,7 +259,10 @@ document.addEventListener("DOMContentLoaded", function () {
           const response = await fetch("/api/rss/process", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ rss_url: feedUrl }),
+            body: JSON.stringify({
+              rss_url: feedUrl,
+              full_backfill: !!document.getElementById("rss-full-backfill")?.checked,
+            }),
           });
           const data = await response.json();
           if (response.status === 202) {
@@ -7,7 +7,9 @@ from datetime import datetime
 import secrets
 import string
 import os
+import hashlib
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from app.core.effective_settings import get_effective_settings
 
 
 logger = logging.getLogger(__name__)
@@ -58,6 +60,11 @@ def normalize_url(raw_url: str) -> str:
 
 
 
+def compute_content_hash(content_text: str) -> str:
+    """Hash SHA-256 del testo, per riconoscere i contenuti non cambiati."""
+    return hashlib.sha256(content_text.encode('utf-8')).hexdigest()
+
+
 def generate_api_key(length=40):
     """Genera una chiave API sicura e casuale."""
     alphabet = string.ascii_letters + string.digits
@@ -68,71 +75,26 @@ def generate_api_key(length=40):
     random_part = ''.join(secrets.choice(alphabet) for _ in range(random_length))
     return prefix + random_part
 
-def build_full_config_for_background_process(user_id: str) -> dict:
+def build_full_config_for_background_process(user_id: str, apply_embedding_state: bool = True) -> dict:
     """
     Costruisce un dizionario di configurazione completo, unendo la configurazione di base
     dell'app con le impostazioni personalizzate (e non vuote) dell'utente.
     ORA CONSERVA ANCHE I MODELLI DI DEFAULT DEL SISTEMA.
+    Con apply_embedding_state=True il modello di embedding e le collezioni sono quelli ATTIVI
+    (durante una migrazione restano i vecchi); con False sono quelli richiesti dalle impostazioni.
+    Le impostazioni dell'utente arrivano dalla cache di get_effective_settings, non dal DB a ogni chiamata.
     """
-    full_config = {**current_app.config}
+    if user_id:
+        full_config = get_effective_settings(user_id).build_config(current_app.config, apply_embedding_state)
+    else:
+        full_config = {**current_app.config}
 
-    if 'RAG_MODELS_LIST' in full_config:
-        full_config['DEFAULT_RAG_MODELS_LIST_FROM_ENV'] = full_config['RAG_MODELS_LIST'][:] 
+    if 'RAG_MODELS_LIST' in current_app.config:
+        full_config['DEFAULT_RAG_MODELS_LIST_FROM_ENV'] = current_app.config['RAG_MODELS_LIST'][:]
 
     if 'USE_AGENTIC_CHUNKING' not in full_config:
         full_config['USE_AGENTIC_CHUNKING'] = os.environ.get('USE_AGENTIC_CHUNKING', 'False')
-    
-    if user_id:
-        db_path = current_app.config.get('DATABASE_FILE')
-        conn = None
-        try:
-            conn = sqlite3.connect(db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT llm_provider, llm_model_name, llm_embedding_model, llm_api_key, ollama_base_url FROM user_settings WHERE user_id = ?", (user_id,))
-            settings_row = cursor.fetchone()
-            
-            if settings_row:
-                logger.info(f"Trovate impostazioni utente per il processo (user: {user_id}). Applico sovrascritture.")
-                
-                user_provider = settings_row['llm_provider']
-                if user_provider and user_provider.strip():
-                    full_config['llm_provider'] = user_provider
-
-                user_model_name = settings_row['llm_model_name']
-                if user_model_name and user_model_name.strip():
-                    full_config['llm_model_name'] = user_model_name
-                    # Sovrascriviamo la lista RAG con quella dell'utente
-                    full_config['RAG_MODELS_LIST'] = [m.strip() for m in user_model_name.split(',') if m.strip()]
-
-                user_embedding_model = settings_row['llm_embedding_model']
-                if user_embedding_model and user_embedding_model.strip():
-                    full_config['llm_embedding_model'] = user_embedding_model
-
-                user_api_key = settings_row['llm_api_key']
-                if user_api_key and user_api_key.strip():
-                    # Conserviamo la chiave generica
-                    full_config['llm_api_key'] = user_api_key
-
-                    # MAPPIAMO esplicitamente la chiave alle variabili che i vari moduli si aspettano.
-                    # Questo evita che _index_article/_index_page non trovino la chiave in core_config.
-                    # Se in futuro aggiungiamo altri provider, estendiamo questa mappatura.
-                    full_config['GOOGLE_API_KEY'] = user_api_key
-                    # Se usi nomi diversi per embedding (es. GEMINI), manteniamo anche quello se non già impostato
-                    if not full_config.get('GEMINI_EMBEDDING_API_KEY'):
-                        full_config['GEMINI_EMBEDDING_API_KEY'] = user_api_key
-
-
-                user_ollama_url = settings_row['ollama_base_url']
-                if user_ollama_url and user_ollama_url.strip():
-                    full_config['ollama_base_url'] = user_ollama_url
-
-        except sqlite3.Error as e:
-            logger.error(f"Impossibile caricare le impostazioni utente per il processo (user: {user_id}): {e}")
-        finally:
-            if conn:
-                conn.close()
-    
+
     return full_config
 
 
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import argparse
+import sqlite3
+import logging
+
+import numpy as np
+
+# --- IMPOSTAZIONE DEL PERCORSO ---
+current_script_path = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_script_path)
+sys.path.append(project_root)
+# --- FINE IMPOSTAZIONE PERCORSO ---
+
+from app.main import create_app
+from app.services.embedding.embedding_service import truncate_and_normalize
+from app.services.embedding.model_migration import get_active_collection_name
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIMENSIONS = [3072, 1536, 768, 512, 256, 128]
+
+
+def load_collection_embeddings(app, user_id: str, base_name: str) -> np.ndarray:
+    """Carica tutti i vettori della collezione Chroma dell'utente."""
+    with app.app_context():
+        chroma_client = app.config.get('CHROMA_CLIENT')
+        collection = chroma_client.get_collection(name=get_active_collection_name(base_name, user_id, app.config))
+        data = collection.get(include=['embeddings'])
+    return np.asarray(data['embeddings'], dtype=np.float32)
+
+
+def run_benchmark(embeddings: np.ndarray, dimensions: list, n_queries: int, k: int, seed: int = 42):
+    """
+    Usa un campione di frammenti come query (escludendo il frammento stesso) e confronta
+    i top-k ottenuti a dimensione ridotta con quelli a dimensione piena.
+    Restituisce una riga per dimensione con recall@k, latenza media per query e spazio per vettore.
+    """
+    rng = np.random.default_rng(seed)
+    full_dim = embeddings.shape[1]
+    n_queries = min(n_queries, len(embeddings))
+    query_idx = rng.choice(len(embeddings), size=n_queries, replace=False)
+
+    def top_k(matrix, queries, idx):
+        scores = queries @ matrix.T
+        scores[np.arange(len(idx)), idx] = -np.inf # La query non deve trovare se stessa
+        return np.argsort(-scores, axis=1)[:, :k]
+
+    full = np.asarray(truncate_and_normalize(embeddings.tolist(), full_dim), dtype=np.float32)
+    reference = top_k(full, full[query_idx], query_idx)
+
+    rows = []
+    for dim in sorted({d for d in dimensions if d <= full_dim} | {full_dim}, reverse=True):
+        reduced = np.asarray(truncate_and_normalize(embeddings.tolist(), dim), dtype=np.float32)
+        start = time.perf_counter()
+        found = top_k(reduced, reduced[query_idx], query_idx)
+        latency_ms = (time.perf_counter() - start) * 1000 / n_queries
+        recall = np.mean([len(set(found[i]) & set(reference[i])) / k for i in range(n_queries)])
+        rows.append({
+            'dimension': dim,
+            'recall_at_k': round(float(recall), 4),
+            'latency_ms_per_query': round(latency_ms, 4),
+            'bytes_per_vector': dim * 4,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Misura il compromesso recall/latenza delle dimensioni ridotte degli embedding.")
+    parser.add_argument('--email', required=True, help="L'email dell'utente di cui usare la collezione.")
+    parser.add_argument('--collection', default='video_transcripts', help="Nome base della collezione (es. video_transcripts, document_content).")
+    parser.add_argument('--dimensions', default=','.join(str(d) for d in DEFAULT_DIMENSIONS), help="Dimensioni da provare, separate da virgola.")
+    parser.add_argument('--queries', type=int, default=200, help="Numero di frammenti usati come query.")
+    parser.add_argument('--k', type=int, default=15, help="Numero di risultati confrontati (come i chunk passati al prompt).")
+    args = parser.parse_args()
+
+    app = create_app()
+
+    user_id = None
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        row = conn.execute("SELECT id FROM users WHERE email = ?", (args.email,)).fetchone()
+        conn.close()
+        if row:
+            user_id = row[0]
+
+    if not user_id:
+        logger.error(f"Nessun utente trovato con l'email: {args.email}")
+        return
+
+    embeddings = load_collection_embeddings(app, user_id, args.collection)
+    if len(embeddings) <= args.k:
+        logger.error(f"La collezione contiene solo {len(embeddings)} vettori: troppo pochi per k={args.k}.")
+        return
+
+    dimensions = [int(d) for d in args.dimensions.split(',') if d.strip()]
+    logger.info(f"Benchmark su {len(embeddings)} vettori da {embeddings.shape[1]} dimensioni, {args.queries} query, k={args.k}.")
+
+    print(f"\n{'Dimensione':>10} | {'Recall@' + str(args.k):>10} | {'ms/query':>9} | {'Byte/vettore':>12}")
+    print("-" * 52)
+    for row in run_benchmark(embeddings, dimensions, args.queries, args.k):
+        print(f"{row['dimension']:>10} | {row['recall_at_k']:>10.4f} | {row['latency_ms_per_query']:>9.4f} | {row['bytes_per_vector']:>12}")
+
+
+if __name__ == "__main__":
+    main()
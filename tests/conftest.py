@@ -8,6 +8,7 @@ import logging
 # o che pytest sia eseguito dalla radice del progetto.
 from app.main import create_app, init_db
 from app.config import TestConfig
+from app.services.transcripts.youtube_transcript_unofficial_library import configure_transcript_fetcher
 
 _TEST_DATA_DIR_CONFTEST = None # Usa un nome diverso per evitare conflitti se test_app.py viene eseguito
 logger = logging.getLogger(__name__)
@@ -76,4 +77,11 @@ def app():
     
 @pytest.fixture(scope='function')
 def client(app):
-    return app.test_client()
\ No newline at end of file
+    return app.test_client()
+
+@pytest.fixture(autouse=True)
+def transcript_routes():
+    """Ogni test parte con gli instradamenti delle trascrizioni sani (un blocco simulato non passa al test dopo)."""
+    configure_transcript_fetcher({})
+    yield
+    configure_transcript_fetcher({})
@@ -67,9 +67,9 @@ def test_document_upload_respects_chunking_configuration(client, app, monkeypatc
     file_data = {'documents': (io.BytesIO(file_content), 'test_upload.txt')}
 
     # Definisci i path delle funzioni da "spiare"
-    path_agentic_chunker = 'app.api.routes.documents.chunk_text_agentically'
-    path_classic_chunker = 'app.api.routes.documents.split_text_into_chunks'
-    path_generate_embeddings = 'app.api.routes.documents.generate_embeddings' # Dobbiamo simulare anche questo
+    path_agentic_chunker = 'app.core.indexing_pipeline.chunk_text_agentically'
+    path_classic_chunker = 'app.core.indexing_pipeline.split_text_into_chunks'
+    path_generate_embeddings = 'app.core.indexing_pipeline.generate_embeddings' # Dobbiamo simulare anche questo
 
     # Prepara le "spie" (mocks)
     with patch(path_agentic_chunker, return_value=["chunk intelligente"]) as mock_agentic, \
@@ -0,0 +1,189 @@
+import uuid
+import sqlite3
+import pytest
+from unittest.mock import patch
+
+from app.services.embedding import model_migration
+from app.services.embedding.model_migration import (
+    request_embedding_migration, run_embedding_migration, get_embedding_model_state,
+    apply_active_embedding_state, get_collection_base_names, user_collection_name,
+    STATUS_PENDING, STATUS_FAILED, STATUS_IDLE
+)
+
+# Modello con cui sono state costruite le collezioni "storiche" dell'utente di test
+OLD_PROFILE = {'provider': 'google', 'model': 'models/old-embedding', 'dimension': 0}
+
+
+def _fake_embeddings(dimension):
+    """Finto provider: un vettore deterministico per testo, della dimensione richiesta."""
+    def _generate(texts, user_settings, task_type=None):
+        return [[float(len(text))] + [0.0] * (dimension - 1) for text in texts]
+    return _generate
+
+
+@pytest.fixture
+def legacy_user(app):
+    """Utente con una collezione storica di 3 frammenti indicizzati con OLD_PROFILE."""
+    user_id = str(uuid.uuid4())
+    chroma_client = app.config['CHROMA_CLIENT']
+    collection = chroma_client.get_or_create_collection(name=user_collection_name('document_content', user_id))
+    collection.upsert(
+        ids=[f"doc1_chunk_{i}" for i in range(3)],
+        embeddings=[[0.1, 0.2, 0.3]] * 3,
+        documents=["primo frammento", "secondo frammento", "terzo"],
+        metadatas=[{'doc_id': 'doc1', 'chunk_index': i} for i in range(3)]
+    )
+    yield user_id
+
+    state = get_embedding_model_state(app.config['DATABASE_FILE'], user_id) or {}
+    for suffix in {'', state.get('active_suffix') or '', state.get('target_suffix') or ''}:
+        for base_name in get_collection_base_names(app.config):
+            try:
+                chroma_client.delete_collection(name=user_collection_name(base_name, user_id, suffix))
+            except Exception:
+                pass
+    conn = sqlite3.connect(app.config['DATABASE_FILE'])
+    conn.execute("DELETE FROM embedding_model_state WHERE user_id = ?", (user_id,))
+    conn.commit()
+    conn.close()
+
+
+def test_migration_switches_only_at_full_coverage(app, legacy_user):
+    """
+    TEST SCENARIO 1: Con un cambio di modello la ricerca resta sulle vecchie collezioni,
+    poi a copertura completa lo switch rende attive quelle nuove e le vecchie vengono eliminate.
+    """
+    user_id = legacy_user
+    db_path = app.config['DATABASE_FILE']
+    chroma_client = app.config['CHROMA_CLIENT']
+
+    with app.app_context():
+        # ARRANGE: le impostazioni correnti chiedono un modello diverso da OLD_PROFILE
+        status = request_embedding_migration(user_id, previous_profile=OLD_PROFILE)
+        target_suffix = get_embedding_model_state(db_path, user_id)['target_suffix']
+
+        # Durante la migrazione ricerca e indicizzazione usano ancora il vecchio modello
+        active_config = apply_active_embedding_state(app.config, user_id)
+
+        # ACT
+        with patch.object(model_migration, 'generate_embeddings', side_effect=_fake_embeddings(8)) as mock_generate:
+            migrated = run_embedding_migration(user_id)
+
+    # ASSERT
+    assert status == STATUS_PENDING
+    assert active_config['GEMINI_EMBEDDING_MODEL'] == 'models/old-embedding'
+    assert active_config['EMBEDDING_COLLECTION_SUFFIX'] == ''
+
+    assert migrated is True
+    state = get_embedding_model_state(db_path, user_id)
+    assert state['status'] == STATUS_IDLE
+    assert state['active_suffix'] == target_suffix
+    assert state['target_suffix'] is None
+    assert state['active_profile']['model'] == app.config['GEMINI_EMBEDDING_MODEL']
+    assert mock_generate.call_args.kwargs['user_settings']['GEMINI_EMBEDDING_MODEL'] == app.config['GEMINI_EMBEDDING_MODEL']
+
+    new_collection = chroma_client.get_collection(name=user_collection_name('document_content', user_id, target_suffix))
+    assert new_collection.count() == 3
+    assert new_collection.metadata['embedding_dimension'] == 8
+    with pytest.raises(Exception):
+        chroma_client.get_collection(name=user_collection_name('document_content', user_id))
+
+
+def test_failed_migration_keeps_old_collections_and_resumes(app, legacy_user):
+    """
+    TEST SCENARIO 2: Se il provider fallisce, le vecchie collezioni restano attive e la
+    migrazione, marcata 'failed', può essere ripresa fino allo switch.
+    """
+    user_id = legacy_user
+    db_path = app.config['DATABASE_FILE']
+    chroma_client = app.config['CHROMA_CLIENT']
+
+    with app.app_context():
+        request_embedding_migration(user_id, previous_profile=OLD_PROFILE)
+
+        # ACT 1: il provider non restituisce embedding
+        with patch.object(model_migration, 'generate_embeddings', return_value=None):
+            first_attempt = run_embedding_migration(user_id)
+        failed_state = get_embedding_model_state(db_path, user_id)
+
+        # ACT 2: lo scheduler (o un nuovo salvataggio) riprende la migrazione
+        claimed = model_migration._claim_migration(db_path, user_id)
+        with patch.object(model_migration, 'generate_embeddings', side_effect=_fake_embeddings(8)):
+            second_attempt = run_embedding_migration(user_id)
+
+    # ASSERT
+    assert first_attempt is False
+    assert failed_state['status'] == STATUS_FAILED
+    assert failed_state['active_suffix'] == ''
+    assert failed_state['last_error']
+
+    assert claimed is True
+    assert second_attempt is True
+    state = get_embedding_model_state(db_path, user_id)
+    assert state['active_suffix'] == failed_state['target_suffix']
+    assert chroma_client.get_collection(name=user_collection_name('document_content', user_id, state['active_suffix'])).count() == 3
+
+
+def test_content_reindexed_during_migration_is_copied_again(app, legacy_user):
+    """
+    TEST SCENARIO 3: Un contenuto re-indicizzato tra due passaggi della migrazione mantiene gli stessi ID;
+    la collezione ombra se ne accorge dall'impronta e ricalcola il frammento con il testo nuovo.
+    """
+    user_id = legacy_user
+    db_path = app.config['DATABASE_FILE']
+    chroma_client = app.config['CHROMA_CLIENT']
+    bases = get_collection_base_names(app.config)
+    source = chroma_client.get_collection(name=user_collection_name('document_content', user_id))
+
+    with app.app_context():
+        request_embedding_migration(user_id, previous_profile=OLD_PROFILE)
+        target_suffix = get_embedding_model_state(db_path, user_id)['target_suffix']
+        with patch.object(model_migration, 'generate_embeddings', side_effect=_fake_embeddings(8)):
+            # ARRANGE: primo passaggio, poi il documento viene re-indicizzato sulle collezioni attive
+            first_copy = model_migration._sync_shadow_collections(chroma_client, user_id, bases, '', target_suffix, dict(app.config), 50, db_path)
+            source.upsert(ids=["doc1_chunk_0"], embeddings=[[0.3, 0.2, 0.1]], documents=["frammento riscritto a metà migrazione"],
+                          metadatas=[{'doc_id': 'doc1', 'chunk_index': 0}])
+
+            # ACT
+            migrated = run_embedding_migration(user_id)
+
+    # ASSERT
+    assert first_copy == 3
+    assert migrated is True
+    shadow = chroma_client.get_collection(name=user_collection_name('document_content', user_id, target_suffix))
+    chunk = shadow.get(ids=["doc1_chunk_0"], include=['documents', 'embeddings'])
+    assert chunk['documents'] == ["frammento riscritto a metà migrazione"]
+    assert chunk['embeddings'][0][0] == float(len("frammento riscritto a metà migrazione"))
+    assert shadow.count() == 3
+
+
+def test_startup_seed_uses_existing_collections_so_scheduler_detects_model_change(app, legacy_user):
+    """
+    TEST SCENARIO 4: Un utente senza stato registrato, con collezioni a 3 dimensioni, mentre il deployment
+    ora chiede vettori a 8: lo stato registrato all'avvio usa la dimensione delle collezioni
+    e il controllo dello scheduler (senza previous_profile) pianifica la migrazione.
+    """
+    user_id = legacy_user
+    db_path = app.config['DATABASE_FILE']
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (id, email, password_hash) VALUES (?, ?, ?)", (user_id, f"{user_id}@example.com", "x"))
+    conn.commit()
+    conn.close()
+
+    try:
+        with patch.dict(app.config, {'EMBEDDING_OUTPUT_DIMENSIONALITY': 8}), app.app_context():
+            # ACT
+            model_migration.seed_embedding_model_states(app)
+            seeded = get_embedding_model_state(db_path, user_id)
+            status = request_embedding_migration(user_id)
+            state = get_embedding_model_state(db_path, user_id)
+    finally:
+        conn = sqlite3.connect(db_path)
+        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        conn.commit()
+        conn.close()
+
+    # ASSERT
+    assert seeded['active_profile']['dimension'] == 3
+    assert status == STATUS_PENDING
+    assert state['target_profile']['dimension'] == 8
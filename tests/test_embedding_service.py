@@ -2,8 +2,13 @@ import pytest
 from unittest.mock import patch, MagicMock
 
 # Importiamo la funzione che vogliamo testare
-from app.services.embedding.embedding_service import generate_embeddings
+import math
+from app.services.embedding.embedding_service import (
+    generate_embeddings, truncate_and_normalize, align_query_embedding,
+    ensure_collection_dimension, EMBEDDING_DIMENSION_METADATA_KEY
+)
 from app.services.embedding.gemini_embedding import TASK_TYPE_DOCUMENT
+from app.services.rate_limiter.token_bucket import LANE_BACKGROUND
 
 # Definiamo i path delle funzioni che dovremo "ingannare" (mockare)
 # Usiamo i loro percorsi completi a partire dalla radice del progetto
@@ -59,7 +64,8 @@ def test_generate_embeddings_chooses_ollama_when_configured(app):
         mock_google_func.assert_not_called()
         mock_ollama_func.assert_called_once()
         # Verifichiamo anche che sia stata chiamata con i parametri giusti
-        mock_ollama_func.assert_called_with(test_texts, 'http://fake-ollama', 'nomic-embed-text')
+        # (i documenti da indicizzare passano dalla corsia background del rate limiter)
+        mock_ollama_func.assert_called_with(test_texts, 'http://fake-ollama', 'nomic-embed-text', lane=LANE_BACKGROUND)
 
 # --- Test Scenario 3: Il centralinista torna a Google per sicurezza ---
 def test_generate_embeddings_falls_back_to_google_if_ollama_model_is_missing(app):
@@ -84,4 +90,71 @@ def test_generate_embeddings_falls_back_to_google_if_ollama_model_is_missing(app
 
         # ASSERT
         mock_google_func.assert_called_once() # DEVE chiamare Google
-        mock_ollama_func.assert_not_called()  # NON deve chiamare Ollama
\ No newline at end of file
+        mock_ollama_func.assert_not_called()  # NON deve chiamare Ollama
+# --- Test Scenario 4: Dimensione ridotta degli embedding ---
+def test_generate_embeddings_reduces_dimension_for_ollama(app):
+    """
+    Verifica che con una dimensione ridotta impostata, i vettori di Ollama
+    (che non sa ridurli) vengano troncati e ri-normalizzati.
+    """
+    # ARRANGE
+    user_settings = {
+        'llm_provider': 'ollama',
+        'llm_embedding_model': 'nomic-embed-text',
+        'ollama_base_url': 'http://fake-ollama',
+        'EMBEDDING_OUTPUT_DIMENSIONALITY': 2
+    }
+
+    with patch(path_get_ollama_embeddings, return_value=[[3.0, 4.0, 12.0]]):
+        # ACT
+        with app.app_context():
+            result = generate_embeddings(texts=["testo"], user_settings=user_settings, task_type=TASK_TYPE_DOCUMENT)
+
+    # ASSERT: prime due componenti, norma unitaria
+    assert result == [[0.6, 0.8]]
+
+
+def test_generate_embeddings_asks_gemini_for_reduced_dimension(app):
+    """
+    Verifica che la dimensione ridotta venga chiesta direttamente a Gemini.
+    """
+    user_settings = {'llm_provider': 'google', 'llm_api_key': 'fake', 'EMBEDDING_OUTPUT_DIMENSIONALITY': 256}
+
+    with patch(path_get_google_embeddings, return_value=[[0.5] * 256]) as mock_google_func:
+        with app.app_context():
+            result = generate_embeddings(texts=["testo"], user_settings=user_settings, task_type=TASK_TYPE_DOCUMENT)
+
+    assert mock_google_func.call_args.kwargs['output_dimensionality'] == 256
+    assert len(result[0]) == 256
+    assert math.isclose(sum(v * v for v in result[0]), 1.0)
+
+
+def test_query_embedding_is_aligned_to_collection_dimension():
+    """
+    Verifica che la query a dimensione piena venga adattata alla dimensione registrata
+    nella collezione, e che una collezione "più grande" della query venga saltata.
+    """
+    small_collection = MagicMock(metadata={EMBEDDING_DIMENSION_METADATA_KEY: 2})
+    big_collection = MagicMock(metadata={EMBEDDING_DIMENSION_METADATA_KEY: 8})
+    legacy_collection = MagicMock(metadata=None)
+    query = [3.0, 4.0, 1.0, 1.0]
+
+    assert align_query_embedding(query, small_collection) == truncate_and_normalize([query], 2)[0]
+    assert align_query_embedding(query, big_collection) is None
+    assert align_query_embedding(query, legacy_collection) == query
+
+
+def test_collection_records_dimension_and_rejects_mismatch():
+    """
+    Verifica che la prima scrittura registri la dimensione e che una scrittura
+    con dimensione diversa venga rifiutata.
+    """
+    collection = MagicMock(metadata=None)
+    collection.name = "video_transcripts_test"
+
+    ensure_collection_dimension(collection, [[0.1, 0.2, 0.3]])
+    collection.modify.assert_called_once_with(metadata={EMBEDDING_DIMENSION_METADATA_KEY: 3})
+
+    collection.metadata = {EMBEDDING_DIMENSION_METADATA_KEY: 3}
+    with pytest.raises(ValueError):
+        ensure_collection_dimension(collection, [[0.1, 0.2]])
@@ -0,0 +1,83 @@
+import pytest
+from unittest.mock import patch
+
+from app.services.rate_limiter import token_bucket
+from app.services.rate_limiter.token_bucket import (
+    configure_rate_limiter, acquire, get_bucket_states, RateLimitTimeout,
+    BUCKET_GEMINI, BUCKET_OLLAMA, LANE_INTERACTIVE, LANE_BACKGROUND
+)
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    """Configura il limitatore su un DB temporaneo e ripristina lo stato precedente alla fine del test."""
+    config = {
+        'DATABASE_FILE': str(tmp_path / 'magazzino.db'),
+        'GEMINI_RATE_LIMIT_RPM': 4,
+        'OLLAMA_RATE_LIMIT_RPM': 0,
+        'RATE_LIMIT_INTERACTIVE_RESERVE': 0.5,
+        'RATE_LIMIT_INTERACTIVE_MAX_WAIT_SECONDS': 0,
+    }
+    previous_settings = dict(token_bucket._limiter_settings)
+    configure_rate_limiter(config)
+    yield config
+    token_bucket._limiter_settings.clear()
+    token_bucket._limiter_settings.update(previous_settings)
+
+
+def test_background_lane_leaves_interactive_reserve(limiter):
+    """
+    TEST SCENARIO 1: La corsia background si ferma alla riserva,
+    mentre la corsia interattiva può ancora consumare i gettoni rimasti.
+    """
+    # ARRANGE: secchio da 4 gettoni, metà riservati alle richieste interattive.
+    # Blocchiamo il tempo per evitare che il secchio si ricarichi durante il test.
+    with patch.object(token_bucket.time, 'time', return_value=1000.0):
+        # ACT: la corsia background prende 2 gettoni...
+        acquire(BUCKET_GEMINI, lane=LANE_BACKGROUND, max_wait=0)
+        acquire(BUCKET_GEMINI, lane=LANE_BACKGROUND, max_wait=0)
+
+        # ...ma il terzo intaccherebbe la riserva
+        with pytest.raises(RateLimitTimeout):
+            acquire(BUCKET_GEMINI, lane=LANE_BACKGROUND, max_wait=0)
+
+        # ASSERT: la chat passa comunque, fino a esaurimento
+        acquire(BUCKET_GEMINI, lane=LANE_INTERACTIVE)
+        acquire(BUCKET_GEMINI, lane=LANE_INTERACTIVE)
+        with pytest.raises(RateLimitTimeout):
+            acquire(BUCKET_GEMINI, lane=LANE_INTERACTIVE)
+
+        states = {s['name']: s for s in get_bucket_states()}
+
+    assert states[BUCKET_GEMINI]['available'] == 0
+    assert states[BUCKET_GEMINI]['total_acquired'] == 4
+    assert states[BUCKET_GEMINI]['total_throttled'] == 2
+
+
+def test_bucket_state_is_shared_between_processes(limiter, tmp_path):
+    """
+    TEST SCENARIO 2: Lo stato vive nel file SQLite accanto al DB principale,
+    quindi un secondo processo (simulato riconfigurando il modulo) vede i gettoni consumati.
+    """
+    with patch.object(token_bucket.time, 'time', return_value=2000.0):
+        acquire(BUCKET_GEMINI, lane=LANE_INTERACTIVE)
+
+        # "Nuovo worker": riconfigura da zero con la stessa configurazione
+        token_bucket._limiter_settings.clear()
+        configure_rate_limiter(limiter)
+        states = {s['name']: s for s in get_bucket_states()}
+
+    assert (tmp_path / 'rate_limiter.db').exists()
+    assert states[BUCKET_GEMINI]['available'] == 3
+
+
+def test_unlimited_or_unconfigured_buckets_never_wait(limiter):
+    """
+    TEST SCENARIO 3: Un provider con limite 0 (o un limitatore non configurato) non blocca mai.
+    """
+    for _ in range(20):
+        assert acquire(BUCKET_OLLAMA, lane=LANE_BACKGROUND, max_wait=0) == 0.0
+
+    token_bucket._limiter_settings.clear()
+    assert acquire(BUCKET_GEMINI, lane=LANE_BACKGROUND, max_wait=0) == 0.0
+    assert get_bucket_states() == []
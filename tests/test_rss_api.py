@@ -3,6 +3,7 @@ import time
 from unittest.mock import patch, MagicMock, ANY
 from flask import url_for
 import sqlite3
+from app.utils import compute_content_hash
 from app.api.routes import rss as rss_api # Importiamo il modulo per accedere alle sue variabili
 
 def setup_function(function):
@@ -79,4 +80,295 @@ def test_process_rss_feed_api_missing_url(client, app, monkeypatch):
     login_test_user_for_rss(client, app, monkeypatch, email="rssmissingurl@example.com")
     response = client.post(url_for('rss.process_rss_feed'), json={})
     assert response.status_code == 400
-    assert response.json['success'] is False
\ No newline at end of file
+    assert response.json['success'] is False
+
+def test_index_items_batches_embeddings_and_chroma_writes_across_articles(app):
+    """
+    TEST SCENARIO: più articoli indicizzati insieme passano per la pipeline a stadi con
+    una sola chiamata di embedding e un solo upsert su ChromaDB, e ognuno riceve il suo stato.
+    """
+    from app.core.indexing_pipeline import index_items, SOURCE_ARTICLE
+
+    # ARRANGE
+    user_id = "pipeline_user"
+    article_ids = [f"pipeline_art_{i}" for i in range(3)]
+    conn = sqlite3.connect(app.config['DATABASE_FILE'])
+    for i, article_id in enumerate(article_ids):
+        conn.execute(
+            "INSERT OR REPLACE INTO articles (article_id, article_url, title, content, user_id, processing_status) VALUES (?, ?, ?, ?, ?, 'pending')",
+            (article_id, f"https://example.com/pipeline-{i}", f"Titolo {i}", f"Contenuto dell'articolo numero {i}. " * 5, user_id)
+        )
+    conn.commit()
+
+    mock_collection = MagicMock()
+    mock_chroma = MagicMock()
+    mock_chroma.get_or_create_collection.return_value = mock_collection
+    core_config = {**app.config, 'CHROMA_CLIENT': mock_chroma, 'USE_AGENTIC_CHUNKING': 'False', 'EMBEDDING_MAX_BATCH_ITEMS': 100}
+    progress = []
+
+    # ACT
+    with app.app_context(), \
+         patch('app.core.indexing_pipeline.generate_embeddings', side_effect=lambda texts, **kwargs: [[0.1, 0.2]] * len(texts)) as mock_embed:
+        statuses = index_items(SOURCE_ARTICLE, article_ids, conn, user_id, core_config, progress_callback=lambda done, total: progress.append((done, total)))
+    conn.commit()
+
+    # ASSERT
+    assert statuses == {article_id: 'completed' for article_id in article_ids}
+    mock_embed.assert_called_once()
+    assert len(mock_embed.call_args[0][0]) == 3 # Un chunk per articolo, tutti nella stessa richiesta
+    mock_collection.upsert.assert_called_once()
+    upserted_ids = mock_collection.upsert.call_args.kwargs['ids']
+    assert upserted_ids == [f"{article_id}_chunk_0" for article_id in article_ids]
+    mock_collection.delete.assert_called_once_with(where={'article_id': {'$in': article_ids}})
+    assert progress[-1] == (3, 3)
+
+    db_statuses = dict(conn.execute(
+        f"SELECT article_id, processing_status FROM articles WHERE article_id IN ({','.join('?' * len(article_ids))})", article_ids
+    ).fetchall())
+    assert db_statuses == {article_id: 'completed' for article_id in article_ids}
+    conn.close()
+
+
+def test_index_items_retries_items_alone_when_group_embedding_fails(app):
+    """
+    TEST SCENARIO: un articolo che fa fallire l'embedding del gruppo non trascina con sé gli altri:
+    ogni contenuto viene riprovato da solo e solo quello problematico finisce in failed_embedding.
+    """
+    from app.core.indexing_pipeline import index_items, SOURCE_ARTICLE
+
+    # ARRANGE
+    user_id = "pipeline_user_group_failure"
+    article_ids = [f"pipeline_fail_{i}" for i in range(3)]
+    conn = sqlite3.connect(app.config['DATABASE_FILE'])
+    for i, article_id in enumerate(article_ids):
+        content = "CONTENUTO RIFIUTATO" if i == 1 else f"Contenuto valido numero {i}."
+        conn.execute(
+            "INSERT OR REPLACE INTO articles (article_id, article_url, title, content, user_id, processing_status) VALUES (?, ?, ?, ?, ?, 'pending')",
+            (article_id, f"https://example.com/fail-{i}", f"Titolo {i}", content, user_id)
+        )
+    conn.commit()
+
+    mock_chroma = MagicMock()
+    core_config = {**app.config, 'CHROMA_CLIENT': mock_chroma, 'USE_AGENTIC_CHUNKING': 'False', 'EMBEDDING_MAX_BATCH_ITEMS': 100}
+
+    def embed_unless_rejected(texts, **kwargs):
+        return None if any("RIFIUTATO" in text for text in texts) else [[0.1, 0.2]] * len(texts)
+
+    # ACT
+    with app.app_context(), \
+         patch('app.core.indexing_pipeline.generate_embeddings', side_effect=embed_unless_rejected):
+        statuses = index_items(SOURCE_ARTICLE, article_ids, conn, user_id, core_config)
+    conn.commit()
+    conn.close()
+
+    # ASSERT
+    assert statuses == {article_ids[0]: 'completed', article_ids[1]: 'failed_embedding', article_ids[2]: 'completed'}
+
+
+def test_scheduled_feed_check_uses_conditional_get(app):
+    """
+    TEST SCENARIO: lo scheduler salva ETag/Last-Modified del feed monitorato e li rimanda al controllo
+    successivo; se il server risponde 304 il run finisce dopo una sola richiesta.
+    """
+    # ARRANGE
+    import feedparser
+    user_id = "user_rss_conditional_get"
+    feed_url = "https://blog.example.com/feed"
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM monitored_rss_feeds WHERE user_id = ?", (user_id,))
+        conn.execute("INSERT INTO monitored_rss_feeds (user_id, feed_url) VALUES (?, ?)", (user_id, feed_url))
+        conn.commit()
+        conn.close()
+
+    changed = feedparser.FeedParserDict(status=200, etag='"v2"', modified='Mon, 01 Jan 2024 10:00:00 GMT', bozo=0, entries=[])
+    not_modified = feedparser.FeedParserDict(status=304, bozo=0, entries=[])
+
+    with app.app_context(), \
+         patch('app.api.routes.rss.feedparser.parse', side_effect=[changed, not_modified]) as mock_parse:
+        # ACT
+        first_run = rss_api._process_rss_feed_core(feed_url, user_id, dict(app.config), None, None, use_conditional_get=True)
+        second_run = rss_api._process_rss_feed_core(feed_url, user_id, dict(app.config), None, None, use_conditional_get=True)
+
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        saved = conn.execute("SELECT etag, last_modified FROM monitored_rss_feeds WHERE user_id = ?", (user_id,)).fetchone()
+        # Il feed non deve restare attivo per i test dello scheduler
+        conn.execute("DELETE FROM monitored_rss_feeds WHERE user_id = ?", (user_id,))
+        conn.commit()
+        conn.close()
+
+    # ASSERT
+    assert first_run is True and second_run is True
+    assert saved == ('"v2"', 'Mon, 01 Jan 2024 10:00:00 GMT')
+    assert mock_parse.call_count == 2
+    assert mock_parse.call_args_list[0].kwargs['etag'] is None
+    assert mock_parse.call_args_list[1].kwargs['etag'] == '"v2"'
+    assert mock_parse.call_args_list[1].kwargs['modified'] == 'Mon, 01 Jan 2024 10:00:00 GMT'
+
+
+def test_feed_import_scrapes_only_entries_without_full_content(app):
+    """
+    TEST SCENARIO: un articolo intero in content:encoded non viene scaricato dal sito;
+    quelli con il solo riassunto o con un estratto troncato sì, in parallelo, e il testo scaricato ha la precedenza.
+    """
+    # ARRANGE
+    import feedparser
+    user_id = "user_rss_scrape_when_needed"
+    full_body = "<p>" + " ".join(["parola"] * 200) + "</p>"
+    truncated_body = "<p>" + " ".join(["parola"] * 200) + " [&hellip;]</p>"
+    entries = [
+        feedparser.FeedParserDict(link="https://blog.example.com/completo", title="Completo", content=[feedparser.FeedParserDict(value=full_body)]),
+        feedparser.FeedParserDict(link="https://blog.example.com/troncato", title="Troncato", content=[feedparser.FeedParserDict(value=truncated_body)]),
+        feedparser.FeedParserDict(link="https://blog.example.com/riassunto", title="Riassunto", summary="<p>Solo un riassunto.</p>"),
+    ]
+    page = feedparser.FeedParserDict(status=200, bozo=0, entries=entries)
+    end = feedparser.FeedParserDict(status=200, bozo=0, entries=[])
+    core_config = {**app.config, 'RSS_SCRAPE_PER_HOST_DELAY_MS': 0}
+
+    with app.app_context(), \
+         patch('app.api.routes.rss.feedparser.parse', side_effect=[page, end]), \
+         patch('app.api.routes.rss.get_full_article_content', side_effect=lambda url: f"Testo completo da {url}") as mock_scrape, \
+         patch('app.api.routes.rss.index_items', side_effect=lambda source, ids, *args, **kwargs: {i: 'completed' for i in ids}):
+        # ACT
+        success = rss_api._process_rss_feed_core("https://blog.example.com/feed", user_id, core_config, None, None)
+
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        saved = dict(conn.execute("SELECT title, content FROM articles WHERE user_id = ?", (user_id,)).fetchall())
+        conn.close()
+
+    # ASSERT
+    assert success is True
+    assert sorted(call.args[0] for call in mock_scrape.call_args_list) == ["https://blog.example.com/riassunto", "https://blog.example.com/troncato"]
+    assert saved["Completo"].startswith("parola parola")
+    assert saved["Troncato"] == "Testo completo da https://blog.example.com/troncato"
+    assert saved["Riassunto"] == "Testo completo da https://blog.example.com/riassunto"
+
+
+def test_feed_pagination_stops_at_already_imported_pages_unless_backfill(app):
+    """
+    TEST SCENARIO: se la prima pagina del feed contiene solo articoli già completati la paginazione si ferma lì;
+    con full_backfill vengono lette anche le pagine successive dell'archivio.
+    """
+    # ARRANGE
+    import feedparser
+    user_id = "user_rss_early_stop"
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM articles WHERE user_id = ?", (user_id,))
+        conn.execute(
+            "INSERT INTO articles (article_id, article_url, normalized_url, title, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?)",
+            ("art-gia-importato", "https://blog.example.com/gia-importato", "https://blog.example.com/gia-importato", "Già importato", user_id, 'completed')
+        )
+        conn.commit()
+        conn.close()
+
+    def _pages():
+        known = feedparser.FeedParserDict(status=200, bozo=0, entries=[
+            feedparser.FeedParserDict(link="https://blog.example.com/gia-importato", title="Già importato", summary="<p>x</p>")
+        ])
+        empty = feedparser.FeedParserDict(status=200, bozo=0, entries=[])
+        return [known, known, empty]
+
+    with app.app_context():
+        # ACT
+        with patch('app.api.routes.rss.feedparser.parse', side_effect=_pages()) as mock_routine:
+            routine = rss_api._process_rss_feed_core("https://blog.example.com/feed", user_id, dict(app.config), None, None)
+        with patch('app.api.routes.rss.feedparser.parse', side_effect=_pages()) as mock_backfill:
+            backfill = rss_api._process_rss_feed_core("https://blog.example.com/feed", user_id, dict(app.config), None, None, full_backfill=True)
+
+    # ASSERT
+    assert routine is True and backfill is True
+    assert mock_routine.call_count == 1
+    assert mock_backfill.call_count == 3
+    assert mock_backfill.call_args_list[1].args[0] == "https://blog.example.com/feed?paged=2"
+
+
+def test_init_db_backfills_normalized_url_used_for_feed_dedupe(app):
+    """
+    TEST SCENARIO: un articolo salvato prima della colonna normalized_url viene completato da init_db
+    (URL normalizzato e hash del contenuto); il feed che lo ripropone con UTM e slash finale non crea un duplicato.
+    """
+    # ARRANGE
+    import feedparser
+    from app.core.setup import init_db
+    user_id = "user_rss_normalized_url"
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM articles WHERE user_id = ?", (user_id,))
+        conn.execute(
+            "INSERT INTO articles (article_id, article_url, title, content, user_id, processing_status) VALUES (?, ?, ?, ?, ?, ?)",
+            ("art-vecchio", "https://Blog.Example.com/vecchio/?utm_source=newsletter", "Vecchio", "Testo", user_id, 'completed')
+        )
+        conn.commit()
+        conn.close()
+
+    feed = feedparser.FeedParserDict(status=200, bozo=0, entries=[
+        feedparser.FeedParserDict(link="https://blog.example.com/vecchio/?utm_medium=rss", title="Vecchio", summary="<p>Testo</p>")
+    ])
+
+    with app.app_context():
+        # ACT
+        init_db(app.config)
+        with patch('app.api.routes.rss.feedparser.parse', side_effect=[feed]), \
+             patch('app.api.routes.rss.index_items') as mock_index:
+            success = rss_api._process_rss_feed_core("https://blog.example.com/feed", user_id, dict(app.config), None, None)
+
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        rows = conn.execute("SELECT article_id, normalized_url, content_hash FROM articles WHERE user_id = ?", (user_id,)).fetchall()
+        conn.close()
+
+    # ASSERT
+    assert success is True
+    mock_index.assert_not_called()
+    assert len(rows) == 1
+    assert rows[0][0] == "art-vecchio"
+    assert rows[0][1] == "https://blog.example.com/vecchio"
+    assert rows[0][2] == compute_content_hash("Testo")
+
+
+def test_feed_import_does_not_hold_write_lock_while_indexing(app):
+    """
+    TEST SCENARIO: durante l'indicizzazione (embedding) gli articoli nuovi sono già confermati
+    e un'altra connessione può scrivere sul DB senza attendere; gli stati finali vengono salvati.
+    """
+    # ARRANGE
+    import feedparser
+    user_id = "user_rss_short_transactions"
+    page = feedparser.FeedParserDict(status=200, bozo=0, entries=[
+        feedparser.FeedParserDict(link="https://blog.example.com/breve", title="Breve", content=[feedparser.FeedParserDict(value="<p>" + " ".join(["parola"] * 200) + "</p>")])
+    ])
+    end = feedparser.FeedParserDict(status=200, bozo=0, entries=[])
+    seen_during_indexing = {}
+
+    def fake_index_items(source, ids, conn, *args, **kwargs):
+        other = sqlite3.connect(app.config['DATABASE_FILE'], timeout=0)
+        try:
+            seen_during_indexing['pending'] = other.execute(
+                "SELECT COUNT(*) FROM articles WHERE user_id = ? AND processing_status = 'pending'", (user_id,)
+            ).fetchone()[0]
+            other.execute("UPDATE articles SET title = title WHERE user_id = ?", (user_id,))
+            other.commit()
+            seen_during_indexing['write_ok'] = True
+        finally:
+            other.close()
+        conn.executemany("UPDATE articles SET processing_status = 'completed' WHERE article_id = ?", [(i,) for i in ids])
+        return {i: 'completed' for i in ids}
+
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM articles WHERE user_id = ?", (user_id,))
+        conn.commit()
+        conn.close()
+        with patch('app.api.routes.rss.feedparser.parse', side_effect=[page, end]), \
+             patch('app.api.routes.rss.index_items', side_effect=fake_index_items):
+            # ACT
+            success = rss_api._process_rss_feed_core("https://blog.example.com/feed", user_id, dict(app.config), None, None)
+
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        statuses = [row[0] for row in conn.execute("SELECT processing_status FROM articles WHERE user_id = ?", (user_id,))]
+        conn.close()
+
+    # ASSERT
+    assert success is True
+    assert seen_during_indexing == {'pending': 1, 'write_ok': True}
+    assert statuses == ['completed']
@@ -1,7 +1,8 @@
 import pytest
 import sqlite3
-from unittest.mock import patch, MagicMock, ANY
+from unittest.mock import patch, ANY
 from flask import current_app
+from app.api.models.video import Video
 
 # Le funzioni helper rimangono le stesse, sono corrette.
 def setup_test_monitoring_data(app, user_id):
@@ -11,6 +12,7 @@ def setup_test_monitoring_data(app, user_id):
         cursor = conn.cursor()
         cursor.execute("DELETE FROM monitored_youtube_channels WHERE user_id = ?", (user_id,))
         cursor.execute("DELETE FROM monitored_rss_feeds WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM youtube_video_backlog WHERE user_id = ?", (user_id,))
         cursor.execute("INSERT OR IGNORE INTO monitored_youtube_channels (user_id, channel_id, is_active) VALUES (?, ?, ?)", (user_id, 'UC-test-channel', True))
         cursor.execute("INSERT OR IGNORE INTO monitored_rss_feeds (user_id, feed_url, is_active) VALUES (?, ?, ?)", (user_id, 'http://test.com/feed', True))
         conn.commit()
@@ -52,7 +54,7 @@ def test_scheduler_job_calls_correct_functions(app, monkeypatch):
     path_youtube_client_class = 'app.services.youtube.client.YouTubeClient' # La classe client vive qui
 
     # Dati finti che i nostri mock restituiranno
-    mock_video_list = [MagicMock()] 
+    mock_video_list = [Video(video_id='vid-scheduler', title='Video', url='...', channel_id='UC-test-channel', published_at='2023-01-01T00:00:00Z')]
 
     # Applichiamo tutte le nostre "spie" ai loro indirizzi reali
     with patch(path_create_app, return_value=app) as mock_create_app, \
@@ -62,7 +64,7 @@ def test_scheduler_job_calls_correct_functions(app, monkeypatch):
 
         # Configuriamo il comportamento della spia per YouTubeClient
         mock_yt_instance = MockYouTubeClient.return_value
-        mock_yt_instance.get_channel_videos_and_total_count.return_value = (mock_video_list, 1)
+        mock_yt_instance.iter_channel_video_pages.return_value = iter([mock_video_list])
 
         # Importiamo la funzione che vogliamo testare
         from app.scheduler_jobs import check_monitored_sources_job
@@ -93,5 +95,6 @@ def test_scheduler_job_calls_correct_functions(app, monkeypatch):
             user_id,
             ANY,
             None,
-            None
+            None,
+            use_conditional_get=True
         )
\ No newline at end of file
@@ -66,7 +66,7 @@ def test_scheduler_calls_processor_with_correct_data(app, monkeypatch):
          patch(path_youtube_client_class) as MockYouTubeClient:
         
         mock_yt_instance = MockYouTubeClient.return_value
-        mock_yt_instance.get_channel_videos_and_total_count.return_value = (mock_video_list, 1)
+        mock_yt_instance.iter_channel_video_pages.return_value = iter([mock_video_list])
 
         from app.scheduler_jobs import check_monitored_sources_job
         
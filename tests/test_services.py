@@ -6,7 +6,7 @@ from google.api_core import exceptions as google_exceptions
 from app.services.embedding.gemini_embedding import get_gemini_embeddings, TASK_TYPE_DOCUMENT
 
 # Importa le funzioni e classi da testare DAI LORO MODULI ORIGINALI
-from app.services.embedding.gemini_embedding import split_text_into_chunks
+from app.services.embedding.gemini_embedding import split_text_into_chunks, iter_chunk_spans, find_chunk_offsets
 from app.api.routes.documents import extract_text_from_file
 from app.services.transcripts.youtube_transcript import TranscriptService
 from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptFound
@@ -37,6 +37,104 @@ def test_split_text_with_overlap():
     ]
     assert split_text_into_chunks(text, chunk_size=5, chunk_overlap=2) == expected_chunks
 
+def test_chunk_spans_point_into_original_text():
+    """
+    TEST SCENARIO: Gli intervalli restituiti dal generatore indicano porzioni del testo
+    originale (spazi e a capo compresi) e find_chunk_offsets li ritrova dai chunk.
+    """
+    text = "uno due\ntre quattro   cinque sei sette otto nove dieci"
+    spans = list(iter_chunk_spans(text, chunk_size=5, chunk_overlap=0))
+    chunks = split_text_into_chunks(text, chunk_size=5, chunk_overlap=0)
+
+    assert [text[start:end] for start, end in spans] == chunks
+    assert chunks[0] == "uno due\ntre quattro   cinque"
+    assert find_chunk_offsets(text, chunks) == spans
+    assert find_chunk_offsets(text, ["testo riscritto dall'LLM"]) == [None]
+
+def test_chunk_spans_snap_to_sentence_end():
+    """
+    TEST SCENARIO: Se una frase finisce verso la fine della finestra, il chunk si ferma lì
+    e il successivo riparte dalla frase seguente (meno l'overlap).
+    """
+    text = "Uno due tre quattro cinque sei sette otto. Nove dieci undici dodici."
+    chunks = split_text_into_chunks(text, chunk_size=10, chunk_overlap=0)
+    assert chunks == ["Uno due tre quattro cinque sei sette otto.", "Nove dieci undici dodici."]
+
+def test_agentic_chunking_long_text_uses_parallel_windows():
+    """
+    TEST SCENARIO: Un testo più lungo della finestra viene mandato all'LLM a pezzi sovrapposti;
+    i confini delle zone di sovrapposizione vengono riconciliati senza chunk duplicati o persi.
+    """
+    import re
+    from app.services.chunking import agentic_chunker
+
+    sentences = [f"Frase numero {i} del documento." for i in range(60)]
+    text = " ".join(sentences) # 300 parole
+    settings = {'AGENTIC_CHUNKING_WINDOW_WORDS': 100, 'AGENTIC_CHUNKING_WINDOW_OVERLAP_WORDS': 20, 'AGENTIC_CHUNKING_MAX_WORKERS': 3}
+
+    # Finto LLM: una frase per chunk (la prima può essere un frammento, se la finestra inizia a metà frase)
+    def fake_llm(window_text, llm_provider, settings):
+        return [part.strip() for part in re.findall(r"[^.]+\.", window_text)]
+
+    with patch.object(agentic_chunker, '_chunk_single_text', side_effect=fake_llm) as mock_llm:
+        chunks = agentic_chunker.chunk_text_agentically(text, llm_provider='google', settings=settings)
+
+    assert mock_llm.call_count > 1
+    assert chunks == sentences
+
+def test_agentic_chunking_reuses_cached_boundaries(tmp_path):
+    """
+    TEST SCENARIO: Un reindex dello stesso testo con lo stesso modello non richiama l'LLM;
+    cambiando modello la cache non vale più.
+    """
+    from app.services.chunking import agentic_chunker, chunk_cache
+
+    # ARRANGE: cache su un DB temporaneo
+    previous_settings = dict(chunk_cache._cache_settings)
+    chunk_cache.configure_chunk_cache({'DATABASE_FILE': str(tmp_path / 'magazzino.db')})
+    text = "Primo argomento del video. Secondo argomento, del tutto diverso."
+    settings = {'GOOGLE_API_KEY': 'fake_api_key', 'RAG_MODELS_LIST': ['modello-a'], 'AGENTIC_CHUNKING_WINDOW_WORDS': 0}
+    llm_chunks = ["Primo argomento del video.", "Secondo argomento, del tutto diverso."]
+
+    try:
+        with patch.object(agentic_chunker, '_request_llm_chunks', return_value=llm_chunks) as mock_llm:
+            # ACT
+            first = agentic_chunker.chunk_text_agentically(text, llm_provider='google', settings=settings)
+            second = agentic_chunker.chunk_text_agentically(text, llm_provider='google', settings=settings)
+            calls_same_model = mock_llm.call_count
+            agentic_chunker.chunk_text_agentically(text, llm_provider='google', settings={**settings, 'RAG_MODELS_LIST': ['modello-b']})
+    finally:
+        chunk_cache._cache_settings.clear()
+        chunk_cache._cache_settings.update(previous_settings)
+
+    # ASSERT
+    assert first == second == llm_chunks
+    assert calls_same_model == 1
+    assert mock_llm.call_count == 2
+
+def test_agentic_chunking_boundary_mode_rebuilds_chunks_and_rejects_bad_indices():
+    """
+    TEST SCENARIO: In modalità 'boundaries' l'LLM riceve frasi numerate e restituisce solo
+    gli indici di inizio; i chunk sono ricostruiti dal testo. Indici fuori intervallo = risposta scartata.
+    """
+    from app.services.chunking import agentic_chunker
+
+    text = "Prima frase. Seconda frase.\n\nTerza frase sul nuovo tema. Quarta frase."
+    settings = {'GOOGLE_API_KEY': 'fake_api_key', 'RAG_MODELS_LIST': ['modello-a'], 'AGENTIC_CHUNKING_OUTPUT_MODE': 'boundaries'}
+
+    # ACT
+    with patch.object(agentic_chunker, '_call_llm', return_value='```json\n[2]\n```') as mock_llm:
+        chunks = agentic_chunker._request_llm_chunks(text, 'google', 'modello-a', settings)
+    sent_prompt = mock_llm.call_args.args[0]
+
+    with patch.object(agentic_chunker, '_call_llm', return_value='{"breaks": [2, 9]}'):
+        rejected = agentic_chunker._request_llm_chunks(text, 'google', 'modello-a', settings)
+
+    # ASSERT
+    assert "[0] Prima frase." in sent_prompt and "[3] Quarta frase." in sent_prompt
+    assert chunks == ["Prima frase. Seconda frase.", "Terza frase sul nuovo tema. Quarta frase."]
+    assert rejected == []
+
 def test_get_gemini_embeddings_handles_rate_limit_and_fails_gracefully(monkeypatch):
     monkeypatch.setattr("time.sleep", lambda seconds: None)
     mock_genai = MagicMock()
@@ -50,6 +148,111 @@ def test_get_gemini_embeddings_handles_rate_limit_and_fails_gracefully(monkeypat
     assert result is None
     assert mock_genai.embed_content.call_count == 5
 
+def test_gemini_embeddings_resume_from_completed_batches(monkeypatch, tmp_path):
+    """
+    TEST SCENARIO: Il secondo batch fallisce; i vettori del primo restano in cache
+    e il nuovo tentativo chiede all'API solo i testi mancanti.
+    """
+    from app.services.embedding import embedding_cache
+    from app.services.embedding.gemini_embedding import GeminiEmbeddingService
+
+    # ARRANGE: cache su un DB temporaneo, 150 testi = 2 batch (100 + 50)
+    previous_settings = dict(embedding_cache._cache_settings)
+    embedding_cache.configure_embedding_cache({'DATABASE_FILE': str(tmp_path / 'magazzino.db')})
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+    texts = [f"testo {i}" for i in range(150)]
+
+    def embed_first_batch_only(model, content, task_type):
+        if len(content) == 50:
+            raise google_exceptions.ResourceExhausted("Quota esaurita")
+        return {'embedding': [[0.5, 0.5] for _ in content]}
+
+    mock_genai = MagicMock()
+    mock_genai.embed_content.side_effect = embed_first_batch_only
+    try:
+        with patch('app.services.embedding.gemini_embedding.genai', mock_genai):
+            service = GeminiEmbeddingService(api_key="fake_api_key", model_name="fake_model")
+
+            # ACT 1: primo tentativo, fallisce a metà
+            progress = service.get_embeddings_with_progress(texts)
+            assert progress['completed'] == 100
+            assert progress['embeddings'][120] is None
+            assert service.get_embeddings(texts) is None
+
+            # ACT 2: il provider torna disponibile
+            mock_genai.embed_content.reset_mock()
+            mock_genai.embed_content.side_effect = lambda model, content, task_type: {'embedding': [[0.1, 0.9] for _ in content]}
+            result = service.get_embeddings(texts)
+    finally:
+        embedding_cache._cache_settings.clear()
+        embedding_cache._cache_settings.update(previous_settings)
+
+    # ASSERT: una sola chiamata, solo per i 50 testi mancanti
+    assert mock_genai.embed_content.call_count == 1
+    assert len(mock_genai.embed_content.call_args.kwargs['content']) == 50
+    assert len(result) == 150
+    assert result[0] == [0.5, 0.5]
+    assert result[149] == pytest.approx([0.1, 0.9])
+
+def test_gemini_query_embeddings_bypass_the_resume_cache():
+    """
+    TEST SCENARIO: gli embedding delle query di ricerca non leggono né scrivono la cache
+    di ripresa, che serve solo all'indicizzazione.
+    """
+    from app.services.embedding.gemini_embedding import GeminiEmbeddingService, TASK_TYPE_QUERY
+
+    # ARRANGE
+    mock_genai = MagicMock()
+    mock_genai.embed_content.side_effect = lambda model, content, task_type: {'embedding': [[0.3, 0.4] for _ in content]}
+    with patch('app.services.embedding.gemini_embedding.genai', mock_genai), \
+         patch('app.services.embedding.gemini_embedding.load_cached_embeddings') as mock_load, \
+         patch('app.services.embedding.gemini_embedding.store_embeddings') as mock_store:
+        service = GeminiEmbeddingService(api_key="fake_api_key", model_name="fake_model")
+        # ACT
+        result = service.get_embeddings(["cosa dice il video?"], task_type=TASK_TYPE_QUERY)
+
+    # ASSERT
+    assert result == [[0.3, 0.4]]
+    mock_load.assert_not_called()
+    mock_store.assert_not_called()
+
+def test_gemini_embeddings_pack_batches_by_tokens_and_split_oversized_texts(tmp_path):
+    """
+    TEST SCENARIO: Le richieste vengono riempite fino al limite di token; un testo oltre il limite
+    per testo viene diviso in porzioni e il suo vettore è la media normalizzata delle porzioni.
+    """
+    from app.services.embedding import embedding_cache
+    from app.services.embedding.gemini_embedding import GeminiEmbeddingService
+    from app.services.embedding.token_budget import count_tokens
+
+    # ARRANGE: cache vuota, limiti piccoli per rendere visibile il packing
+    previous_settings = dict(embedding_cache._cache_settings)
+    embedding_cache.configure_embedding_cache({'DATABASE_FILE': str(tmp_path / 'magazzino.db')})
+    limits = {'max_items': 100, 'max_batch_tokens': 30, 'max_text_tokens': 20}
+    long_text = " ".join(f"parola{i}" for i in range(30))
+    texts = ["breve uno", "breve due", long_text, "breve tre"]
+
+    mock_genai = MagicMock()
+    mock_genai.embed_content.side_effect = lambda model, content, task_type: {'embedding': [[1.0, 0.0] if c.startswith("breve") else [0.6, 0.8] for c in content]}
+    try:
+        with patch('app.services.embedding.gemini_embedding.genai', mock_genai):
+            service = GeminiEmbeddingService(api_key="fake_api_key", model_name="fake_model", limits=limits)
+            # ACT
+            result = service.get_embeddings(texts)
+    finally:
+        embedding_cache._cache_settings.clear()
+        embedding_cache._cache_settings.update(previous_settings)
+
+    # ASSERT
+    sent_batches = [call.kwargs['content'] for call in mock_genai.embed_content.call_args_list]
+    sent_pieces = [piece for batch in sent_batches for piece in batch]
+    assert all(sum(count_tokens(piece) for piece in batch) <= 30 for batch in sent_batches)
+    assert all(count_tokens(piece) <= 20 for piece in sent_pieces)
+    assert len(sent_pieces) > len(texts) # il testo lungo è stato diviso
+    assert len(result) == 4
+    assert result[0] == [1.0, 0.0]
+    assert result[2] == pytest.approx([0.6, 0.8])
+
 def test_unofficial_transcript_service_chooses_correct_strategy(monkeypatch):
     mock_transcript_object = MagicMock(is_generated=False, language_code='it')
     mock_transcript_object.fetch.return_value = [MagicMock(text='testo moderno')]
@@ -81,7 +81,7 @@ def test_youtube_processing_handles_quota_error_correctly(client, app, monkeypat
 
     mock_valid_credentials = MagicMock(valid=True)
     mock_yt_client_instance = MagicMock()
-    mock_yt_client_instance.get_channel_videos_and_total_count.side_effect = google_exceptions.ResourceExhausted("Simulated Google API Quota Exceeded")
+    mock_yt_client_instance.iter_channel_video_pages.side_effect = google_exceptions.ResourceExhausted("Simulated Google API Quota Exceeded")
 
     with patch(path_load_credentials, return_value=mock_valid_credentials), \
          patch(path_yt_client_class, return_value=mock_yt_client_instance):
@@ -1,8 +1,8 @@
 import pytest
 import sqlite3
-from unittest.mock import patch, MagicMock
 from flask import url_for
 from app.utils import build_full_config_for_background_process
+from app.core.effective_settings import bump_settings_version, get_effective_settings
 
 # --- NUOVA FUNZIONE HELPER (ROBUSTA E CORRETTA) ---
 # Questa funzione si occupa di creare e loggare un utente finto
@@ -33,6 +33,20 @@ def logged_in_user(client, app, monkeypatch):
     assert user_id is not None
     return user_id # Restituisce l'ID dell'utente loggato
 
+def _save_ai_settings(app, user_id, ai_settings):
+    """Scrive (o cancella, con None) le impostazioni AI dell'utente come fa la pagina impostazioni."""
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM user_settings WHERE user_id = ?", (user_id,))
+        if ai_settings:
+            conn.execute(
+                "INSERT INTO user_settings (user_id, llm_provider, llm_model_name, llm_embedding_model, llm_api_key, ollama_base_url) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, ai_settings['llm_provider'], ai_settings['llm_model_name'], ai_settings['llm_embedding_model'], ai_settings['llm_api_key'], ai_settings['ollama_base_url'])
+            )
+        conn.commit()
+        conn.close()
+        bump_settings_version(user_id)
+
 def test_build_config_with_user_overrides(app, client, logged_in_user):
     """
     TEST SCENARIO 1: Verifica che le impostazioni di un utente (Ollama)
@@ -43,24 +57,19 @@ def test_build_config_with_user_overrides(app, client, logged_in_user):
     app.config['llm_provider'] = 'google'
     app.config['RAG_MODELS_LIST'] = ['gemini-default']
     
-    mock_db_row = {
+    _save_ai_settings(app, logged_in_user, {
         'llm_provider': 'ollama',
         'llm_model_name': 'llama3:latest',
         'llm_embedding_model': 'nomic-embed-text',
         'llm_api_key': None,
         'ollama_base_url': 'http://ollama-host:11434'
-    }
-    mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = mock_db_row
-    mock_conn = MagicMock()
-    mock_conn.cursor.return_value = mock_cursor
-    
-    with patch('app.utils.sqlite3.connect', return_value=mock_conn):
-        # Usiamo il client per creare un contesto di richiesta REALE.
-        # È questo che rende 'current_user' disponibile.
-        with client:
-            # 2. ACT
-            full_config = build_full_config_for_background_process(user_id=logged_in_user)
+    })
+
+    # Usiamo il client per creare un contesto di richiesta REALE.
+    # È questo che rende 'current_user' disponibile.
+    with client:
+        # 2. ACT
+        full_config = build_full_config_for_background_process(user_id=logged_in_user)
 
     # 3. ASSERT
     assert full_config['llm_provider'] == 'ollama'
@@ -76,16 +85,43 @@ def test_build_config_with_no_user_settings(app, client, logged_in_user):
     app.config['llm_provider'] = 'google'
     app.config['RAG_MODELS_LIST'] = ['gemini-default']
     
-    mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = None
-    mock_conn = MagicMock()
-    mock_conn.cursor.return_value = mock_cursor
-    
-    with patch('app.utils.sqlite3.connect', return_value=mock_conn):
-        with client:
-            # 2. ACT
-            full_config = build_full_config_for_background_process(user_id=logged_in_user)
+    _save_ai_settings(app, logged_in_user, None)
+
+    with client:
+        # 2. ACT
+        full_config = build_full_config_for_background_process(user_id=logged_in_user)
 
     # 3. ASSERT
     assert full_config['llm_provider'] == 'google'
-    assert full_config['RAG_MODELS_LIST'] == ['gemini-default']
\ No newline at end of file
+    assert full_config['RAG_MODELS_LIST'] == ['gemini-default']
+
+def test_effective_settings_are_cached_until_the_version_changes(app, client, logged_in_user):
+    """
+    TEST SCENARIO 3: Le impostazioni effettive restano in cache (nessuna lettura di user_settings
+    a ogni chiamata) finché un salvataggio non incrementa la versione.
+    """
+    # 1. ARRANGE
+    _save_ai_settings(app, logged_in_user, {
+        'llm_provider': 'google', 'llm_model_name': 'gemini-a, gemini-b',
+        'llm_embedding_model': None, 'llm_api_key': 'chiave-utente', 'ollama_base_url': None
+    })
+    config = {**app.config, 'USER_SETTINGS_CACHE_CHECK_SECONDS': 0} # Ricontrolla la versione a ogni chiamata
+
+    with app.app_context():
+        # 2. ACT
+        first = get_effective_settings(logged_in_user, config)
+        # Modifica "alle spalle" della cache, senza incrementare la versione
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("UPDATE user_settings SET llm_model_name = 'gemini-c' WHERE user_id = ?", (logged_in_user,))
+        conn.commit()
+        conn.close()
+        still_cached = get_effective_settings(logged_in_user, config)
+        bump_settings_version(logged_in_user)
+        reloaded = get_effective_settings(logged_in_user, config)
+
+    # 3. ASSERT
+    assert first.rag_models == ['gemini-a', 'gemini-b']
+    assert first.llm_api_key == 'chiave-utente'
+    assert still_cached is first
+    assert reloaded is not first
+    assert reloaded.rag_models == ['gemini-c']
@@ -56,12 +56,10 @@ def test_wordpress_sync_logic(client, app, monkeypatch):
     
     # Definiamo i path di TUTTE le funzioni esterne O LENTE che dobbiamo "ingannare"
     path_to_wp_client = 'app.api.routes.website.WordPressClient'
-    path_to_index_article = 'app.api.routes.website._index_article' # <-- NUOVO PATCH
-    path_to_index_page = 'app.api.routes.website._index_page'       # <-- NUOVO PATCH
+    path_to_index_items = 'app.api.routes.website.index_items'
 
     with patch(path_to_wp_client, return_value=mock_wp_client_instance) as mock_wp_client_class, \
-         patch(path_to_index_article, return_value='completed') as mock_index_article_func, \
-         patch(path_to_index_page, return_value='completed') as mock_index_page_func:
+         patch(path_to_index_items, side_effect=lambda source, ids, *args, **kwargs: {i: 'completed' for i in ids}) as mock_index_items:
         
         # 2. ACT
         from app.api.routes.website import _background_wp_sync_core
@@ -82,9 +80,10 @@ def test_wordpress_sync_logic(client, app, monkeypatch):
             _background_wp_sync_core(app.app_context(), user_id, settings, fake_core_config)
 
         # 3. ASSERT
-        # Verifichiamo che le funzioni di indicizzazione siano state CHIAMATE
-        mock_index_article_func.assert_called_once()
-        mock_index_page_func.assert_called_once()
+        # Verifichiamo che l'indicizzazione sia stata CHIAMATA una volta per tipo, con tutti i contenuti nuovi
+        from app.core.indexing_pipeline import SOURCE_ARTICLE, SOURCE_PAGE
+        assert [call.args[0] for call in mock_index_items.call_args_list] == [SOURCE_ARTICLE, SOURCE_PAGE]
+        assert all(len(call.args[1]) == 1 for call in mock_index_items.call_args_list)
         
         # E verifichiamo comunque che i dati base siano stati inseriti nel DB
         # (perché questo lo fa _background_wp_sync_core prima di chiamare l'indicizzazione)
@@ -0,0 +1,76 @@
+import pytest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+from googleapiclient.errors import HttpError
+
+from app.services.youtube import quota_ledger
+from app.services.youtube.quota_ledger import configure_quota_ledger, get_quota_status, QUOTA_TIMEZONE
+from app.services.youtube.client import YouTubeClient
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    """Configura il registro su un DB temporaneo e ripristina lo stato precedente alla fine del test."""
+    previous_settings = dict(quota_ledger._ledger_settings)
+    configure_quota_ledger({'DATABASE_FILE': str(tmp_path / 'magazzino.db'), 'YOUTUBE_QUOTA_DAILY_LIMIT': 1000})
+    yield
+    quota_ledger._ledger_settings.clear()
+    quota_ledger._ledger_settings.update(previous_settings)
+
+
+@pytest.fixture
+def youtube_client(monkeypatch):
+    mock_youtube_service = MagicMock()
+    with patch('app.services.youtube.client.get_youtube_service', return_value=mock_youtube_service):
+        yield YouTubeClient(token_file="dummy_token.json"), mock_youtube_service
+
+
+def test_client_calls_are_recorded_with_their_unit_cost(ledger, youtube_client):
+    """
+    TEST SCENARIO 1: ogni chiamata del client finisce nel registro con il costo documentato;
+    a mezzanotte ora del Pacifico il conteggio riparte da zero.
+    """
+    # ARRANGE
+    client, service = youtube_client
+    service.captions.return_value.list.return_value.execute.return_value = {
+        'items': [{'id': 'track1', 'snippet': {'language': 'it', 'trackKind': 'standard'}}]
+    }
+    service.captions.return_value.download.return_value.execute.return_value = b"1\n00:00:01,000 --> 00:00:02,000\nCiao\n"
+    before_midnight = datetime(2026, 3, 10, 23, 59, tzinfo=QUOTA_TIMEZONE)
+    after_midnight = datetime(2026, 3, 11, 0, 1, tzinfo=QUOTA_TIMEZONE)
+
+    # ACT
+    with patch.object(quota_ledger, '_now', return_value=before_midnight):
+        transcript = client.get_transcript_by_api('vid1')
+        status = get_quota_status()
+    with patch.object(quota_ledger, '_now', return_value=after_midnight):
+        status_next_day = get_quota_status()
+
+    # ASSERT
+    assert transcript['text'] == 'Ciao'
+    assert status['usage'] == 250
+    assert status['remaining'] == 750
+    assert status['by_method']['captions.download'] == {'calls': 1, 'units': 200}
+    assert status_next_day['usage'] == 0
+    assert status_next_day['remaining'] == 1000
+
+
+def test_quota_exceeded_response_empties_the_remaining_budget(ledger, youtube_client):
+    """
+    TEST SCENARIO 2: se YouTube risponde quotaExceeded il budget residuo del giorno è zero,
+    anche se il nostro conteggio locale è più basso (altri client usano lo stesso progetto).
+    """
+    # ARRANGE
+    client, service = youtube_client
+    quota_error = HttpError(resp=MagicMock(status=403), content=b'{"error": {"errors": [{"reason": "quotaExceeded"}]}}')
+    service.videos.return_value.list.return_value.execute.side_effect = quota_error
+
+    # ACT
+    with pytest.raises(HttpError):
+        client.get_video_details('vid1')
+    status = get_quota_status()
+
+    # ASSERT
+    assert status['usage'] == 1
+    assert status['exhausted'] is True
+    assert status['remaining'] == 0
@@ -0,0 +1,77 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from app.services.youtube import service_factory
+
+
+def _write_token(path, token, expires_in):
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + expires_in
+    credentials = Credentials(token=token, refresh_token='refresh-token', client_id='client-id',
+                              client_secret='client-secret', token_uri='https://oauth2.googleapis.com/token', expiry=expiry)
+    path.write_text(credentials.to_json())
+
+
+@pytest.fixture
+def token_path(tmp_path):
+    path = tmp_path / 'token.json'
+    yield path
+    service_factory.invalidate(str(path))
+
+
+def test_service_is_built_once_per_thread_and_token_file_read_once(token_path):
+    """
+    TEST SCENARIO 1: richieste ripetute nello stesso thread riusano servizio e credenziali
+    (niente nuova lettura del token né nuova costruzione); un altro thread ha il suo servizio.
+    """
+    # ARRANGE
+    _write_token(token_path, 'token-valido', timedelta(hours=1))
+    path = str(token_path)
+
+    with patch.object(service_factory, 'build_from_document', side_effect=lambda *a, **kw: MagicMock()) as mock_build, \
+         patch.object(service_factory.Credentials, 'from_authorized_user_file', wraps=Credentials.from_authorized_user_file) as mock_read:
+        # ACT
+        first = service_factory.get_youtube_service(path)
+        second = service_factory.get_youtube_service(path)
+        other_thread = []
+        worker = threading.Thread(target=lambda: other_thread.append(service_factory.get_youtube_service(path)))
+        worker.start()
+        worker.join()
+
+    # ASSERT
+    assert first is second
+    assert other_thread[0] is not first
+    assert mock_build.call_count == 2
+    assert mock_read.call_count == 1
+
+
+def test_expiring_token_is_refreshed_once_and_saved_for_other_workers(token_path):
+    """
+    TEST SCENARIO 2: un token vicino alla scadenza viene rinnovato e scritto sul file;
+    un worker che arriva dopo trova il file già aggiornato e non chiama Google di nuovo.
+    """
+    # ARRANGE
+    _write_token(token_path, 'token-in-scadenza', timedelta(minutes=1))
+    path = str(token_path)
+
+    def fake_refresh(credentials, request):
+        credentials.token = 'token-rinnovato'
+        credentials.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+    with patch.object(service_factory.Credentials, 'refresh', autospec=True, side_effect=fake_refresh) as mock_refresh:
+        # ACT
+        credentials = service_factory.get_credentials(path)
+        again = service_factory.get_credentials(path)
+        # Un altro worker con in memoria il vecchio token passa comunque dal lock
+        from_other_worker = service_factory._refresh(path, None)
+
+    # ASSERT
+    assert credentials.token == 'token-rinnovato'
+    assert again is credentials
+    assert from_other_worker.token == 'token-rinnovato'
+    assert mock_refresh.call_count == 1
+    assert json.loads(token_path.read_text())['token'] == 'token-rinnovato'
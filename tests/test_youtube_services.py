@@ -1,10 +1,13 @@
 import pytest
 from unittest.mock import patch, MagicMock
-from app.services.transcripts.youtube_transcript_unofficial_library import UnofficialTranscriptService
+from googleapiclient.errors import HttpError
+from app.services.transcripts.youtube_transcript_unofficial_library import UnofficialTranscriptService, configure_transcript_fetcher
 from app.services.youtube.client import YouTubeClient
 from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptFound
 import sqlite3
-from app.core.youtube_processor import _process_youtube_channel_core
+import threading
+import itertools
+from app.core.youtube_processor import _process_youtube_channel_core, process_channel_with_backlog
 from app.api.models.video import Video
 
 # Definiamo il percorso della CLASSE che vogliamo "ingannare"
@@ -74,6 +77,56 @@ def test_unofficial_transcript_ip_blocked_error():
     assert result['error'] == 'IP_BLOCKED'
     assert 'bloccato' in result['message']
 
+def test_unofficial_transcript_rotates_proxies_and_pauses_blocked_ones():
+    """
+    TEST SCENARIO 4: con due proxy, il primo bloccato da YouTube va in pausa e il video passa dal secondo;
+    le richieste successive usano solo il proxy sano e la sua sessione keep-alive.
+    """
+    # ARRANGE
+    configure_transcript_fetcher({'YOUTUBE_TRANSCRIPT_PROXIES': 'http://proxy-a:8080, http://proxy-b:8080'})
+    sessions_used = []
+
+    def _api_for_session(http_client):
+        sessions_used.append(http_client)
+        api = MagicMock()
+        if http_client.proxies['https'] == 'http://proxy-a:8080':
+            api.list.side_effect = Exception("YouTube is blocking requests from your IP")
+        else:
+            transcript = MagicMock(is_generated=True, language_code='it')
+            transcript.fetch.return_value = [MagicMock(text='via proxy')]
+            api.list.return_value.find_transcript.return_value = transcript
+        return api
+
+    with patch(YOUTUBE_TRANSCRIPT_API_PATH, side_effect=_api_for_session), \
+         patch('app.services.transcripts.youtube_transcript_unofficial_library._route_counter', itertools.count()):
+        # ACT
+        first = UnofficialTranscriptService.get_transcript('video_1')
+        second = UnofficialTranscriptService.get_transcript('video_2')
+
+    # ASSERT
+    assert first['text'] == 'via proxy' and second['text'] == 'via proxy'
+    assert [s.proxies['https'] for s in sessions_used] == ['http://proxy-a:8080', 'http://proxy-b:8080', 'http://proxy-b:8080']
+    assert sessions_used[1] is sessions_used[2]
+
+
+def test_unofficial_transcript_skips_network_while_ip_is_blocked():
+    """
+    TEST SCENARIO 5: dopo un blocco IP della connessione diretta, i video successivi
+    ricevono subito IP_BLOCKED senza un'altra richiesta a YouTube.
+    """
+    # ARRANGE
+    mock_api_instance = MagicMock()
+    mock_api_instance.list.side_effect = Exception("HTTP Error 429: Too Many Requests")
+
+    with patch(YOUTUBE_TRANSCRIPT_API_PATH, return_value=mock_api_instance) as mock_api_class:
+        # ACT
+        first = UnofficialTranscriptService.get_transcript('video_blocked_1')
+        second = UnofficialTranscriptService.get_transcript('video_blocked_2')
+
+    # ASSERT
+    assert first['error'] == 'IP_BLOCKED' and second['error'] == 'IP_BLOCKED'
+    mock_api_class.assert_called_once()
+
 # Il resto dei test in questo file non era fallito, ma li lascio per completezza e coerenza
 @pytest.mark.parametrize("url_input, expected_id", [
     ("UCJSuTw2VDoX0CWejniSo5TA", "UCJSuTw2VDoX0CWejniSo5TA"),
@@ -151,12 +204,9 @@ def test_get_channel_videos_handles_pagination_with_playlist_method(monkeypatch)
         mock_playlist_page2
     ]
 
-    # Sostituiamo il vero 'build' di googleapiclient con il nostro attore
-    path_to_build = 'app.services.youtube.client.build'
-    with patch(path_to_build, return_value=mock_youtube_service):
-        # Impediamo al client di cercare un vero file di token
-        monkeypatch.setattr("app.services.youtube.client.Credentials.from_authorized_user_file", lambda *args, **kwargs: MagicMock())
-        monkeypatch.setattr("os.path.exists", lambda path: True)
+    # Sostituiamo il servizio (credenziali e discovery) con il nostro attore
+    path_to_service = 'app.services.youtube.client.get_youtube_service'
+    with patch(path_to_service, return_value=mock_youtube_service):
         
         # 2. ACT: Creiamo il nostro client e chiamiamo la funzione da testare
         client = YouTubeClient(token_file="dummy_token.json")
@@ -172,6 +222,54 @@ def test_get_channel_videos_handles_pagination_with_playlist_method(monkeypatch)
     mock_youtube_service.channels.return_value.list.assert_called_once()
     assert mock_youtube_service.playlistItems.return_value.list.return_value.execute.call_count == 2
 
+def test_get_channel_videos_incremental_stops_at_known_videos_and_uses_etag(monkeypatch):
+    """
+    TEST SCENARIO: con i video già noti la scansione si ferma alla prima pagina fatta solo di video noti;
+    al run successivo la prima pagina invariata (304 sull'ETag) non restituisce nulla.
+    """
+    # ARRANGE
+    def _page(video_ids, next_token=None):
+        page = {
+            'etag': 'etag-pagina-1',
+            'pageInfo': {'totalResults': 120},
+            'items': [{'snippet': {'title': v, 'publishedAt': '2023-01-01T00:00:00Z', 'description': '',
+                                   'resourceId': {'kind': 'youtube#video', 'videoId': v}}} for v in video_ids],
+        }
+        if next_token:
+            page['nextPageToken'] = next_token
+        return page
+
+    mock_youtube_service = MagicMock()
+    playlist_request = mock_youtube_service.playlistItems.return_value.list.return_value
+    playlist_request.headers = {}
+    not_modified = HttpError(resp=MagicMock(status=304), content=b'')
+    playlist_request.execute.side_effect = [
+        _page(['new1', 'old1'], 'token_2'),
+        _page(['old2', 'old3'], 'token_3'),
+        not_modified,
+    ]
+    listing_state = {'uploads_playlist_id': 'UU-fake-playlist-id'}
+
+    with patch('app.services.youtube.client.get_youtube_service', return_value=mock_youtube_service):
+        client = YouTubeClient(token_file="dummy_token.json")
+
+        # ACT
+        videos, total_count = client.get_channel_videos_and_total_count(
+            "fake_channel", known_video_ids={'old1', 'old2', 'old3'}, listing_state=listing_state
+        )
+        videos_again, total_again = client.get_channel_videos_and_total_count(
+            "fake_channel", known_video_ids={'new1', 'old1', 'old2', 'old3'}, listing_state=listing_state
+        )
+
+    # ASSERT: la terza pagina non viene mai chiesta, la playlist non viene ricercata
+    assert [v.video_id for v in videos] == ['new1', 'old1', 'old2', 'old3']
+    assert total_count == 120
+    assert listing_state['etag'] == 'etag-pagina-1'
+    assert playlist_request.headers['If-None-Match'] == 'etag-pagina-1'
+    assert videos_again == [] and total_again == 120
+    assert playlist_request.execute.call_count == 3
+    mock_youtube_service.channels.return_value.list.assert_not_called()
+
 def test_youtube_processor_core_logic(app, monkeypatch):
     """
     Testa la logica core del processore YouTube, verificando anche che i dati
@@ -262,4 +360,262 @@ def test_youtube_processor_core_logic(app, monkeypatch):
     
     # Verifica che fragment_count sia stato salvato correttamente
     # Ci aspettiamo 1 perché mock_chunks ha 1 elemento
-    assert video_salvato['fragment_count'] == 1
\ No newline at end of file
+    assert video_salvato['fragment_count'] == 1
+def test_youtube_processor_fetches_transcripts_in_parallel_with_source_limits(app):
+    """
+    TEST SCENARIO: Le trascrizioni vengono scaricate in parallelo senza superare il limite della
+    libreria non ufficiale; embedding e upsert restano nell'ordine dei video.
+    """
+    import time
+    import threading
+
+    user_id_test = "user_for_parallel_transcripts"
+    videos_from_yt_api = [
+        Video(video_id=f"vid_parallel_{i}", title=f"Video {i}", channel_id="channel_parallel", published_at="2023-01-02T00:00:00Z", url="...")
+        for i in range(6)
+    ]
+
+    # ARRANGE: la trascrizione "finta" impiega un po' e registra quante ne girano insieme
+    active, max_active = [0], [0]
+    counter_lock = threading.Lock()
+
+    def slow_transcript(video_id):
+        with counter_lock:
+            active[0] += 1
+            max_active[0] = max(max_active[0], active[0])
+        time.sleep(0.1)
+        with counter_lock:
+            active[0] -= 1
+        return {'text': f"Trascrizione di {video_id}.", 'language': 'it', 'type': 'auto'}
+
+    mock_core_config = {
+        **app.config, 'CHROMA_CLIENT': MagicMock(), 'VIDEO_COLLECTION_NAME': 'video_transcripts',
+        'YOUTUBE_TRANSCRIPT_WORKERS': 4, 'YOUTUBE_TRANSCRIPT_UNOFFICIAL_CONCURRENCY': 2
+    }
+    mock_chroma_collection = MagicMock()
+    mock_core_config['CHROMA_CLIENT'].get_or_create_collection.return_value = mock_chroma_collection
+
+    with patch('app.core.youtube_processor.UnofficialTranscriptService.get_transcript', side_effect=slow_transcript), \
+         patch('app.core.youtube_processor.TranscriptService.get_transcript') as mock_official, \
+         patch('app.core.youtube_processor.YouTubeClient', MagicMock()), \
+         patch('app.core.youtube_processor.generate_embeddings', side_effect=lambda chunks, **kwargs: [[0.1] * 8 for _ in chunks]):
+        status_dict_fake = {}
+        with app.app_context():
+            # ACT
+            result = _process_youtube_channel_core(
+                channel_id="channel_parallel", user_id=user_id_test, core_config=mock_core_config,
+                videos_from_yt_models=videos_from_yt_api, status_dict=status_dict_fake, use_official_api_only=False
+            )
+
+    # ASSERT
+    assert result['success'] is True
+    assert result['new_videos_processed'] == 6
+    assert max_active[0] == 2
+    mock_official.assert_not_called()
+    upserted_ids = [call.kwargs['ids'][0] for call in mock_chroma_collection.upsert.call_args_list]
+    assert upserted_ids == [f"vid_parallel_{i}_chunk_0" for i in range(6)]
+    assert status_dict_fake['total_videos'] == 6
+
+
+def test_youtube_processor_resumes_interrupted_videos_from_checkpoint(app):
+    """
+    TEST SCENARIO: Un import interrotto lascia video con trascrizione salvata ma embedding non confermati.
+    Il nuovo run li riprende senza riscaricare la trascrizione; se i frammenti sono già in ChromaDB
+    non rifà nemmeno gli embedding. I video conclusi restano saltati.
+    """
+    user_id_test = "user_for_checkpoint_resume"
+    transcript = "Trascrizione salvata al checkpoint."
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM videos WHERE user_id = ?", (user_id_test,))
+        for video_id, status in (("vid_done", "completed"), ("vid_upserted", "processing_embedding"), ("vid_interrupted", "processing_embedding")):
+            conn.execute(
+                "INSERT INTO videos (video_id, title, user_id, channel_id, published_at, url, transcript, transcript_language, captions_type, processing_status) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                (video_id, video_id, user_id_test, "channel_checkpoint", "2023-01-01T00:00:00Z", "...", transcript, "it", "auto", status)
+            )
+        conn.commit()
+        conn.close()
+
+    videos_from_yt_api = [
+        Video(video_id=video_id, title=video_id, channel_id="channel_checkpoint", published_at="2023-01-01T00:00:00Z", url="...")
+        for video_id in ("vid_done", "vid_upserted", "vid_interrupted", "vid_new")
+    ]
+
+    # ARRANGE: per 'vid_upserted' l'upsert era riuscito prima dell'interruzione
+    mock_chroma_collection = MagicMock()
+    mock_chroma_collection.get.side_effect = lambda where, include: {'ids': ["vid_upserted_chunk_0"] if where['video_id'] == "vid_upserted" else []}
+    mock_core_config = {**app.config, 'CHROMA_CLIENT': MagicMock(), 'VIDEO_COLLECTION_NAME': 'video_transcripts'}
+    mock_core_config['CHROMA_CLIENT'].get_or_create_collection.return_value = mock_chroma_collection
+
+    with patch('app.core.youtube_processor.UnofficialTranscriptService.get_transcript',
+               return_value={'text': 'Trascrizione nuova.', 'language': 'it', 'type': 'auto'}) as mock_unofficial, \
+         patch('app.core.youtube_processor.TranscriptService.get_transcript') as mock_official, \
+         patch('app.core.youtube_processor.YouTubeClient', MagicMock()), \
+         patch('app.core.youtube_processor.split_text_into_chunks', side_effect=lambda text, **kwargs: [text]), \
+         patch('app.core.youtube_processor.generate_embeddings', side_effect=lambda chunks, **kwargs: [[0.1] * 8 for _ in chunks]) as mock_embed:
+        with app.app_context():
+            # ACT
+            result = _process_youtube_channel_core(
+                channel_id="channel_checkpoint", user_id=user_id_test, core_config=mock_core_config,
+                videos_from_yt_models=videos_from_yt_api, status_dict={}, use_official_api_only=False
+            )
+
+    # ASSERT
+    assert result['success'] is True
+    assert result['new_videos_processed'] == 3
+    mock_unofficial.assert_called_once_with("vid_new")
+    mock_official.assert_not_called()
+    assert mock_embed.call_count == 2 # 'vid_interrupted' e 'vid_new'
+    upserted_ids = [call.kwargs['ids'][0] for call in mock_chroma_collection.upsert.call_args_list]
+    assert upserted_ids == ["vid_interrupted_chunk_0", "vid_new_chunk_0"]
+
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        rows = dict(conn.execute("SELECT video_id, processing_status FROM videos WHERE user_id = ?", (user_id_test,)).fetchall())
+        conn.close()
+    assert rows == {video_id: 'completed' for video_id in ("vid_done", "vid_upserted", "vid_interrupted", "vid_new")}
+
+
+def test_channel_backlog_is_split_into_daily_batches_that_fit_the_quota(app):
+    """
+    TEST SCENARIO: un canale con più video di quanti la quota di oggi permetta, elencato in due pagine.
+    Il run elabora i più recenti che ci stanno, mette gli altri in coda per il giorno dopo e il run
+    successivo (solo coda, come fa lo scheduler) li completa.
+    """
+    # ARRANGE: 250 unità a video (API ufficiale), 100 di riserva
+    user_id_test = "user_for_quota_backlog"
+    channel_id = "UC-big-channel"
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM videos WHERE user_id = ?", (user_id_test,))
+        conn.execute("DELETE FROM youtube_video_backlog WHERE user_id = ?", (user_id_test,))
+        conn.commit()
+        conn.close()
+
+    videos_on_channel = [
+        Video(video_id=f"vid{day}", title=f"Video {day}", channel_id=channel_id, published_at=f"2023-01-0{day}T00:00:00Z", url="...")
+        for day in range(5, 0, -1) # La playlist "Uploads" arriva dal più recente
+    ]
+    core_config = {**app.config, 'YOUTUBE_QUOTA_RESERVE_UNITS': 100}
+    processed_batches = []
+
+    def _fake_core(channel_id, user_id, core_config, videos_from_yt_models, status_dict, use_official_api_only):
+        processed_batches.append([v.video_id for v in videos_from_yt_models])
+        conn = sqlite3.connect(core_config['DATABASE_FILE'])
+        conn.executemany(
+            "INSERT INTO videos (video_id, title, user_id, channel_id, published_at, url, processing_status) VALUES (?,?,?,?,?,?,'completed')",
+            [(v.video_id, v.title, user_id, channel_id, str(v.published_at), v.url) for v in videos_from_yt_models]
+        )
+        conn.commit()
+        conn.close()
+        return {"success": True, "new_videos_processed": len(videos_from_yt_models)}
+
+    def _quota(day, remaining):
+        return {'quota_day': day, 'remaining': remaining, 'limit': 850}
+
+    with patch('app.core.youtube_processor.iter_channel_videos', return_value=iter([videos_on_channel[:3], videos_on_channel[3:]])), \
+         patch('app.core.youtube_processor._process_youtube_channel_core', side_effect=_fake_core):
+        with app.app_context():
+            # ACT 1: oggi restano 600 unità -> 2 video, poi 3 al giorno
+            with patch('app.core.youtube_backlog.get_quota_status', return_value=_quota('2026-03-10', 600)):
+                first_run = process_channel_with_backlog(MagicMock(), channel_id, user_id_test, core_config, {}, use_official_api_only=True)
+            conn = sqlite3.connect(app.config['DATABASE_FILE'])
+            queued = conn.execute("SELECT video_id, planned_day FROM youtube_video_backlog WHERE user_id = ? ORDER BY video_id", (user_id_test,)).fetchall()
+            conn.close()
+
+            # ACT 2: il giorno dopo lo scheduler smaltisce la coda
+            with patch('app.core.youtube_backlog.get_quota_status', return_value=_quota('2026-03-11', 850)):
+                second_run = process_channel_with_backlog(MagicMock(), channel_id, user_id_test, core_config, {}, use_official_api_only=True, list_new_videos=False)
+
+    # ASSERT: prima i più recenti, nessun video perso o elaborato due volte
+    assert processed_batches == [["vid5", "vid4"], ["vid3", "vid2", "vid1"]]
+    assert queued == [("vid1", "2026-03-11"), ("vid2", "2026-03-11"), ("vid3", "2026-03-11")]
+    assert first_run["backlog"] == {'queued_videos': 3, 'last_day': '2026-03-11'}
+    assert second_run["backlog"]["queued_videos"] == 0
+
+
+def test_youtube_processor_starts_transcripts_while_the_listing_is_still_arriving(app):
+    """
+    TEST SCENARIO: il core riceve i video come iteratore di pagine. Le trascrizioni della prima pagina
+    partono prima che la seconda pagina venga richiesta, e il totale mostrato cresce con le pagine.
+    """
+    # ARRANGE
+    user_id_test = "user_for_streaming_listing"
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM videos WHERE user_id = ?", (user_id_test,))
+        conn.commit()
+        conn.close()
+
+    first_transcript_started = threading.Event()
+    page_two_requested_after_transcript = []
+
+    def _pages():
+        yield [Video(video_id=v, title=v, channel_id="channel_stream", published_at="2023-01-02T00:00:00Z", url="...") for v in ("p1_a", "p1_b")]
+        page_two_requested_after_transcript.append(first_transcript_started.wait(timeout=5))
+        yield [Video(video_id="p2_a", title="p2_a", channel_id="channel_stream", published_at="2023-01-01T00:00:00Z", url="...")]
+
+    def _fake_transcript(video_id):
+        first_transcript_started.set()
+        return {'text': f'Testo di {video_id}.', 'language': 'it', 'type': 'auto'}
+
+    mock_core_config = {**app.config, 'CHROMA_CLIENT': MagicMock(), 'VIDEO_COLLECTION_NAME': 'video_transcripts', 'YOUTUBE_TRANSCRIPT_WORKERS': 1}
+    status = {}
+    with patch('app.core.youtube_processor.UnofficialTranscriptService.get_transcript', side_effect=_fake_transcript), \
+         patch('app.core.youtube_processor.split_text_into_chunks', side_effect=lambda text, **kwargs: [text]), \
+         patch('app.core.youtube_processor.generate_embeddings', side_effect=lambda chunks, **kwargs: [[0.1] * 8 for _ in chunks]):
+        with app.app_context():
+            # ACT
+            result = _process_youtube_channel_core(
+                channel_id="channel_stream", user_id=user_id_test, core_config=mock_core_config,
+                videos_from_yt_models=(video for page in _pages() for video in page), status_dict=status
+            )
+
+    # ASSERT
+    assert page_two_requested_after_transcript == [True]
+    assert result["success"] is True
+    assert result["new_videos_processed"] == 3
+    assert result["total_videos_on_yt"] == 3
+    assert status["total_videos"] == 3
+
+
+def test_channel_run_skips_live_private_and_short_videos_before_spending_caption_quota(app):
+    """
+    TEST SCENARIO: una pagina di video nuovi passa da un'unica richiesta di dettagli in blocco.
+    Prime visioni e video privati non arrivano al core e non vengono salvati (si riprovano al
+    prossimo run); gli Shorts vengono salvati come 'skipped_short'.
+    """
+    # ARRANGE
+    user_id_test = "user_for_video_prefilter"
+    channel_id = "UC-prefilter"
+    with app.app_context():
+        conn = sqlite3.connect(app.config['DATABASE_FILE'])
+        conn.execute("DELETE FROM videos WHERE user_id = ?", (user_id_test,))
+        conn.execute("DELETE FROM youtube_video_backlog WHERE user_id = ?", (user_id_test,))
+        conn.commit()
+        conn.close()
+
+    page = [Video(video_id=v, title=v, channel_id=channel_id, published_at="2023-01-01T00:00:00Z", url="...")
+            for v in ("vid_ok", "vid_upcoming", "vid_private", "vid_short")]
+    details = {
+        "vid_ok": {'video': page[0], 'duration_seconds': 600, 'live_broadcast_content': 'none', 'has_captions': False},
+        "vid_upcoming": {'video': page[1], 'duration_seconds': 0, 'live_broadcast_content': 'upcoming', 'has_captions': False},
+        "vid_short": {'video': page[3], 'duration_seconds': 45, 'live_broadcast_content': 'none', 'has_captions': True},
+    }
+    mock_client = MagicMock()
+    mock_client.iter_channel_video_pages.return_value = iter([page])
+    mock_client.get_videos_details.return_value = details
+    core_config = {**app.config, 'YOUTUBE_SKIP_VIDEOS_SHORTER_THAN_SECONDS': 60}
+
+    with patch('app.core.youtube_processor._process_youtube_channel_core', return_value={"success": True}) as mock_core:
+        with app.app_context():
+            # ACT
+            process_channel_with_backlog(mock_client, channel_id, user_id_test, core_config, {}, use_official_api_only=False)
+            conn = sqlite3.connect(app.config['DATABASE_FILE'])
+            saved = conn.execute("SELECT video_id, processing_status FROM videos WHERE user_id = ?", (user_id_test,)).fetchall()
+            conn.close()
+
+    # ASSERT
+    mock_client.get_videos_details.assert_called_once_with(["vid_ok", "vid_upcoming", "vid_private", "vid_short"])
+    assert [v.video_id for v in mock_core.call_args.kwargs['videos_from_yt_models']] == ["vid_ok"]
+    assert saved == [("vid_short", "skipped_short")]